@@ -11,10 +11,42 @@ import logzero
 from logzero import logger
 import time
 import ssl
+import threading
+import weakref
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
 from SmartApi.version import __version__, __title__
 
 log = logging.getLogger(__name__)
 
+#
+# TOMAR
+# All REST calls go through one pooled keep-alive requests.Session, so only
+# the first call (and the first call after the server drops an idle
+# connection) pays for the TCP and TLS handshake.
+# _new_conn() of the pools below counts, per thread, the connections opened
+# by the current call, which is how _request() knows if the call reused a
+# pooled connection, see getRequestStats().
+#
+_conn_tls = threading.local()
+
+class _HTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        _conn_tls.new_conns = getattr(_conn_tls, "new_conns", 0) + 1
+        return super()._new_conn()
+
+class _HTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        _conn_tls.new_conns = getattr(_conn_tls, "new_conns", 0) + 1
+        return super()._new_conn()
+
+class _CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _HTTPConnectionPool,
+            "https": _HTTPSConnectionPool,
+        }
+
 class SmartConnect(object):
     #_rootUrl = "https://openapisuat.angelbroking.com"
     _rootUrl="https://apiconnect.angelone.in" #prod endpoint
@@ -122,19 +154,37 @@ class SmartConnect(object):
         # Configure minimum TLS version to TLS 1.2
         self.ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
 
-        if not disable_ssl:
-            self.reqsession = requests.Session()
-            if pool is not None:
-                reqadapter = requests.adapters.HTTPAdapter(**pool)
-                self.reqsession.mount("https://", reqadapter)
-            else:
-                reqadapter = requests.adapters.HTTPAdapter()
-                self.reqsession.mount("https://", reqadapter)
-            logger.info(f"in pool")
-        else:
-            # If SSL is disabled, use the default SSL context
-            self.reqsession = requests
-            
+        #
+        # TOMAR
+        # pool is passed to HTTPAdapter, f.e., {"pool_connections": 4,
+        # "pool_maxsize": 16}. pool_maxsize is the number of connections kept
+        # alive per host, it should be at least the number of threads making
+        # concurrent calls. timeout can be a (connect, read) tuple.
+        #
+        self.pool = pool
+        self._newSession()
+
+        # Per route stats, see getRequestStats().
+        self.stats_lock = threading.Lock()
+        self.request_stats = {}
+
+        #
+        # TOMAR
+        # pylive forks the OrderPlacer process after login, with this object
+        # (and its session) already in use. The child must not use the
+        # pooled connections of the parent, both would be reading/writing
+        # the same TLS streams, and it must not inherit locks (pool locks,
+        # stats_lock) that some parent thread held at fork time, so it
+        # starts with a new session. The inherited connections are just
+        # dropped, not closed, as they still belong to the parent.
+        #
+        this = weakref.ref(self)
+        def after_fork_in_child():
+            obj = this()
+            if obj is not None:
+                obj._afterForkInChild()
+        os.register_at_fork(after_in_child=after_fork_in_child)
+
         # Create a log folder based on the current date
         log_folder = time.strftime("%Y-%m-%d", time.localtime())
         log_folder_path = os.path.join("logs", log_folder)  # Construct the full path to the log folder
@@ -142,16 +192,18 @@ class SmartConnect(object):
         log_path = os.path.join(log_folder_path, "app.log") # Construct the full path to the log file
         logzero.logfile(log_path, loglevel=logging.ERROR)  # Output logs to a date-wise log file
 
-        if pool:
-            self.reqsession = requests.Session()
-            reqadapter = requests.adapters.HTTPAdapter(**pool)
-            self.reqsession.mount("https://", reqadapter)
-            logger.info(f"in pool")
-        else:
-            self.reqsession = requests
-
         # disable requests SSL warning
         requests.packages.urllib3.disable_warnings()
+    def _newSession(self):
+        self.reqsession = requests.Session()
+        reqadapter = _CountingHTTPAdapter(**(self.pool or {}))
+        self.reqsession.mount("https://", reqadapter)
+        self.reqsession.mount("http://", reqadapter)
+
+    def _afterForkInChild(self):
+        self._newSession()
+        self.stats_lock = threading.Lock()
+
     def requestHeaders(self):
         return{
             "Content-type":self.accept,
@@ -215,8 +267,10 @@ class SmartConnect(object):
         if self.debug:
             log.debug("Request: {method} {url} {params} {headers}".format(method=method, url=url, params=params, headers=headers))
     
+        _conn_tls.new_conns = 0
+        start = time.perf_counter()
         try:
-            r = requests.request(method,
+            r = self.reqsession.request(method,
                                         url,
                                         data=json.dumps(params) if method in ["POST", "PUT"] else None,
                                         params=json.dumps(params) if method in ["GET", "DELETE"] else None,
@@ -227,9 +281,12 @@ class SmartConnect(object):
                                         proxies=self.proxies)
            
         except Exception as e:
+            self._recordRequest(route, time.perf_counter() - start, error=True)
             logger.error(f"Error occurred while making a {method} request to {url}. Headers: {headers}, Request: {params}, Response: {e}")
             raise e
 
+        self._recordRequest(route, time.perf_counter() - start)
+
         if self.debug:
             log.debug("Response: {code} {content}".format(code=r.status_code, content=r.content))
 
@@ -261,6 +318,46 @@ class SmartConnect(object):
                 content_type=headers["Content-type"],
                 content=r.content))
         
+    def _recordRequest(self, route, latency, error=False):
+        new_conns = _conn_tls.new_conns
+        with self.stats_lock:
+            stats = self.request_stats.get(route)
+            if stats is None:
+                stats = {"calls": 0, "reused": 0, "new_connections": 0,
+                         "errors": 0, "latency": 0.0, "max_latency": 0.0}
+                self.request_stats[route] = stats
+            stats["calls"] += 1
+            if new_conns == 0:
+                stats["reused"] += 1
+            stats["new_connections"] += new_conns
+            if error:
+                stats["errors"] += 1
+            stats["latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+
+    #
+    # TOMAR
+    # Per route calls, calls that reused a pooled connection, connections
+    # opened, errors and average/max latency (ms) of the REST calls made till
+    # now, along with their totals (as "total").
+    #
+    def getRequestStats(self):
+        with self.stats_lock:
+            routes = {route: dict(stats) for route, stats in self.request_stats.items()}
+
+        total = {"calls": 0, "reused": 0, "new_connections": 0,
+                 "errors": 0, "latency": 0.0, "max_latency": 0.0}
+        for stats in routes.values():
+            for key in ("calls", "reused", "new_connections", "errors", "latency"):
+                total[key] += stats[key]
+            total["max_latency"] = max(total["max_latency"], stats["max_latency"])
+        routes["total"] = total
+
+        for stats in routes.values():
+            stats["avg_ms"] = round(stats.pop("latency") * 1000 / max(1, stats["calls"]), 3)
+            stats["max_ms"] = round(stats.pop("max_latency") * 1000, 3)
+        return routes
+
     def _deleteRequest(self, route, params=None):
         """Alias for sending a DELETE request."""
         return self._request(route, "DELETE", params)
@@ -47,11 +47,36 @@ class SmartWebSocketV2(object):
         4: "DEPTH"
     }
 
+    #
+    # XXX
+    # Precompiled (little endian) binary layouts for each subscription mode.
+    # Field offsets are as documented at
+    # https://smartapi.angelbroking.com/docs/WebSocket2
+    #
+    # LTP: mode, exchange type, token, sequence number, exchange timestamp, ltp.
+    _LTP_STRUCT = struct.Struct("<BB25sqqq")
+    # QUOTE: LTP + ltq, atp, volume, total buy/sell qty, day open, high, low, close.
+    _QUOTE_STRUCT = struct.Struct("<BB25sqqqqqqddqqqq")
+    # SNAP_QUOTE: QUOTE + ltt, oi, oi change %, <best 5 data>, circuit limits, 52 week high/low.
+    _SNAP_QUOTE_STRUCT = struct.Struct("<BB25sqqqqqqddqqqqqqd200xqqqq")
+    # DEPTH: mode, exchange type, token, <8 bytes not used>, exchange timestamp.
+    _DEPTH_HEADER_STRUCT = struct.Struct("<BB25s8xq")
+    # One best 5 packet: flag, quantity, price, no of orders.
+    _BEST_5_PACKET_STRUCT = struct.Struct("<HqqH")
+    # One depth 20 packet: quantity, price, num of orders.
+    _DEPTH_20_PACKET_STRUCT = struct.Struct("<iih")
+    # Lean layouts, skip everything not returned by _parse_binary_data_lean().
+    _LEAN_LTP_STRUCT = struct.Struct("<B1x25sqqq")
+    _LEAN_QUOTE_STRUCT = struct.Struct("<B1x25sqqq16xq16xqqqq")
+
     wsapp = None
     input_request_dict = {}
     current_retry_attempt = 0
 
-    def __init__(self, auth_token, api_key, client_code, feed_token, max_retry_attempt=1,retry_strategy=0, retry_delay=10, retry_multiplier=2, retry_duration=60):
+    # Optional callable, called with every raw binary frame before it's parsed, f.e., for recording the feed.
+    on_raw_data = None
+
+    def __init__(self, auth_token, api_key, client_code, feed_token, max_retry_attempt=1,retry_strategy=0, retry_delay=10, retry_multiplier=2, retry_duration=60, lean=False):
         """
             Initialise the SmartWebSocketV2 instance
             Parameters
@@ -64,6 +89,9 @@ class SmartWebSocketV2(object):
                 angel one account id
             feed_token: string
                 feed token received from Login API
+            lean: bool
+                if True, on_data gets only the fields needed for tracking LTP
+                and building candles, see _parse_binary_data_lean()
         """
         self.auth_token = auth_token
         self.api_key = api_key
@@ -76,6 +104,9 @@ class SmartWebSocketV2(object):
         self.retry_delay = retry_delay
         self.retry_multiplier = retry_multiplier
         self.retry_duration = retry_duration        
+        self.lean = lean
+        # Per connection subscriptions (for resubscribe), not shared with other instances.
+        self.input_request_dict = {}
         # Create a log folder based on the current date
         log_folder = time.strftime("%Y-%m-%d", time.localtime())
         log_folder_path = os.path.join("logs", log_folder)  # Construct the full path to the log folder
@@ -118,6 +149,8 @@ class SmartWebSocketV2(object):
 
     def _on_data(self, wsapp, data, data_type, continue_flag):
         if data_type == 2:
+            if self.on_raw_data is not None:
+                self.on_raw_data(data)
             parsed_message = self._parse_binary_data(data)
             self.on_data(wsapp, parsed_message)
 
@@ -195,7 +228,7 @@ class SmartWebSocketV2(object):
                 if token['exchangeType'] in self.input_request_dict[mode]:
                     self.input_request_dict[mode][token['exchangeType']].extend(token["tokens"])
                 else:
-                    self.input_request_dict[mode][token['exchangeType']] = token["tokens"]
+                    self.input_request_dict[mode][token['exchangeType']] = list(token["tokens"])
 
             if mode == self.DEPTH:
                 total_tokens = sum(len(token["tokens"]) for token in token_list)
@@ -345,59 +378,129 @@ class SmartWebSocketV2(object):
         self.on_close(wsapp)
 
     def _parse_binary_data(self, binary_data):
-        parsed_data = {
-            "subscription_mode": self._unpack_data(binary_data, 0, 1, byte_format="B")[0],
-            "exchange_type": self._unpack_data(binary_data, 1, 2, byte_format="B")[0],
-            "token": SmartWebSocketV2._parse_token_value(binary_data[2:27]),
-            "sequence_number": self._unpack_data(binary_data, 27, 35, byte_format="q")[0],
-            "exchange_timestamp": self._unpack_data(binary_data, 35, 43, byte_format="q")[0],
-            "last_traded_price": self._unpack_data(binary_data, 43, 51, byte_format="q")[0]
-        }
+        #
+        # XXX
+        # Each tick is decoded with a single unpack_from() of the precompiled
+        # layout for its subscription mode, over a memoryview so that we don't
+        # copy slices of the packet. Earlier we did one struct.unpack() per
+        # field which meant a slice copy and a format string parse per field.
+        #
         try:
-            parsed_data["subscription_mode_val"] = self.SUBSCRIPTION_MODE_MAP.get(parsed_data["subscription_mode"])
-
-            if parsed_data["subscription_mode"] in [self.QUOTE, self.SNAP_QUOTE]:
-                parsed_data["last_traded_quantity"] = self._unpack_data(binary_data, 51, 59, byte_format="q")[0]
-                parsed_data["average_traded_price"] = self._unpack_data(binary_data, 59, 67, byte_format="q")[0]
-                parsed_data["volume_trade_for_the_day"] = self._unpack_data(binary_data, 67, 75, byte_format="q")[0]
-                parsed_data["total_buy_quantity"] = self._unpack_data(binary_data, 75, 83, byte_format="d")[0]
-                parsed_data["total_sell_quantity"] = self._unpack_data(binary_data, 83, 91, byte_format="d")[0]
-                parsed_data["open_price_of_the_day"] = self._unpack_data(binary_data, 91, 99, byte_format="q")[0]
-                parsed_data["high_price_of_the_day"] = self._unpack_data(binary_data, 99, 107, byte_format="q")[0]
-                parsed_data["low_price_of_the_day"] = self._unpack_data(binary_data, 107, 115, byte_format="q")[0]
-                parsed_data["closed_price"] = self._unpack_data(binary_data, 115, 123, byte_format="q")[0]
-
-            if parsed_data["subscription_mode"] == self.SNAP_QUOTE:
-                parsed_data["last_traded_timestamp"] = self._unpack_data(binary_data, 123, 131, byte_format="q")[0]
-                parsed_data["open_interest"] = self._unpack_data(binary_data, 131, 139, byte_format="q")[0]
+            data = memoryview(binary_data)
+            subscription_mode = data[0]
+
+            # Depth packets have nothing useful for lean consumers, decode fully.
+            if self.lean and subscription_mode != self.DEPTH:
+                return self._parse_binary_data_lean(data, subscription_mode)
+
+            if subscription_mode == self.DEPTH:
+                (subscription_mode, exchange_type, token,
+                 exchange_timestamp) = self._DEPTH_HEADER_STRUCT.unpack_from(data, 0)
+                depth_20_data = self._parse_depth_20_buy_and_sell_data(data[43:])
+                return {
+                    "subscription_mode": subscription_mode,
+                    "exchange_type": exchange_type,
+                    "token": self._token_from_bytes(token),
+                    "exchange_timestamp": exchange_timestamp,
+                    "packet_received_time": exchange_timestamp,
+                    "depth_20_buy_data": depth_20_data["depth_20_buy_data"],
+                    "depth_20_sell_data": depth_20_data["depth_20_sell_data"]
+                }
+
+            if subscription_mode == self.SNAP_QUOTE:
+                fields = self._SNAP_QUOTE_STRUCT.unpack_from(data, 0)
+            elif subscription_mode == self.QUOTE:
+                fields = self._QUOTE_STRUCT.unpack_from(data, 0)
+            else:
+                fields = self._LTP_STRUCT.unpack_from(data, 0)
+
+            parsed_data = {
+                "subscription_mode": fields[0],
+                "exchange_type": fields[1],
+                "token": self._token_from_bytes(fields[2]),
+                "sequence_number": fields[3],
+                "exchange_timestamp": fields[4],
+                "last_traded_price": fields[5],
+                "subscription_mode_val": self.SUBSCRIPTION_MODE_MAP.get(fields[0])
+            }
+
+            if subscription_mode in (self.QUOTE, self.SNAP_QUOTE):
+                parsed_data["last_traded_quantity"] = fields[6]
+                parsed_data["average_traded_price"] = fields[7]
+                parsed_data["volume_trade_for_the_day"] = fields[8]
+                parsed_data["total_buy_quantity"] = fields[9]
+                parsed_data["total_sell_quantity"] = fields[10]
+                parsed_data["open_price_of_the_day"] = fields[11]
+                parsed_data["high_price_of_the_day"] = fields[12]
+                parsed_data["low_price_of_the_day"] = fields[13]
+                parsed_data["closed_price"] = fields[14]
+
+            if subscription_mode == self.SNAP_QUOTE:
+                parsed_data["last_traded_timestamp"] = fields[15]
+                parsed_data["open_interest"] = fields[16]
                 #
                 # TOMAR
                 # q -> d
                 #
-                parsed_data["open_interest_change_percentage"] = self._unpack_data(binary_data, 139, 147, byte_format="d")[0]
-                parsed_data["upper_circuit_limit"] = self._unpack_data(binary_data, 347, 355, byte_format="q")[0]
-                parsed_data["lower_circuit_limit"] = self._unpack_data(binary_data, 355, 363, byte_format="q")[0]
-                parsed_data["52_week_high_price"] = self._unpack_data(binary_data, 363, 371, byte_format="q")[0]
-                parsed_data["52_week_low_price"] = self._unpack_data(binary_data, 371, 379, byte_format="q")[0]
-                best_5_buy_and_sell_data = self._parse_best_5_buy_and_sell_data(binary_data[147:347])
+                parsed_data["open_interest_change_percentage"] = fields[17]
+                parsed_data["upper_circuit_limit"] = fields[18]
+                parsed_data["lower_circuit_limit"] = fields[19]
+                parsed_data["52_week_high_price"] = fields[20]
+                parsed_data["52_week_low_price"] = fields[21]
+                best_5_buy_and_sell_data = self._parse_best_5_buy_and_sell_data(data[147:347])
                 parsed_data["best_5_buy_data"] = best_5_buy_and_sell_data["best_5_sell_data"]
                 parsed_data["best_5_sell_data"] = best_5_buy_and_sell_data["best_5_buy_data"]
 
-            if parsed_data["subscription_mode"] == self.DEPTH:
-                parsed_data.pop("sequence_number", None)
-                parsed_data.pop("last_traded_price", None)
-                parsed_data.pop("subscription_mode_val", None)
-                parsed_data["packet_received_time"]=self._unpack_data(binary_data, 35, 43, byte_format="q")[0]
-                depth_data_start_index = 43
-                depth_20_data = self._parse_depth_20_buy_and_sell_data(binary_data[depth_data_start_index:])
-                parsed_data["depth_20_buy_data"] = depth_20_data["depth_20_buy_data"]
-                parsed_data["depth_20_sell_data"] = depth_20_data["depth_20_sell_data"]
-
             return parsed_data
         except Exception as e:
             logger.error(f"Error occurred during binary data parsing: {e}")
             raise e
 
+    def _parse_binary_data_lean(self, data, subscription_mode):
+        """
+            Lean variant of _parse_binary_data(), used when the instance is
+            created with lean=True.
+            It returns only the fields needed for building candles and tracking
+            LTP, i.e., subscription_mode, token, sequence_number,
+            exchange_timestamp, last_traded_price and, for QUOTE and SNAP_QUOTE
+            modes, volume_trade_for_the_day and the day's OHLC.
+            The rest of the packet is never decoded.
+        """
+        if subscription_mode in (self.QUOTE, self.SNAP_QUOTE):
+            (subscription_mode, token, sequence_number, exchange_timestamp,
+             last_traded_price, volume_trade_for_the_day, open_price_of_the_day,
+             high_price_of_the_day, low_price_of_the_day,
+             closed_price) = self._LEAN_QUOTE_STRUCT.unpack_from(data, 0)
+            return {
+                "subscription_mode": subscription_mode,
+                "token": self._token_from_bytes(token),
+                "sequence_number": sequence_number,
+                "exchange_timestamp": exchange_timestamp,
+                "last_traded_price": last_traded_price,
+                "volume_trade_for_the_day": volume_trade_for_the_day,
+                "open_price_of_the_day": open_price_of_the_day,
+                "high_price_of_the_day": high_price_of_the_day,
+                "low_price_of_the_day": low_price_of_the_day,
+                "closed_price": closed_price
+            }
+
+        (subscription_mode, token, sequence_number, exchange_timestamp,
+         last_traded_price) = self._LEAN_LTP_STRUCT.unpack_from(data, 0)
+        return {
+            "subscription_mode": subscription_mode,
+            "token": self._token_from_bytes(token),
+            "sequence_number": sequence_number,
+            "exchange_timestamp": exchange_timestamp,
+            "last_traded_price": last_traded_price
+        }
+
+    @staticmethod
+    def _token_from_bytes(token):
+        """
+            Token is a NUL terminated string in a fixed 25 byte field.
+        """
+        return token.split(b"\x00", 1)[0].decode("latin-1")
+
     def _unpack_data(self, binary_data, start, end, byte_format="I"):
         """
             Unpack Binary Data to the integer according to the specified byte_format.
@@ -415,30 +518,18 @@ class SmartWebSocketV2(object):
         return token
 
     def _parse_best_5_buy_and_sell_data(self, binary_data):
-
-        def split_packets(binary_packets):
-            packets = []
-
-            i = 0
-            while i < len(binary_packets):
-                packets.append(binary_packets[i: i + 20])
-                i += 20
-            return packets
-
-        best_5_buy_sell_packets = split_packets(binary_data)
-
         best_5_buy_data = []
         best_5_sell_data = []
 
-        for packet in best_5_buy_sell_packets:
+        for flag, quantity, price, num_orders in self._BEST_5_PACKET_STRUCT.iter_unpack(binary_data):
             each_data = {
-                "flag": self._unpack_data(packet, 0, 2, byte_format="H")[0],
-                "quantity": self._unpack_data(packet, 2, 10, byte_format="q")[0],
-                "price": self._unpack_data(packet, 10, 18, byte_format="q")[0],
-                "no of orders": self._unpack_data(packet, 18, 20, byte_format="H")[0]
+                "flag": flag,
+                "quantity": quantity,
+                "price": price,
+                "no of orders": num_orders
             }
 
-            if each_data["flag"] == 0:
+            if flag == 0:
                 best_5_buy_data.append(each_data)
             else:
                 best_5_sell_data.append(each_data)
@@ -452,26 +543,21 @@ class SmartWebSocketV2(object):
         depth_20_buy_data = []
         depth_20_sell_data = []
 
-        for i in range(20):
-            buy_start_idx = i * 10
-            sell_start_idx = 200 + i * 10
-
-            # Parse buy data
-            buy_packet_data = {
-                "quantity": self._unpack_data(binary_data, buy_start_idx, buy_start_idx + 4, byte_format="i")[0],
-                "price": self._unpack_data(binary_data, buy_start_idx + 4, buy_start_idx + 8, byte_format="i")[0],
-                "num_of_orders": self._unpack_data(binary_data, buy_start_idx + 8, buy_start_idx + 10, byte_format="h")[0],
+        #
+        # 20 buy packets followed by 20 sell packets, 10 bytes each.
+        #
+        packets = self._DEPTH_20_PACKET_STRUCT.iter_unpack(binary_data[:400])
+        for i, (quantity, price, num_of_orders) in enumerate(packets):
+            packet_data = {
+                "quantity": quantity,
+                "price": price,
+                "num_of_orders": num_of_orders,
             }
 
-            # Parse sell data
-            sell_packet_data = {
-                "quantity": self._unpack_data(binary_data, sell_start_idx, sell_start_idx + 4, byte_format="i")[0],
-                "price": self._unpack_data(binary_data, sell_start_idx + 4, sell_start_idx + 8, byte_format="i")[0],
-                "num_of_orders": self._unpack_data(binary_data, sell_start_idx + 8, sell_start_idx + 10, byte_format="h")[0],
-            }
-
-            depth_20_buy_data.append(buy_packet_data)
-            depth_20_sell_data.append(sell_packet_data)
+            if i < 20:
+                depth_20_buy_data.append(packet_data)
+            else:
+                depth_20_sell_data.append(packet_data)
 
         return {
             "depth_20_buy_data": depth_20_buy_data,
@@ -15,6 +15,18 @@ from pathlib import Path
 
 from brokerbase import BrokerBase
 
+# For the rate limiter shared with pylive, see pylive/common/ratelimit.py.
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'pylive', 'common'))
+import ratelimit
+
+#
+# getCandleData allows 3 requests/sec, 180/min and 5000/hr as per
+# https://smartapi.angelbroking.com/docs/RateLimit.
+# Every call goes through candle_limiter which waits only as long as these
+# limits require, and after a failed call, for a jittered exponential backoff.
+#
+candle_limiter = ratelimit.RateLimiter({"getCandleData": [(3, 1), (180, 60), (5000, 3600)]})
+
 def get_linecount(filename):
     ''' Return number of lines in the given file.
     '''
@@ -69,7 +81,12 @@ class AngelOne(BrokerBase):
 
         # AngelOne specific account details.
         angelone = cfg['broker']['angelone']['account']
-        self.obj = SmartConnect(api_key=angelone['api_key'])
+        # getCandleData calls share a pool of keep-alive connections.
+        self.obj = SmartConnect(api_key=angelone['api_key'],
+                                pool={"pool_connections": 1,
+                                      "pool_maxsize": int(cfg.get('broker_http_pool_size', "4"))},
+                                timeout=(float(cfg.get('broker_http_connect_timeout', "3")),
+                                         float(cfg.get('broker_http_read_timeout', "7"))))
         totp = pyotp.TOTP(angelone['token'])
         time_remaining = totp.interval - (datetime.now().timestamp() % totp.interval)
         otp = totp.now()
@@ -240,7 +257,10 @@ class AngelOne(BrokerBase):
         #
         instrument_token = self.get_instrument_token_for_symbol(symbol)
 
+        attempt = 0
         while True:
+            attempt += 1
+            candle_limiter.acquire("getCandleData")
             try:
                 #
                 # AngelOne can supply all 1D candles for a year in one call,
@@ -253,15 +273,14 @@ class AngelOne(BrokerBase):
                     "fromdate": datetime.strftime(first_day_of_year, '%Y-%m-%d %H:%M'),
                     "todate": datetime.strftime(last_day_of_year, '%Y-%m-%d %H:%M')
                 }
-                hd = self.obj.getCandleData(historicParam)['data']
-                print("Got historical_data %s" %
-                                (json.dumps(self.obj.getCandleData(historicParam), indent=2)))
+                resp = self.obj.getCandleData(historicParam)
+                hd = resp['data']
+                print("Got historical_data %s" % (json.dumps(resp, indent=2)))
                 break
             except Exception as e:
                 print("[pyhistorical] Historic Api failed: {}".format(e))
-                # w/o sleep it performs better, as the server itself
-                # throttles the APIs.
-                time.sleep(0.5)
+                # Next acquire() waits for the backoff.
+                candle_limiter.backoff("getCandleData", attempt)
 
         print("[pyhistorical] {} historical daily data received for {} from AngelOne, "
               "between {} -> {}." .format(
@@ -598,7 +617,10 @@ class AngelOne(BrokerBase):
                 break
 
             historicParam = {}
+            attempt = 0
             while True:
+                attempt += 1
+                candle_limiter.acquire("getCandleData")
                 try:
                     #
                     # We ask for tne entire range of candles that we need.
@@ -626,9 +648,8 @@ class AngelOne(BrokerBase):
                 except Exception as e:
                     print("[pyhistorical] [%s] Historical Api failed (%s): %s" %
                             (symbol, historicParam, e))
-                    # w/o sleep it performs better, as the server itself
-                    # throttles the APIs.
-                    time.sleep(0.5)
+                    # Next acquire() waits for the backoff.
+                    candle_limiter.backoff("getCandleData", attempt)
 
             if hd is None or len(hd) == 0:
                 if hd is None:
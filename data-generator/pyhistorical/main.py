@@ -10,7 +10,7 @@
 import os
 import json
 import argparse
-from angelone import AngelOne
+from angelone import AngelOne, candle_limiter
 import helpers as ch
 
 def main():
@@ -80,6 +80,10 @@ def main():
     else:
         broker.load_historical(cfg)
 
+    print("[pyhistorical] getCandleData stats: %s" % json.dumps(candle_limiter.stats()))
+    if broker.obj is not None:
+        print("[pyhistorical] HTTP stats: %s" % json.dumps(broker.obj.getRequestStats()))
+
     f.close()
 
 if __name__ == "__main__":
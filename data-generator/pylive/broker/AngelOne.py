@@ -36,8 +36,14 @@ PYPInfo("Before import SmartWebSocketV2")
 from SmartApi.smartWebSocketV2 import SmartWebSocketV2
 PYPInfo("SmartWebSocketV2 imported")
 
+from SmartApi.smartWebSocketOrderUpdate import SmartWebSocketOrderUpdate
+
 import pyotp
 import multiprocessing
+import functools
+import threading
+import FrameLog
+import ratelimit
 
 #
 # API doc @ https://github.com/angel-one/smartapi-python
@@ -73,6 +79,14 @@ sub_token = None
 token_list = None
 ss = None
 ss2 = None
+
+#
+# With cfg.feed_partitions > 1 the tokens in token_list are split over that
+# many websocket connections. token_lists[i] has the tokens subscribed over
+# ws2_conns[i]. ss2 is ws2_conns[0].
+#
+token_lists = None
+ws2_conns = None
 obj = None
 tick_cb = None
 initialized = None
@@ -80,8 +94,84 @@ initialized = None
 websocket_running = False
 stop_websocket_called = False
 
+#
+# FrameLog.FrameRecorder recording raw websocket frames, if cfg.ws_record is
+# set, else None.
+#
+recorder = None
+
+#
+# FrameLog.FrameReplayer, if we are replaying recorded frames instead of
+# connecting to the websocket, see broker/replay.py, else None.
+#
+replayer = None
+
+#
+# Order update websocket, see start_order_updates().
+#
+ws_order_update = None
+order_update_cb = None
+order_update_thread = None
+stop_order_updates_called = False
+
+# Delay before reconnecting the order update websocket.
+ORDER_UPDATE_RETRY_SECS = 5
+
 stocks = get_stocks_list()
 
+#
+# AngelOne rate limits for the APIs we call, keyed by the SmartConnect method
+# (or route for postRequest()), as per
+# https://smartapi.angelbroking.com/docs/RateLimit.
+# Either requests/sec or a list of (requests, seconds).
+#
+# _SAFEAPI() calls every endpoint through api_limiter, which spaces the calls
+# as per these limits, so concurrent callers (f.e., OrderPlacer's broker
+# fetches, see fetch_from_broker()) don't collide on an endpoint and waste
+# retries on 'Access denied because of exceeding access rate' errors. Failed
+# calls are retried after a jittered exponential backoff. See
+# common/ratelimit.py. Endpoints not listed here are not throttled.
+#
+API_RATE_LIMITS = {
+    "getProfile": 3,
+    "rmsLimit": 2,
+    "allholding": 1,
+    "position": 1,
+    "orderBook": 1,
+    "tradeBook": 1,
+    "individual_order_details": 10,
+    "placeOrderFullResponse": 20,
+    "modifyOrder": 20,
+    "cancelOrder": 20,
+    "api.gtt.create": 20,
+    "api.gtt.modify": 20,
+    "gttDetails": 1,
+    "gttLists": 1,
+    "getCandleData": [(3, 1), (180, 60), (5000, 3600)],
+}
+
+api_limiter = ratelimit.RateLimiter(API_RATE_LIMITS)
+
+def _api_endpoint(func, args):
+    ''' Endpoint name for func called with args, as used in API_RATE_LIMITS.
+    '''
+    name = getattr(func, "__name__", str(func))
+    if name == "postRequest" and len(args) > 0:
+        return args[0]
+    return name
+
+def get_api_stats():
+    ''' Per endpoint calls, throttles, wait time and retries of _SAFEAPI().
+    '''
+    return api_limiter.stats()
+
+def get_http_stats():
+    ''' Per route calls, connection reuse and latency of the REST calls.
+    '''
+    if obj is None:
+        return {}
+    return obj.getRequestStats()
+
 #
 # Some internal server error returns we've seen.
 #
@@ -108,11 +198,14 @@ def _SAFEAPI(func, *args):
 
         Note: We also retry on failed status too. The reason is that mostly we
               won't be making failing API calls, so if it fails it's likely due to
-              some internal server error and retrying may help. In this case we
-              retry with more wait to help the server.
+              some internal server error and retrying may help. The backoff
+              grows with every retry to help the server.
     '''
+    endpoint = _api_endpoint(func, args)
     resp = None
     for i in range(1, 10):
+        # Waits as long as the endpoint's rate limit (or backoff) requires.
+        api_limiter.acquire(endpoint)
         try:
             if len(args) == 0:
                 resp = func()
@@ -129,8 +222,6 @@ def _SAFEAPI(func, *args):
                 if resp['status'] != True:
                     PYPWarn("API (%s) returned failed status: %s" %
                             (func, json.dumps(resp, indent=4)))
-                    # Additional wait for such "internal server" errors.
-                    time.sleep(1.0)
                     raise Exception("resp['status'] is not true!")
             else:
                 #
@@ -141,15 +232,13 @@ def _SAFEAPI(func, *args):
 
             return resp
         except Exception as e:
-            PYPWarn("API (%s) failed with exception: %s" % (func, e))
             #
             # Most likely cause for failure would be "too frequent API calls",
-            # so wait before retrying. Minimum allowed Req/sec is 1 as per
-            # https://smartapi.angelbroking.com/docs/RateLimit, so we might
-            # need to sleep for max 1sec, which means we might have more than
-            # 1 iteration of this loop.
+            # so back off before retrying, the next acquire() waits for it.
             #
-            time.sleep(0.5)
+            delay = api_limiter.backoff(endpoint, i)
+            PYPWarn("API (%s) failed with exception: %s, retrying after %.3fs" %
+                    (func, e, delay))
     PYPError("API (%s) failed even after 10 retries!" % (func))
     return None
 
@@ -328,17 +417,30 @@ def register_tickcb(cb):
 def login():
     ''' Perform login to AngelOne account for performing API calls.
     '''
-    # We must be here only if broker selection is angelone.
-    ASSERT(cfg.broker['selection'] == 'angelone')
+    # We must be here only if broker selection is angelone (or mock).
+    ASSERT(cfg.broker['selection'] in ('angelone', 'mock'))
 
+    #
     # AngelOne specific account details.
-    account = cfg.broker['angelone']['account']
+    # With the mock broker (see broker/mockbroker.py) we login and make all
+    # the calls exactly like we do with AngelOne, just to its url.
+    #
+    broker_cfg = cfg.broker[cfg.broker['selection']]
+    account = broker_cfg['account']
 
     global api_key
     api_key = account['api_key']
 
+    #
+    # All REST calls, from all threads, share a pool of keep-alive connections.
+    #
     global obj
-    obj = SmartConnect(api_key=api_key)
+    obj = SmartConnect(api_key=api_key,
+                       root=broker_cfg.get('url'),
+                       pool={"pool_connections": 4,
+                             "pool_maxsize": cfg.broker_http_pool_size},
+                       timeout=(cfg.broker_http_connect_timeout,
+                                cfg.broker_http_read_timeout))
 
     while True:
         totp = pyotp.TOTP(account['token'])
@@ -598,10 +700,10 @@ def ws_init():
     ss.connect()
     PYPInfo("After connect")
 
-def on_open2(ws2):
+def on_open2(ws2, partition=0):
     # Details @ https://smartapi.angelbroking.com/docs/WebSocket2
-    PYPInfo("websocket2:on_open")
-    PYPInfo("Subscribing token list: %s" % token_list)
+    PYPInfo("websocket2:on_open (connection %d)" % partition)
+    PYPInfo("Subscribing token list: %s" % token_lists[partition])
 
     #
     # 1 (LTP)
@@ -624,7 +726,7 @@ def on_open2(ws2):
     # tracking purposes between request and corresponding error response.
     #
     correlation_id = "tomar ws2"
-    ss2.subscribe(correlation_id, mode, token_list)
+    ws2_conns[partition].subscribe(correlation_id, mode, token_lists[partition])
     PYPInfo("Subscribe done!")
 
 def on_data2(wsapp, message):
@@ -680,17 +782,67 @@ def ws2_init():
         token = symbol_to_instrument_token[stock]
         token_list[0]["tokens"] += [token]
 
+    #
+    # Load testing with a mock feed may need more tokens than the stocklist,
+    # add other equity tokens.
+    #
+    if cfg.ws_feed_url and cfg.ws_feed_tokens > len(token_list[0]["tokens"]):
+        subscribed = set(token_list[0]["tokens"])
+        for token in sorted(instrument_token_to_symbol.keys()):
+            if len(token_list[0]["tokens"]) >= cfg.ws_feed_tokens:
+                break
+            if token not in subscribed:
+                token_list[0]["tokens"] += [token]
+        PYPWarn("Subscribing to %d tokens on %s" %
+                (len(token_list[0]["tokens"]), cfg.ws_feed_url))
+
+    #
+    # Split the tokens over cfg.feed_partitions connections, the same way
+    # CandleGenerator splits them over its workers.
+    #
+    global token_lists
+    token_lists = [[{"exchangeType": 1, "tokens": []}] for _ in range(cfg.feed_partitions)]
+    for token in token_list[0]["tokens"]:
+        token_lists[token_partition(token, cfg.feed_partitions)][0]["tokens"] += [token]
+
     global ss2
+    global ws2_conns
     # login() must have been called.
     ASSERT(clientCode is not None)
     ASSERT(feedToken is not None)
-    ss2 = SmartWebSocketV2(authToken, api_key, clientCode, feedToken)
 
-    # Assign the callbacks.
-    ss2.on_open = on_open2
-    ss2.on_data = on_data2
-    ss2.on_error = on_error2
-    ss2.on_close = on_close2
+    if cfg.ws_record:
+        global recorder
+        recorder = FrameLog.FrameRecorder(cfg.ws_record_dir)
+
+    ws2_conns = []
+    for partition in range(cfg.feed_partitions):
+        #
+        # In lean mode only the tick fields needed by CandleGenerator are
+        # decoded, which saves websocket thread CPU at high tick rates.
+        #
+        conn = SmartWebSocketV2(authToken, api_key, clientCode, feedToken,
+                                lean=cfg.lean_ticks)
+        PYPInfo("Created SmartWebSocketV2 %d with %d tokens (lean=%s)" %
+                (partition, len(token_lists[partition][0]["tokens"]), cfg.lean_ticks))
+
+        if cfg.ws_feed_url:
+            conn.ROOT_URI = cfg.ws_feed_url
+            PYPWarn("Using websocket feed %s instead of the broker's" % cfg.ws_feed_url)
+
+        # Assign the callbacks.
+        conn.on_open = functools.partial(on_open2, partition=partition)
+        conn.on_data = on_data2
+        conn.on_error = on_error2
+        conn.on_close = on_close2
+
+        # FrameRecorder takes a lock, frames of all connections go to one file.
+        if recorder is not None:
+            conn.on_raw_data = recorder.record
+
+        ws2_conns.append(conn)
+
+    ss2 = ws2_conns[0]
 
     #
     # We will not start getting ticks as yet.
@@ -698,6 +850,18 @@ def ws2_init():
     # websocket. See start_websocket().
     #
 
+def ws2_replay_init():
+    ''' Replay frames from cfg.replay_file instead of the websocket.
+        The frames are parsed by a SmartWebSocketV2 instance which is never
+        connected, so that they are parsed exactly like the live feed.
+    '''
+    ASSERT(cfg.replay_file is not None)
+    parser = SmartWebSocketV2("replay", "replay", "replay", "replay",
+                              lean=cfg.lean_ticks)
+
+    global replayer
+    replayer = FrameLog.FrameReplayer(cfg.replay_file, cfg.replay_speed, parser)
+
 def get_historical():
     global obj
     # Sample code for calling historic api.
@@ -725,7 +889,28 @@ def init():
 
     _refresh_instruments()
     _populate_symbol_to_instrument_token_map()
-    login()
+
+    #
+    # Replaying recorded frames doesn't need the broker, don't login.
+    #
+    if cfg.replay_file is not None:
+        ws2_replay_init()
+        initialized = True
+        PYPPass("AngelOne init done (replaying %s)!" % cfg.replay_file)
+        return
+
+    #
+    # Load test with broker/replay.py against a mock feed, the mock feed
+    # doesn't authenticate, so don't login.
+    #
+    if cfg.replay_outdir is not None and cfg.ws_feed_url:
+        global authToken, api_key, clientCode, feedToken
+        authToken = api_key = clientCode = feedToken = "mock"
+    else:
+        # Mock broker has no feed.
+        ASSERT(cfg.broker['selection'] != "mock" or cfg.ws_feed_url,
+               "broker selection mock needs ws_feed_url, f.e., broker/mockfeed.py")
+        login()
 
     # Initialise websocket2 for getting feed data for subscribed stocks.
     ws2_init()
@@ -763,8 +948,30 @@ def start_websocket(cb):
     # stop_websocket_called must be False before starting the websocket.
     ASSERT(stop_websocket_called == False)
 
+    #
+    # Replay returns once all frames are replayed (or stop_websocket() is
+    # called), unlike the websocket it's ok to come out on its own.
+    #
+    if replayer is not None:
+        replayer.run(tick_cb)
+        websocket_running = False
+        PYPWarn("Replay done")
+        return
+
+    #
+    # Every other connection runs in its own thread, the first one in ours.
+    #
+    conn_threads = []
+    for conn in ws2_conns[1:]:
+        thread = threading.Thread(target=conn.connect, args=(), daemon=False)
+        thread.start()
+        conn_threads.append(thread)
+
     ss2.connect()
 
+    for thread in conn_threads:
+        thread.join()
+
     # It comes out when stop_websocket() calls close_connection().
     ASSERT(websocket_running)
     websocket_running = False
@@ -781,18 +988,29 @@ def start_websocket(cb):
 def stop_websocket():
     ''' Call this function to close websocket created by start_websocket().
     '''
+    global stop_websocket_called
+
+    # Replay may have already finished, nothing to close.
+    if replayer is not None:
+        stop_websocket_called = True
+        replayer.stop()
+        return
+
     # Must be called only once, when websocket is connected.
     ASSERT(websocket_running)
 
-    global stop_websocket_called
     ASSERT(stop_websocket_called == False)
 
     stop_websocket_called = True
 
     PYPInfo("Before close_connection")
-    ss2.close_connection()
+    for conn in ws2_conns:
+        conn.close_connection()
     PYPInfo("After close_connection")
 
+    if recorder is not None:
+        recorder.close()
+
     #
     # XXX This has been seen to come here after ss2.connect() returns in
     #     start_websocket(). I've added the ASSERT to know if/when it
@@ -802,6 +1020,137 @@ def stop_websocket():
     time.sleep(1)
     ASSERT(websocket_running == False)
 
+class OrderUpdateWebSocket(SmartWebSocketOrderUpdate):
+    ''' SmartWebSocketOrderUpdate, with logs going to our log instead of
+        logs/{date}/app.log (relative to cwd), and reconnects left to
+        order_updates_runner() which, unlike retry_connect(), doesn't give up
+        after 2 attempts.
+        Details @ https://smartapi.angelbroking.com/docs/WebSocketOrderStatus
+    '''
+    def __init__(self, auth_token, api_key, client_code, feed_token):
+        self.auth_token = auth_token
+        self.api_key = api_key
+        self.client_code = client_code
+        self.feed_token = feed_token
+        self.connected = False
+
+    def on_message(self, wsapp, message):
+        # Heartbeat response.
+        if message == "pong":
+            return
+
+        try:
+            update = json.loads(message)
+        except Exception as e:
+            PYPWarn("order-update: Bad message (%s): %s" % (e, message))
+            return
+
+        #
+        # The first message after connecting has order-status AB00 and no
+        # order, all others carry the updated order in orderData, in the
+        # same form as orders in the orderbook.
+        #
+        if update.get("order-status") == "AB00":
+            PYPInfo("order-update: Connected: %s" % message)
+            order_update_cb(None)
+            return
+
+        order = update.get("orderData")
+        if not order or not order.get("orderid"):
+            PYPWarn("order-update: Ignoring message: %s" % message)
+            return
+
+        order_update_cb(order)
+
+    def on_open(self, wsapp):
+        PYPInfo("order-update: on_open")
+        # stop_order_updates() may have been called while we were connecting.
+        if stop_order_updates_called:
+            wsapp.close()
+            return
+        self.connected = True
+
+    def on_error(self, wsapp, error):
+        PYPError("order-update: on_error: %s" % error)
+
+    def on_close(self, wsapp, close_status_code, close_msg):
+        PYPWarn("order-update: on_close: %s %s" % (close_status_code, close_msg))
+        self.connected = False
+
+    def on_ping(self, wsapp, data):
+        pass
+
+    def on_pong(self, wsapp, data):
+        pass
+
+    def retry_connect(self):
+        # order_updates_runner() reconnects.
+        pass
+
+def order_updates_runner():
+    ''' Thread running the order update websocket, reconnecting till
+        stop_order_updates() is called.
+    '''
+    while not stop_order_updates_called:
+        PYPInfo("order-update: Connecting to %s" % ws_order_update.WEBSOCKET_URI)
+        # Returns when the connection closes.
+        ws_order_update.connect()
+        ws_order_update.connected = False
+        if stop_order_updates_called:
+            break
+        PYPWarn("order-update: Disconnected, reconnecting in %ds" %
+                ORDER_UPDATE_RETRY_SECS)
+        time.sleep(ORDER_UPDATE_RETRY_SECS)
+    PYPInfo("order-update: Exiting")
+
+def start_order_updates(cb):
+    ''' Start getting order updates over the order update websocket.
+        cb is called (from the websocket thread) with the updated order every
+        time an order changes, and with None on every (re)connect as updates
+        may have been missed while disconnected.
+    '''
+    # Must be called only after broker is initialized.
+    ASSERT(is_initialized())
+    ASSERT(callable(cb))
+
+    global order_update_cb
+    global ws_order_update
+    global order_update_thread
+
+    # MUST be called only once.
+    ASSERT(order_update_thread is None)
+
+    order_update_cb = cb
+    ws_order_update = OrderUpdateWebSocket(authToken, api_key, clientCode, feedToken)
+    order_update_thread = threading.Thread(target=order_updates_runner, args=(), daemon=False)
+    order_update_thread.start()
+
+def stop_order_updates():
+    ''' Close the order update websocket started by start_order_updates().
+    '''
+    global stop_order_updates_called
+
+    ASSERT(order_update_thread is not None)
+    ASSERT(stop_order_updates_called == False)
+    stop_order_updates_called = True
+
+    ws_order_update.close_connection()
+    order_update_thread.join()
+
+def order_updates_connected():
+    ''' Are we connected to the order update websocket?
+    '''
+    return ws_order_update is not None and ws_order_update.connected
+
+def warmup():
+    ''' Make a cheap authenticated API call, so that the connection to the
+        broker's REST server is up when the next order is placed.
+    '''
+    # Must be called only after broker is initialized.
+    ASSERT(is_initialized())
+
+    _SAFEAPI(obj.getProfile, refreshToken)
+
 def get_profile():
     ''' Return a json object containing user profile details.
     '''
@@ -1087,7 +1436,8 @@ def get_positions():
 def place_order(order_json):
     global obj
 
-    PYPInfo("[AngelOne] place_order: %s" % json.dumps(order_json, indent=4))
+    # Order is on the critical path, don't pretty print.
+    PYPInfo("[AngelOne] place_order: %s" % json.dumps(order_json))
 
     # Must be called only after broker is initialized.
     ASSERT(is_initialized())
@@ -1227,7 +1577,7 @@ def place_order(order_json):
             "quantity": order_json["quantity"]
         }
 
-        PYPPass("[AngelOne] Placing order %s" % (json.dumps(orderparams, indent=4)))
+        PYPPass("[AngelOne] Placing order %s" % (json.dumps(orderparams)))
 
         orderResponse = _SAFEAPI(obj.placeOrderFullResponse, orderparams)
         if orderResponse is not None:
@@ -1369,6 +1719,7 @@ def get_order_book():
     #     ]
     # }
     #
+    orderBook = OrderbookSnapshot(orderBook)
     lastKnownOrderbook = orderBook
     return orderBook
 
@@ -1790,6 +2141,97 @@ def is_gtt_rule(json):
 
     return is_gtt
 
+class OrderbookSnapshot(dict):
+    ''' Orderbook returned by get_order_book(), along with indices of its
+        orders by orderid, parentorderid, uniqueorderid and tradingsymbol.
+
+        The ROBO helpers below are called for every ROBO order in the
+        orderbook by move_to_correct_orders_dir() and each of them used to
+        scan orderbook['data'], making every refresh quadratic in the day's
+        order count. They now look up the orders in these indices.
+
+        It's a dict with the same content as the orderbook, so it can be used
+        (and json dumped) exactly like the orderbook. The indices are built
+        once, when get_order_book() gets a fresh orderbook. Orders must only
+        be added or replaced through apply(), which keeps the indices
+        updated.
+
+        Note: Like the linear scans, the orderid and uniqueorderid indices
+              map to the first order with that id.
+    '''
+    def __init__(self, orderbook):
+        super().__init__(orderbook)
+
+        # orderid -> order.
+        self.by_orderid = {}
+        # uniqueorderid -> order.
+        self.by_uniqueorderid = {}
+        # parentorderid -> list of sub-orders (ROBO target and stoploss).
+        self.by_parentorderid = {}
+        # tradingsymbol -> list of orders.
+        self.by_symbol = {}
+        # orderid -> index of the order in self['data'].
+        self.position = {}
+
+        orders = self['data']
+        if orders is not None:
+            for i, order in enumerate(orders):
+                self.index_order(i, order)
+
+    def index_order(self, i, order):
+        if order['orderid'] not in self.by_orderid:
+            self.by_orderid[order['orderid']] = order
+            self.position[order['orderid']] = i
+        self.by_uniqueorderid.setdefault(order['uniqueorderid'], order)
+        if order['parentorderid'] != "":
+            self.by_parentorderid.setdefault(order['parentorderid'], []).append(order)
+        self.by_symbol.setdefault(order['tradingsymbol'], []).append(order)
+
+    def unindex_order(self, order):
+        if self.by_uniqueorderid.get(order['uniqueorderid']) is order:
+            del self.by_uniqueorderid[order['uniqueorderid']]
+        if order['parentorderid'] != "":
+            self.by_parentorderid[order['parentorderid']].remove(order)
+        self.by_symbol[order['tradingsymbol']].remove(order)
+
+    def apply(self, order):
+        ''' Add order to the orderbook, replacing the existing order with the
+            same orderid, if any. Used to apply order updates.
+        '''
+        if self['data'] is None:
+            self['data'] = []
+        orders = self['data']
+
+        i = self.position.get(order['orderid'])
+        if i is not None:
+            old_order = orders[i]
+            self.unindex_order(old_order)
+            del self.by_orderid[old_order['orderid']]
+            orders[i] = order
+        else:
+            i = len(orders)
+            orders.append(order)
+        self.index_order(i, order)
+
+    def get_order(self, orderid):
+        return self.by_orderid.get(orderid)
+
+    def get_order_by_uniqueorderid(self, uniqueorderid):
+        return self.by_uniqueorderid.get(uniqueorderid)
+
+    def get_suborders(self, parentorderid):
+        return self.by_parentorderid.get(parentorderid, [])
+
+    def get_orders_for_symbol(self, symbol):
+        return self.by_symbol.get(symbol, [])
+
+def orderbook_snapshot(orderbook):
+    ''' OrderbookSnapshot for orderbook, which may already be one.
+    '''
+    if isinstance(orderbook, OrderbookSnapshot):
+        return orderbook
+    return OrderbookSnapshot(orderbook)
+
 def get_stoploss_suborder_for_robo(parentorderid, orderbook):
     ''' For every ROBO order (bracket order) AngelOne creates two additonal
         sub-orders one for exiting with the target/profit and another for exiting
@@ -1922,16 +2364,16 @@ def get_stoploss_suborder_for_robo(parentorderid, orderbook):
             "uniqueorderid": "49261896-2322-4977-9862-168a10ed6621"
         }
     '''
+    orderbook = orderbook_snapshot(orderbook)
     main_order = get_main_order_for_robo(parentorderid, orderbook)
     ASSERT(main_order is not None)
 
-    for order in orderbook['data']:
+    for order in orderbook.get_suborders(parentorderid):
         ASSERT((order['transactiontype'] == "BUY") or
                (order['transactiontype'] == "SELL"))
 
         # MUST condition.
-        if order['parentorderid'] != parentorderid:
-            continue
+        ASSERT(order['parentorderid'] == parentorderid)
 
         # parentorderid is used only to identify ROBO sub-orders.
         ASSERT((order['variety'] == "ROBO") and (order['producttype'] == "BO"))
@@ -1977,16 +2419,16 @@ def get_target_suborder_for_robo(parentorderid, orderbook):
     ''' Given the parentorderid this function returns the target order.
         See get_stoploss_suborder_for_robo() for details.
     '''
+    orderbook = orderbook_snapshot(orderbook)
     main_order = get_main_order_for_robo(parentorderid, orderbook)
     ASSERT(main_order is not None)
 
-    for order in orderbook['data']:
+    for order in orderbook.get_suborders(parentorderid):
         ASSERT((order['transactiontype'] == "BUY") or
                (order['transactiontype'] == "SELL"))
 
         # MUST condition.
-        if order['parentorderid'] != parentorderid:
-            continue
+        ASSERT(order['parentorderid'] == parentorderid)
 
         # parentorderid is used only to identify ROBO sub-orders.
         ASSERT((order['variety'] == "ROBO") and (order['producttype'] == "BO"))
@@ -2022,14 +2464,14 @@ def get_main_order_for_robo(parentorderid, orderbook):
     ''' Given the parentorderid this function returns the main ROBO order.
         See get_stoploss_suborder_for_robo() for details.
     '''
-    for order in orderbook['data']:
-        if ((order['variety'] == "ROBO") and
-            (order['ordertype'] == 'LIMIT') and
-            (order['producttype'] == "BO") and
-            (order['orderid'] == parentorderid)):
-            # Main order MUST have parentorderid as "".
-            ASSERT(order['parentorderid'] == "")
-            return order
+    order = orderbook_snapshot(orderbook).get_order(parentorderid)
+    if ((order is not None) and
+        (order['variety'] == "ROBO") and
+        (order['ordertype'] == 'LIMIT') and
+        (order['producttype'] == "BO")):
+        # Main order MUST have parentorderid as "".
+        ASSERT(order['parentorderid'] == "")
+        return order
     return None
 
 def is_fully_completed_robo_order(broker_orderid, orderbook):
@@ -2037,6 +2479,7 @@ def is_fully_completed_robo_order(broker_orderid, orderbook):
         A fully completed ROBO order is one which has both entered and exited
         (target or stop-loss) the trade.
     '''
+    orderbook = orderbook_snapshot(orderbook)
     main_order = get_main_order_for_robo(broker_orderid, orderbook)
     if main_order is None:
         PYPError("No ROBO order with broker_orderid %s" % (broker_orderid))
@@ -2100,6 +2543,7 @@ def is_partially_completed_robo_order(broker_orderid, orderbook):
         A partially completed ROBO order is one which has completed the main
         order but the sub-orders (target and stop-loss) are still open.
     '''
+    orderbook = orderbook_snapshot(orderbook)
     main_order = get_main_order_for_robo(broker_orderid, orderbook)
     if main_order is None:
         PYPError("No ROBO order with broker_orderid %s" % (broker_orderid))
@@ -2177,6 +2621,8 @@ def squareoff_robo_order(broker_orderid, orderbook):
     ASSERT(orderbook['status'] == True)
     ASSERT(len(orderbook['data']) >= 1)
 
+    orderbook = orderbook_snapshot(orderbook)
+
     #
     # Find the main ROBO order. We trust the caller that they will call us for
     # valid ROBO orders, hence we MUST see the main ROBO order in the orderbook,
@@ -2208,6 +2654,10 @@ def squareoff_robo_order(broker_orderid, orderbook):
         cancel_order_resp = cancel_order(broker_orderid, "ROBO")
         PYPInfo("Cancel not-yet-complete ROBO order response: %s" %
                 json.dumps(cancel_order_resp, indent=4))
+        if cancel_order_resp is None:
+            PYPError("Cancel not-yet-complete ROBO order %s failed!" % broker_orderid)
+            # cancelled, squaredoff
+            return False, False
         # cancelled, squaredoff
         return True, False
 
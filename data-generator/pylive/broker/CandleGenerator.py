@@ -1,17 +1,24 @@
-import os, sys, csv
+import os, sys, csv, setproctitle
 from pathlib import Path
 import subprocess
 import json
-import queue
 import time
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 
 import threading
+import multiprocessing
+from collections import deque
 import pandas as pd
 import config as cfg
 from helpers import *
-
-if cfg.broker['selection'] == "angelone":
+import LTPTable
+import LatestPublisher
+import LiveWriter
+import TickMetrics
+import TickRing
+
+# mock is AngelOne talking to broker/mockbroker.py, see config.py.
+if cfg.broker['selection'] in ("angelone", "mock"):
     import AngelOne as broker
 else:
     # Till we support other brokers.
@@ -19,30 +26,50 @@ else:
 
 cg = None
 
-# Total ticks received over websocket.
-ticks_received = 0
-
 #
-# Ticks for prev minute (or older) received.
-# This should only come at the starting minute and never afterwards.
+# Workers poll their queue every NO_TICK_POLL_SECS and pylive is restarted if
+# no worker got any tick for NO_TICK_RESTART_SECS during market hours, see
+# CandleWorker.dequeue().
 #
-stale_ticks_received = 0
+NO_TICK_POLL_SECS = 10
+NO_TICK_RESTART_SECS = 30
 
 exit_now = False
 ws_thread = None
-dequeue_thread = None
+
+#
+# With cfg.tick_ring set, the websocket runs in this process (see ingest())
+# and ws_thread just waits for it to exit. ingest_stop asks it to stop.
+#
+ingest_process = None
+ingest_stop = None
 historical_thread = None
 
 # Time when pylive started.
 start_time = None
 
 #
-# LTP details (one per symbol) are placed in this directory and updated as we
-# get new ticks.
+# LTP details (one record per symbol) are placed in the memory mapped LTP
+# table in this directory and updated as we get new ticks.
 #
 ltp_dir = os.path.join(cfg.srcdir, "pylive/orders/ltp")
 ASSERT(os.path.exists(ltp_dir))
 
+# LTPTable.LTPTableWriter, created by init().
+ltp_table = None
+
+#
+# LatestPublisher.LatestPublisher, created by init() if cfg.publish_latest is
+# set, else None.
+#
+publisher = None
+
+#
+# TickMetrics.TickMetrics, created by init() if cfg.tick_metrics is set, else
+# None.
+#
+metrics = None
+
 #
 # Absolute minute at which CandleGenerator started.
 # We ignore candles that start on the same minute as they could be incomplete.
@@ -56,8 +83,12 @@ class Candle:
         self.symbol = broker.token_to_symbol(instrument)
         ASSERT(len(self.symbol) > 1);
 
-        # start-of-candle timestamp.
-        self.dt = None
+        #
+        # start-of-candle time in epoch seconds, rounded down to the minute.
+        # The tz-aware Timestamp (self.dt) is built from this only when needed,
+        # f.e., when the candle is dumped.
+        #
+        self.soc_epoch = None
 
         #
         # Boolean flag to indicate if this is a partial candle.
@@ -95,27 +126,21 @@ class Candle:
         self.volume_trade_for_the_day_at_soc = 0
 
         #
-        # Set and create initial LTP file which will be updated as we receive
-        # ticks for this symbol.
+        # Slot of this symbol in the LTP table, which will be updated as we
+        # receive ticks for this symbol. The record is created with 0 LTP
+        # when the first Candle for the symbol is created, later Candles for
+        # the symbol get the same slot.
         #
-        self.ltp_file = os.path.join(ltp_dir, self.symbol)
-
-        initial_ltp = {
-                "sequence_number": 0,
-                "exchange_timestamp": 0,
-                "last_traded_price": 0,
-        }
+        ASSERT(ltp_table is not None)
+        self.ltp_slot = ltp_table.add(self.symbol)
 
-        try:
-            with open(self.ltp_file, 'w') as f:
-                json.dump(initial_ltp, f, indent=4)
-                PYPPass("Created initial LTP file %s" % (self.ltp_file))
-        except Exception as e:
-            PYPError("Failed to create initial LTP file %s" % (self.ltp_file))
-            # Treat this as fatal as engine needs LTP for correctly placing
-            # orders.
-            ASSERT(False)
-        ASSERT(os.path.exists(self.ltp_file))
+    @property
+    def dt(self):
+        ''' start-of-candle timestamp, None if we haven't got any tick yet.
+        '''
+        if self.soc_epoch is None:
+            return None
+        return epoch_to_ist(self.soc_epoch)
 
     def on_tick(self, tick):
         ''' Update candle with the newly received tick.
@@ -141,14 +166,23 @@ class Candle:
             }
 
         '''
-
+        ltp = tick["last_traded_price"]
+        self.on_ticks(tick, tick, ltp, ltp)
+
+    def on_ticks(self, first_tick, last_tick, high, low):
+        ''' Update candle with a batch of ticks received for this instrument
+            in the same minute. Only the first and the last tick of the batch
+            and the highest and lowest traded price (in paise) over all ticks
+            of the batch are needed, the result is the same as calling
+            on_tick() for every tick in the batch.
+        '''
         if cfg.verbose:
-            PYPInfo("Candle::on_tick(%s)" % broker.token_to_symbol(tick["token"]))
-        ASSERT(tick["token"] == self.instrument,
-               "%s != %s" % (tick["token"], self.instrument))
+            PYPInfo("Candle::on_ticks(%s)", self.symbol)
+        ASSERT(last_tick["token"] == self.instrument,
+               "%s != %s" % (last_tick["token"], self.instrument))
 
         # tick_timestamp is in milliseconds.
-        tick_timestamp = tick["exchange_timestamp"]
+        tick_timestamp = first_tick["exchange_timestamp"]
         tick_timestamp //= 1000
 
         #
@@ -156,11 +190,11 @@ class Candle:
         #
         ASSERT(tick_timestamp > 1672511400, "tick_timestamp=%d" % tick_timestamp)
 
-        # Price traded in the last tick.
-        ltp = tick["last_traded_price"]
+        # Price traded in the first tick.
+        ltp = first_tick["last_traded_price"]
 
-        # Cumulative daily volume till now.
-        volume_trade_for_the_day = tick["volume_trade_for_the_day"]
+        # Cumulative daily volume till the first tick.
+        volume_trade_for_the_day = first_tick["volume_trade_for_the_day"]
 
         #
         # First tick of the candle.
@@ -168,7 +202,7 @@ class Candle:
         # a new Candle, so at the start of every minute we will get the first
         # tick of the candle.
         #
-        if self.dt is None:
+        if self.soc_epoch is None:
             # Nothing should be set yet.
             ASSERT(self.o is None)
             ASSERT(self.h is None)
@@ -176,24 +210,12 @@ class Candle:
             ASSERT(self.c is None)
             ASSERT(self.v is None)
 
-            # Starting time.
-            self.dt = pd.to_datetime(tick_timestamp, unit='s').tz_localize('UTC').tz_convert('Asia/Kolkata')
-
-            #
-            # If this tick was formed in the same minute that we started
-            # collecting live data we are not sure if we have seen all the
-            # ticks for the minute, play safe, mark it partial and don't dump
-            # it.
-            #
-            tick_minute = (self.dt.hour * 60) + self.dt.minute
-
             #
             # Now we wait for start of minute so don't have to check for partial
             # candles. Infact if we check we may end up marking the first
             # candle as always partial even though it may start on the 0th
             # second.
             #
-            #self.partial = (tick_minute <= start_minute)
             self.partial = False
 
             #
@@ -207,9 +229,10 @@ class Candle:
             #       get ticks necessarily at the 0th second, so we leave a
             #       margin of 2 seconds to avoid noise.
             #
-            if self.dt.second >= 2:
-                PYPWarn("[%s] First tick of the minute not received till 2 seconds: %s" %
-                        (broker.token_to_symbol(tick["token"]), self.dt))
+            if (tick_timestamp % 60) >= 2:
+                PYPWarnRateLimited("late-first-tick",
+                                   "[%s] First tick of the minute not received till 2 seconds: %s",
+                                   self.symbol, LazyIST(tick_timestamp))
 
             #
             # Starting time, rounded to the starting minute. Note that we do
@@ -217,7 +240,7 @@ class Candle:
             # is required as we want to dump 1Min ticks starting clean at 0th
             # second in order to not confuse our consumers.
             #
-            self.dt = self.dt.replace(second=0)
+            self.soc_epoch = tick_timestamp - (tick_timestamp % 60)
 
             self.o = ltp
             self.h = ltp
@@ -240,42 +263,32 @@ class Candle:
                        ("%d < %d" %
                         (volume_trade_for_the_day, self.volume_trade_for_the_day_at_soc)))
 
-        self.h = max(self.h, ltp)
-        self.l = min(self.l, ltp)
+        self.h = max(self.h, high)
+        self.l = min(self.l, low)
 
         #
         # Always set self.c so that the last value set becomes the actual
         # closing price.
         #
+        ltp = last_tick["last_traded_price"]
         self.c = ltp
 
         # Cumulative daily volume.
-        self.volume_trade_for_the_day = volume_trade_for_the_day
-
-        #
-        # Now dump the tick into self.ltp_file.
-        # Note that we dump LTP on every tick so ltp_file will always contain
-        # the latest tick. self.ltp_file must have been created in the
-        # constructor so we must have it here.
-        #
-        ASSERT(os.path.exists(self.ltp_file)
-        try:
-            with open(self.ltp_file, 'w') as f:
-                json.dump(tick, f, indent=4)
-                if cfg.verbose:
-                    PYPInfo("Dumped LTP into file %s:\n%s" %
-                            (self.ltp_file, json.dumps(tick, indent=4)))
-        except Exception as e:
-            PYPError("Failed to dump LTP into file %s:\n%s" %
-                     (self.ltp_file, json.dumps(tick, indent=4)))
-            #
-            # Treat this as fatal as engine needs LTP for correctly placing
-            # orders.
-            #
-            ASSERT(False)
+        self.volume_trade_for_the_day = last_tick["volume_trade_for_the_day"]
+
+        #
+        # Now store the tick into our LTP table record.
+        # Note that we store LTP on every batch so the LTP table will always
+        # contain the latest tick. This is a single in-place store into the
+        # mmap()ed table, no syscalls.
+        #
+        ltp_table.update(self.ltp_slot, last_tick)
+        if cfg.verbose:
+            PYPInfo("Updated LTP for %s (slot %d): ltp=%d seq=%d",
+                    self.symbol, self.ltp_slot, ltp, last_tick["sequence_number"])
 
     def asrow(self):
-        ASSERT(self.dt is not None)
+        ASSERT(self.soc_epoch is not None)
         ASSERT(self.o is not None)
         ASSERT(self.h is not None)
         ASSERT(self.l is not None)
@@ -292,8 +305,10 @@ class Candle:
 class Instrument:
     ''' This class holds tick info for one token.
     '''
-    def __init__(self, token):
+    def __init__(self, token, live_writer):
         self.token = token
+        # LiveWriter of the CandleWorker this token belongs to.
+        self.live_writer = live_writer
         # Total ticks received for this token.
         self.ticks_received = 0
         self._1Min_ticks_dumped = 0
@@ -319,14 +334,75 @@ class Instrument:
                                      self.symbol,
                                      "%s.live.csv" % self.symbol)
 
+        #
+        # Set of absolute IST minutes (see epoch_to_ist_minute()) of the
+        # candles present in self.csv_file, used for not adding duplicate rows
+        # to $stock.live.csv, see [AVOID_DUP_HIST_AND_LIVE].
+        # This is seeded from self.csv_file by seed_live_minutes() once
+        # pyhistorical has written it and then updated for every row we add.
+        # None till seeded.
+        #
+        self.live_minutes = None
+
     def on_tick(self, tick):
-        self.ticks_received += 1
+        ltp = tick["last_traded_price"]
+        self.on_ticks(tick, tick, ltp, ltp, 1)
+
+    def on_ticks(self, first_tick, last_tick, high, low, count):
+        ''' Update with a batch of count ticks received for this token in the
+            same minute, see Candle::on_ticks().
+        '''
+        self.ticks_received += count
         if cfg.verbose:
-            PYPInfo("[%s] Instrument::on_tick(%s)" %
-                            (self.ticks_received, broker.token_to_symbol(tick["token"])))
-        ASSERT(tick["token"] == self.token,
-               "%s != %s" % (tick["token"], self.token))
-        self.ongoing_candle.on_tick(tick)
+            PYPInfo("[%s] Instrument::on_ticks(%s), batch of %d",
+                    self.ticks_received, self.symbol, count)
+        ASSERT(last_tick["token"] == self.token,
+               "%s != %s" % (last_tick["token"], self.token))
+        self.ongoing_candle.on_ticks(first_tick, last_tick, high, low)
+
+        #
+        # Publisher only needs the latest values, intermediate ticks of the
+        # batch would be coalesced by it anyways.
+        #
+        if publisher is not None:
+            publisher.on_tick(self.symbol, last_tick)
+
+    # How much of $stock.live.csv tail is read by seed_live_minutes().
+    LIVE_CSV_TAIL_BYTES = 64 * 1024
+
+    def seed_live_minutes(self):
+        ''' Seed self.live_minutes from the candles in self.csv_file.
+            This must be called only after pyhistorical has written
+            self.csv_file and before we add any row to it.
+
+            Only the tail of the file is read, as any duplicate can only be
+            for the last few candles that pyhistorical fetched, for the
+            minutes since pylive started. LIVE_CSV_TAIL_BYTES is large enough
+            to hold all the 1Min candles of a day anyways.
+        '''
+        self.live_minutes = set()
+
+        if not os.path.exists(self.csv_file):
+            PYPWarn("*** %s not found ***" % (self.csv_file))
+            return
+
+        with open(self.csv_file, 'rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            offset = max(0, size - Instrument.LIVE_CSV_TAIL_BYTES)
+            f.seek(offset)
+            lines = f.read().decode().splitlines()
+
+        # First line may be partially read, skip it.
+        if offset > 0:
+            lines = lines[1:]
+
+        # live.csv doesn't have a header.
+        for line in lines:
+            if line:
+                self.live_minutes.add(ist_str_to_minute(line))
+
+        PYPInfo("[%s] Seeded %d live minutes from %s (%d bytes read)",
+                self.symbol, len(self.live_minutes), self.csv_file, size - offset)
 
     def dump(self, historical_data_refreshed):
         ''' Returns True if it has dumped ticks in self.csv_file, else returns False.
@@ -341,11 +417,12 @@ class Instrument:
         #    least one stock (need not be the same as the prev one).
         #    There could be some stocks for which no ticks are received.
         #
-        if (self.ongoing_candle.dt is None):
+        if (self.ongoing_candle.soc_epoch is None):
                 return False
 
-        PYPDebug("[%s] dt = %s" %
-                (broker.token_to_symbol(self.token), self.ongoing_candle.dt))
+        if cfg.verbose:
+            PYPDebug("[%s] dt = %s" %
+                    (broker.token_to_symbol(self.token), self.ongoing_candle.dt))
 
         ASSERT(self.ongoing_candle.partial is not None)
         if self.ongoing_candle.partial:
@@ -380,76 +457,46 @@ class Instrument:
         #
         dumped = False
 
-        if (len(self.pending_rows) > 0) and historical_data_refreshed:
-            #
-            # Read the live.csv file and skip already present rows.
-            #
-            dtypes = {
-                'Open': np.float64,
-                'High': np.float64,
-                'Low': np.float64,
-                'Close': np.float64,
-                'Volume': np.int64
-            }
-
-            # Columns are in the following order.
-            columns = ['Open', 'High', 'Low', 'Close', 'Volume']
-
-            live_df = None
-            if os.path.exists(self.csv_file):
-                stat_buf = os.stat(self.csv_file)
-                if stat_buf.st_size > 0:
-                    # live.csv doesn't have a header.
-                    live_df = pd.read_csv(
-                            self.csv_file,
-                            engine="pyarrow",
-                            names=columns,
-                            index_col=0,
-                            parse_dates=True,
-                            dtype=dtypes,
-                            header=None)
-                    #
-                    # pd.read_csv() always sets tz to UTC, though it correctly
-                    # takes into account the time offset mentioned, so we just
-                    # need to convert it to India timezone.
-                    #
-                    assert(live_df.index[0].tz == pytz.UTC)
-                    live_df.index = live_df.index.tz_convert("Asia/Kolkata")
-            else:
-                PYPWarn("*** %s not found ***" % (self.csv_file))
-
-            outfile = open(self.csv_file, 'a')
-            csvwriter = csv.writer(outfile)
+        #
+        # pyhistorical is done writing $stock.live.csv, note the candles it
+        # has, before we add any.
+        #
+        # PERF: Earlier we used to pd.read_csv() the entire live.csv for
+        #       every instrument, to check the pending rows against, which
+        #       stalled the tick thread for the first minute after
+        #       pyhistorical completed. Now it's a set lookup per row.
+        #
+        if historical_data_refreshed and self.live_minutes is None:
+            self.seed_live_minutes()
 
+        if (len(self.pending_rows) > 0) and historical_data_refreshed:
             PYPWarn("Dumping %d pending rows to %s" %
                     (len(self.pending_rows), self.csv_file))
 
             for row in self.pending_rows:
+                # row[0] is the start-of-candle Timestamp.
+                row_minute = epoch_to_ist_minute(int(row[0].timestamp()))
+
                 # Don't dump duplicate rows in live.csv.
-                if live_df is not None and (row[0] in live_df.index):
+                if row_minute in self.live_minutes:
                     PYPWarn("Skipping already present live row for (%s / %s): %s" %
                             (broker.token_to_symbol(self.token), self.token, row))
                     continue
 
                 PYPWarn("Dumping row for (%s / %s): %s" %
                         (broker.token_to_symbol(self.token), self.token, row))
-                csvwriter.writerow(row)
+                self.live_writer.write(self.csv_file, row)
+                self.live_minutes.add(row_minute)
                 dumped = True
 
             # Dump only once.
             self.pending_rows.clear()
-            outfile.close()
 
         #
-        # XXX
         # Dump ongoing_candle latest 1Min data into appropriate file.
-        # See if we can dump inline or if it's too slow and will hold the
-        # caller unnecessarily. If so we can add these to some queue and from
-        # there some other process can dump it.
-        # We will have to see how many ticks can be queued by the websocket
-        # before it starts dropping them. All the ticks queued while we are
-        # holding the websocket callback, will be passed once the websocket
-        # callback returns.
+        # The row is only queued to live_writer here, it's written along with
+        # the rows of all other instruments when dump_all_instruments() commits
+        # them, see LiveWriter.py.
         #
         if ((not self.ongoing_candle.partial) and
             (self.ongoing_candle.volume_trade_for_the_day_at_soc != 0)):
@@ -460,25 +507,21 @@ class Instrument:
                 ASSERT(self.ongoing_candle.v >= 0)
 
                 row = self.ongoing_candle.asrow()
+
+                if publisher is not None:
+                    publisher.on_candle(self.symbol, self.ongoing_candle.c / 100)
                 #
-                # XXX Do this from a thread to reduce block time for the
-                #     websocket handler.
-                #     If we do this, we need to make sure finalize_live_data()
-                #     runs only after this thread and all such threads
-                #     complete. That may be hard!!
+                # Note: With cfg.live_writer_async the row is written by the
+                #       LiveWriter thread which also runs finalize_live_data()
+                #       once all the rows for the minute are written.
                 #
                 if historical_data_refreshed:
-                    # Get a csv writer handle on the live.csv file.
-                    outfile = open(self.csv_file, 'a')
-                    csvwriter = csv.writer(outfile)
-
                     PYPPass("Dumping new row for (%s / %s): %s, to %s" %
                             (broker.token_to_symbol(self.token), self.token,
                              row, self.csv_file))
 
-                    csvwriter.writerow(row)
-                    #outfile.flush()
-                    outfile.close()
+                    self.live_writer.write(self.csv_file, row)
+                    self.live_minutes.add(epoch_to_ist_minute(self.ongoing_candle.soc_epoch))
                     dumped = True
                 else:
                     self.pending_rows += [row]
@@ -498,16 +541,56 @@ class Instrument:
         self.ongoing_candle.volume_trade_for_the_day_at_soc = volume_trade_for_the_day
         return dumped
 
-class CandleGenerator:
-    instantiated = False
+class TickQueue:
+    ''' Unbounded tick queue between the websocket on_data() callback
+        (producer) and the dequeue thread (consumer).
+        Unlike queue.Queue which hands out one tick per get() (taking the lock
+        and possibly sleeping for every tick), the consumer takes all the
+        queued ticks in one go by swapping the deque under the lock, so when
+        ticks build up (f.e. while we are dumping candles at the start of a
+        new minute) they are drained as one batch.
+    '''
     def __init__(self):
-
-        # Enforce singleton.
-        ASSERT(not CandleGenerator.instantiated)
-        CandleGenerator.instantiated = True
+        self.ticks = deque()
+        self.cond = threading.Condition(threading.Lock())
+
+    def put(self, tick):
+        with self.cond:
+            self.ticks.append(tick)
+            # Only the first tick needs to wake up the consumer.
+            if len(self.ticks) == 1:
+                self.cond.notify()
+
+    def qsize(self):
+        return len(self.ticks)
+
+    def get_all(self, timeout):
+        ''' Returns a deque with all the queued ticks, in the order they were
+            queued. Blocks till at least one tick is queued or till timeout
+            seconds, in which case an empty deque is returned.
+        '''
+        with self.cond:
+            if not self.ticks:
+                self.cond.wait(timeout)
+            ticks = self.ticks
+            self.ticks = deque()
+        return ticks
+
+class CandleWorker:
+    ''' Candle builder for one partition of the subscribed tokens (see
+        token_partition()), with its own tick queue, dequeue thread,
+        Instruments and LiveWriter for their $stock.live.csv files.
+        With cfg.feed_partitions == 1 (the default) there's just one, which
+        gets all the ticks.
+        Every worker detects the minute boundary from its own ticks and dumps
+        its own instruments, CandleGenerator.on_worker_committed() finalizes
+        the minute once all workers have committed it.
+    '''
+    def __init__(self, index):
+        self.index = index
 
         #
-        # CandleGenerator tracks ongoing candles for each instrument for which
+        # CandleWorker tracks ongoing candles for each instrument for which
         # we are getting ticks. self.instruments has one entry for each
         # instrument, keyed by the instrument token. Note that token is
         # specific to the Broker unlike symbol name which is fixed.
@@ -518,78 +601,90 @@ class CandleGenerator:
         # How many times dump_all_instruments() was called.
         self.dump_count = 0
 
-        # How many times finalize_live_data() was called.
+        # How many times dump_all_instruments() committed the dumped candles.
         self.finalize_count = 0
 
         #
-        # Since we can start at any time of the day we need to fetch the 1Min
-        # candles till the last 1Min candle. We do this using historical APIs
-        # and save those to $stock.live.csv for each stock in cfg.stocklist.
-        # Once this is done the live candle generator then starts adding live
-        # ticks beyond that.
-        # Till this is set the live ticks should not be dumped to
-        # $stock.live.csv but kept in memory and later dumped once this is
-        # True.
+        # Tick path stats, reported by broker/replay.py.
+        # Number of batches dequeued, the largest batch and the time (in
+        # seconds) taken by every dump_all_instruments() call.
         #
-        self.historical_data_refreshed = False
+        self.batches = 0
+        self.max_batch = 0
+        self.dump_latencies = []
+
+        #
+        # Ticks of this worker's tokens received over websocket, and the
+        # ones for prev minute (or older) amongst them. Stale ticks should
+        # only come at the starting minute and never afterwards.
+        # These are only updated by the dequeue thread, use
+        # get_ticks_received() and get_stale_ticks_received() for the totals.
+        #
+        self.ticks_received = 0
+        self.stale_ticks_received = 0
+
+        #
+        # Start of the minute (epoch seconds) which the last
+        # dump_all_instruments() call closed.
+        #
+        self.minute_close_epoch = None
 
         #
-        # Last tick timestamp stored as datetime. This is the timestamp of the
-        # last tick (corresponding to any token) received.
+        # Last tick timestamp stored as epoch seconds. This is the timestamp of
+        # the last tick (corresponding to any token of this worker) received.
         # Whenever we get a tick whose minute value is different from
-        # last_tick_dt, it means that this tick is the beginning of a new
+        # last_tick_epoch, it means that this tick is the beginning of a new
         # minute and we should close all the instrument candles for the
         # previous minute and dump them.
         #
-        self.last_tick_dt = None
+        # PERF: We keep this as int and not as a tz-aware Timestamp as this
+        #       is checked for every tick. Use last_tick_dt for logging.
+        #
+        self.last_tick_epoch = None
+
+        #
+        # time.monotonic() when the dequeue thread last got a batch of ticks.
+        # A partition with few tokens can go without ticks for long, so
+        # dequeue() checks for a stuck websocket using the latest of all the
+        # workers, see CandleGenerator.tick_idle_secs().
+        #
+        self.last_batch_time = time.monotonic()
+
+        # Writer for the $stock.live.csv files of this worker's instruments.
+        self.live_writer = LiveWriter.LiveWriter(cfg.live_fsync, cfg.live_writer_async)
 
         #
         # Make an infinite queue where the websocket's on_data() handler will
         # add ticks as soon as it is called. A dedicated thread will dequeue
-        # from this queue and perform the actual on_tick() handling.
+        # (all available ticks in one go) from this queue and perform the
+        # actual on_ticks() handling.
         # The reason for using a queue is to free the websocket callback
         # promptly to avoid any tick drops.
         #
-        self.q = queue.Queue(maxsize=0)
+        # With cfg.tick_ring set, the websocket runs in the ingest process and
+        # ticks come through the shared memory TickRing instead, which
+        # TickRingReader reads with the same get_all() interface.
+        #
+        if cfg.tick_ring:
+            self.ring = TickRing.TickRing(cfg.tick_ring_slots)
+            self.q = TickRing.TickRingReader(self.ring)
+        else:
+            self.ring = None
+            self.q = TickQueue()
 
         #
         # Create and start the dequeue thread for processing ticks added by
-        # the websocket on_data() callback self.enqueue().
+        # the websocket on_data() callback CandleGenerator.enqueue().
         #
-        global dequeue_thread
-        dequeue_thread = threading.Thread(target=self.dequeue, args=(), daemon=False)
-        dequeue_thread.start()
-
-    def enqueue(self, tick):
-        ''' This is the websocket on_data() callback.
-            It just adds the tick to the thread-safe queue and returns.
-            The idea is to free the websocket callback promptly in case that
-            causes tick drops.
-
-            Note: It's not confirmed yet if the ticks are being dropped by the
-                  websocket or AngelOne itself is not sending all ticks.
-                  Note that it does add extra overhead of adding the ticks to
-                  the queue and then dequeuing from the queue. This may cause
-                  more CPU usage. Need to check.
-        '''
-        self.q.put(tick)
-        PYPInfo("After enqueue (%s), self.q.qsize: %d" %
-                (broker.token_to_symbol(tick["token"]), self.q.qsize()))
-        if self.q.qsize() > 100:
-            PYPWarn("After enqueue (%s), self.q.qsize: %d" %
-                    (broker.token_to_symbol(tick["token"]), self.q.qsize()))
+        self.dequeue_thread = threading.Thread(target=self.dequeue, args=(), daemon=False)
+        self.dequeue_thread.start()
 
     def dequeue(self):
         while True:
             #
-            # Read next tick queued by Websocket on_data() callback.
+            # Read all ticks queued by Websocket on_data() callback.
             # It'll block here if the queue is empty, once the enqueue()
             # thread adds new ticks, it'll be woken up.
-            #
-            PYPInfo("Before dequeue, self.q.qsize: %d" % (self.q.qsize()))
-            if self.q.qsize() > 100:
-                PYPWarn("Before dequeue, self.q.qsize: %d" % (self.q.qsize()))
-
             #
             # I've seen problems where websocket can get stuck, it won't
             # received anything from the broker for long periods and it
@@ -599,31 +694,88 @@ class CandleGenerator:
             # Since we can come here before the market starts, we have to
             # explicitly check for that.
             #
+            # Note: With cfg.feed_partitions > 1 a partition can be quiet
+            #       while others are getting ticks, so it's stuck only if no
+            #       worker got any tick for NO_TICK_RESTART_SECS.
+            #
             while True:
-                try:
-                    tick = self.q.get(timeout=30)
+                ticks = self.q.get_all(timeout=NO_TICK_POLL_SECS)
+                if ticks:
+                    self.last_batch_time = time.monotonic()
                     break
-                except queue.Empty:
-                    if is_market_open():
-                        PYPError("Did not see any tick for 30 seconds!")
-                        PYPError("Websocket may be stuck, restarting pylive!")
-                        #
-                        # ASSERT causes non-zero exit which causes systemd to
-                        # restart.
-                        #
-                        ASSERT(False)
+                # Ingest process must run till stop() asks it to stop.
+                if ingest_process is not None and not ingest_process.is_alive() and not exit_now:
+                    PYPError("Ingest process exited with exitcode=%s, restarting pylive!" %
+                             ingest_process.exitcode)
+                    ASSERT(False)
+                # Recorded frames may have gaps, don't restart for those.
+                if (is_market_open() and cfg.replay_outdir is None and
+                    cg.tick_idle_secs() >= NO_TICK_RESTART_SECS):
+                    PYPError("Did not see any tick for %d seconds!" % NO_TICK_RESTART_SECS)
+                    PYPError("Websocket may be stuck, restarting pylive!")
+                    #
+                    # ASSERT causes non-zero exit which causes systemd to
+                    # restart.
+                    #
+                    ASSERT(False)
+
+            nticks = len(ticks)
+            self.batches += 1
+            self.max_batch = max(self.max_batch, nticks)
+            if cfg.verbose:
+                PYPDebug("dequeue[%d]: Dequeued batch of %d ticks", self.index, nticks)
+
+            #
+            # Ticks from the ring are stamped by the ingest process, enqueue()
+            # didn't see them.
+            #
+            if self.ring is not None and metrics is not None:
+                for tick in ticks:
+                    if tick is not None:
+                        metrics.exch_to_recv.record((tick["recv_time"] * 1000 - tick["exchange_timestamp"]) * 1000)
+
+            #
+            # Backlog alarm, based on how long the oldest tick of the batch
+            # waited in the queue. A large batch of ticks that all arrived
+            # together (f.e. at the minute boundary) is not a backlog, ticks
+            # waiting for long is.
+            #
+            if ticks[0] is not None:
+                queue_age_ms = (time.time() - ticks[0]["recv_time"]) * 1000
+                if queue_age_ms > cfg.queue_age_alarm_ms:
+                    PYPWarnRateLimited("queue-age",
+                                       "Tick queue backlog: oldest tick waited %.1fms, batch of %d ticks (worker %d)",
+                                       queue_age_ms, nticks, self.index)
 
+            #
             # stop() enqueues the None sentinel value for asking it to stop.
-            if tick is None:
-                PYPWarn("dequeue: exiting on receiving sentinel value!");
-                break
+            # Process the ticks queued before it and exit.
+            #
+            exiting = (ticks[-1] is None)
+            if exiting:
+                ticks.pop()
+                ASSERT(None not in ticks)
 
             #
             # Call the tick handler.
             # When dumping tick data (at the start of a new minute) this can
-            # take more time and and that's when the queue might build up.
+            # take more time and and that's when the queue might build up,
+            # which will all be handled as the next batch.
             #
-            self.on_tick(tick)
+            if ticks:
+                self.on_ticks(ticks)
+
+            if exiting:
+                PYPWarn("dequeue[%d]: exiting on receiving sentinel value!" % self.index);
+                break
+
+    @property
+    def last_tick_dt(self):
+        ''' Timestamp of the last tick, for logging.
+        '''
+        if self.last_tick_epoch is None:
+            return None
+        return epoch_to_ist(self.last_tick_epoch)
 
     def is_new_minute(self, tick_timestamp):
         ''' Check if tick_timestamp (corresponding to a newly received tick)
@@ -633,24 +785,21 @@ class CandleGenerator:
         # If this is the first tick received over websocket, we have no tick
         # data to seal, so return false.
         #
-        if self.last_tick_dt is None:
+        if self.last_tick_epoch is None:
             return False
 
-        #
-        # Timestamp received is in IST timezone so use that for correctness.
-        # Note that we don't really need to do that as all we need to find is
-        # if tick_timestamp belongs to a new minute than the last timestamp
-        # stored in last_tick_dt.
-        #
-        dt = pd.to_datetime(tick_timestamp,
-                            unit='s').tz_localize('UTC').tz_convert('Asia/Kolkata')
-
         if cfg.verbose:
-            PYPDebug("is_new_minute: dt=%s last_tick_dt=%s" % (dt, self.last_tick_dt))
+            PYPDebug("is_new_minute: dt=%s last_tick_dt=%s" %
+                     (epoch_to_ist(tick_timestamp), self.last_tick_dt))
 
-        # Absolute minute of this tick and the last tick received.
-        dt_minute = dt.hour*60 + dt.minute
-        last_tick_dt_minute = self.last_tick_dt.hour*60 + self.last_tick_dt.minute
+        #
+        # Absolute (IST) minute of this tick and the last tick received.
+        # All we need to find is if tick_timestamp belongs to a new minute
+        # than the last timestamp stored in last_tick_epoch, so integer
+        # minutes are enough.
+        #
+        dt_minute = epoch_to_ist_minute(tick_timestamp)
+        last_tick_dt_minute = epoch_to_ist_minute(self.last_tick_epoch)
 
         #
         # Ideally we should get ticks in increasing order of timestamp, i.e.,
@@ -680,15 +829,28 @@ class CandleGenerator:
         #     Restarting pylive in this case is the best option. This means
         #     any assert failure MUST cause entire program restart.
         #
+        # Note: With cfg.feed_partitions > 1 this worker's tokens may not get
+        #       any tick for a minute or more while the other workers' do, so
+        #       a forward skip is checked against the latest tick minute seen
+        #       by any worker, i.e. the feed as a whole.
+        #
         if dt_minute < last_tick_dt_minute:
             PYPWarn("Reordered tick received %s (last_tick_dt = %s)" %
-                    (dt, self.last_tick_dt))
+                    (epoch_to_ist(tick_timestamp), self.last_tick_dt))
         elif dt_minute > last_tick_dt_minute+1:
-            PYPWarn("Future tick received %s (last_tick_dt = %s)" %
-                    (dt, self.last_tick_dt))
+            feed_minute = cg.last_tick_minute()
+            if dt_minute > feed_minute+1:
+                PYPWarn("Future tick received %s (last_tick_dt = %s, feed last_tick_dt = %s)" %
+                        (epoch_to_ist(tick_timestamp), self.last_tick_dt,
+                         epoch_to_ist(feed_minute * 60)))
+                ASSERT(dt_minute <= (feed_minute+1))
+            else:
+                PYPWarnRateLimited("quiet-partition",
+                                   "Worker %d got no tick from %s till %s",
+                                   self.index, self.last_tick_dt,
+                                   epoch_to_ist(tick_timestamp))
 
         ASSERT(dt_minute >= (last_tick_dt_minute-1))
-        ASSERT(dt_minute <= (last_tick_dt_minute+1))
 
         #
         # This tick starts a new minute?
@@ -707,6 +869,8 @@ class CandleGenerator:
         #
         ASSERT(len(self.instruments) > 0)
 
+        start = time.perf_counter()
+
         #
         # Count how many times dump_all_instruments() is called.
         # Not all of these calls will result in data getting dumped to
@@ -721,7 +885,7 @@ class CandleGenerator:
                     (broker.token_to_symbol(instrument.token),
                      instrument.token,
                      dumped,
-                     self.historical_data_refreshed))
+                     cg.historical_data_refreshed))
 
             #
             # instrument.dump() will return true only if it dumps at least one
@@ -729,7 +893,7 @@ class CandleGenerator:
             # Only if at least one stock has dumped we would want to call
             # pyprocess to generate aggregate tick data.
             #
-            if instrument.dump(self.historical_data_refreshed):
+            if instrument.dump(cg.historical_data_refreshed):
                 dumped += 1
 
             #
@@ -755,19 +919,420 @@ class CandleGenerator:
         # Note: We call finalize_live_data() only if we are able to dump
         #       at least one instrument.
         #
-        if dumped > 0:
-            self.finalize_live_data()
-            #self.finalize_count += 1
-            # Touch pylive_running to indicate liveness to engine.
-            Path(cfg.pylivedir + "/pylive_running.xxx").touch()
+        # Note: Rows are actually written (and flushed, and fsynced if
+        #       cfg.live_fsync is set) by live_writer.commit() which calls
+        #       on_worker_committed() only after that, which in turn calls
+        #       finalize_live_data() once every worker has committed this
+        #       minute, so pyprocess always sees all the rows of the minute.
+        #
+        minute_close_epoch = self.minute_close_epoch
+        self.live_writer.commit(lambda: cg.on_worker_committed(self.index,
+                                                               minute_close_epoch,
+                                                               dumped))
         self.finalize_count += 1
 
+        dump_latency = time.perf_counter() - start
+        self.dump_latencies.append(dump_latency)
+        if metrics is not None:
+            metrics.dump.record(dump_latency * 1000000)
         return dumped
 
-    def finalize_live_data(self):
+    def on_tick(self, tick):
+        ''' on_tick handler for the CandleWorker class, for a single tick.
+        '''
+        self.on_ticks((tick,))
+
+    def on_ticks(self, ticks):
+        ''' on_ticks handler for the CandleWorker class.
+            Every tick of this worker's tokens must be fed to this, ticks
+            is the batch of all the ticks dequeued in one go, in the order
+            they were received.
+            Every tick is validated (market hours, stale, minute boundary) in
+            order, same as if they were handled one at a time, but the
+            accepted ticks are grouped by token and each Instrument is updated
+            only once with the first, last, highest and lowest price of its
+            ticks. A batch spanning a minute boundary is applied in two parts,
+            ticks before the first tick of the new minute are applied before
+            the candles are dumped and the rest after.
+
+            Note: Do not assert in this function and any function called from
+                  this function as that doesn't result in program to stop,
+                  but instead it causes a meaningless message from websocket
+                  claiming the callback failed.
+                  Use ASSERT().
+        '''
+        #
+        # token -> [first_tick, last_tick, high, low, count] for the ticks
+        # accepted but not yet applied to the Instrument.
+        #
+        pending = {}
+
+        start = time.time()
+
+        for tick in ticks:
+            if metrics is not None:
+                recv_time = tick.get("recv_time")
+                if recv_time is not None:
+                    metrics.queue_wait.record((start - recv_time) * 1000000)
+
+            #
+            # Log for the first 1000 ticks received to confirm things are working,
+            # or if verbose is set in config.
+            #
+            if cfg.verbose or (self.ticks_received < 1000):
+                PYPInfo("[%d] CandleWorker[%d]::on_ticks(%s)",
+                        self.ticks_received, self.index, broker.token_to_symbol(tick["token"]))
+
+            tick = broker.tick2tick(tick)
+
+            #
+            # XXX This is AngelOne specific, make it generic.
+            #
+            mode = tick["subscription_mode"]
+            ASSERT(mode == 1 or mode == 2 or mode == 3, ("mode=%d" % mode))
+
+            token = tick["token"]
+
+            # AngelOne tick timestamp is in milliseconds.
+            tick_timestamp = tick["exchange_timestamp"]
+            tick_timestamp //= 1000
+
+            #
+            # PERF: Work with integer IST minutes and not tz-aware Timestamps as
+            #       this is done for every tick. Timestamps are created only for
+            #       logging and when candles are dumped.
+            #
+            tick_minute = epoch_to_ist_minute(tick_timestamp)
+            minute_of_day = tick_minute % 1440
+
+            #
+            # Ignore ticks received outside market hours, i.e., outside
+            # [09:15, 15:30].
+            #
+            if minute_of_day < (9*60 + 15) or minute_of_day > (15*60 + 30):
+                PYPWarnRateLimited("outside-market-hours-tick",
+                                   "Tick (@ %s) generated outside market hours, ignoring: %s",
+                                   LazyIST(tick_timestamp), tick)
+                continue
+
+            if self.last_tick_epoch is None and (tick_timestamp % 60) > 2:
+                #
+                # when we start pylive on minute boundary, I see that candles for
+                # the previous minute also arrive, since websocket is not done
+                # sending all of them. Ignore those!
+                # f.e.,
+                # 2023-08-21 09:52:59+05:30
+                #
+                PYPWarnRateLimited("previous-minute-tick",
+                                   "Previous minute tick (@ %s), ignoring: %s",
+                                   LazyIST(tick_timestamp), tick)
+                continue
+
+            #
+            # Any tick received with minute less than the current minute must be
+            # considered stale and dropped, else we may mess up the tick data.
+            #
+            # XXX We need to check if stale ticks are common or does Angelone take
+            #     care of publishing ticks in strictly increasing time order, so
+            #     if we get one tick at T other ticks will only be greater than T.
+            #
+            # Update: Stale ticks are only seen in the first minute after pylive
+            #     is restarted and not seen during the run, which is good!
+            #
+
+            if self.last_tick_epoch is not None:
+                if tick_minute < epoch_to_ist_minute(self.last_tick_epoch):
+                    self.stale_ticks_received += 1
+                    #
+                    # Stale ticks come in bursts, log one error every
+                    # cfg.log_ratelimit_secs, self.stale_ticks_received has the count.
+                    #
+                    if ratelimit("stale-tick") is not None:
+                        PYPError("[%d] Stale tick (@ %s), last_tick_dt=%s, ignoring: %s",
+                                 self.stale_ticks_received, LazyIST(tick_timestamp),
+                                 self.last_tick_dt, tick)
+                    continue
+
+            # Only count ticks received in market hours.
+            self.ticks_received += 1
+
+            #
+            # First tick that starts a new minute causes current ongoing candles
+            # (for the current minute) to be sealed and dumped.
+            #
+            # XXX Hopefully anything after this tick will be later than this and
+            #     hence won't be for the previous minute. In case we get some tick
+            #     for the older minute we should ignore that with the risk that we
+            #     will lose some accuracy.
+            #
+            is_new_minute = self.is_new_minute(tick_timestamp)
+            last_tick_epoch = self.last_tick_epoch
+
+            #
+            # After we are done processing this tick, store the tick_timestamp as
+            # last_tick_epoch, signifying the timestamp of the last tick received.
+            # Whenever a tick is received whose minute value is different from
+            # last_tick_epoch that means it's time to seal all the minute candles and
+            # dump them.
+            #
+            # Sometimes I've seen that AngelOne will send older ticks later (maybe
+            # they arrive like that on websocket). This is possible since
+            # self.last_tick_epoch tracks the latest tick received for all stocks,
+            # but some stock may be getting older starting tick.
+            #
+            # Ensure last_tick_epoch should not move  backwards.
+            #
+            if self.last_tick_epoch is None:
+                self.last_tick_epoch = tick_timestamp
+            else:
+                self.last_tick_epoch = max(self.last_tick_epoch, tick_timestamp)
+
+            if is_new_minute:
+                #
+                # Ticks of this batch which belong to the minute that's ending
+                # must be added to the ongoing candles before they are dumped.
+                #
+                self.apply_ticks(pending)
+                pending = {}
+
+                #
+                # The minute being closed ends where the minute of the last
+                # tick ends. It's where this tick's minute starts, unless this
+                # worker's tokens got no tick for some minutes.
+                #
+                self.minute_close_epoch = last_tick_epoch - (last_tick_epoch % 60) + 60
+
+                PYPWarn("Got new minute tick [%s], dumping all instruments!" %
+                        epoch_to_ist(tick_timestamp))
+                #
+                # dump_all_instruments() will also call finalize_live_data() to
+                # generate live aggregate data after the latest 1Min candle data
+                # received.
+                #
+                self.dump_all_instruments()
+
+            #
+            # Accumulate the tick in this token's aggregate for the batch, the
+            # Instrument is updated once per batch (or once per minute, if the
+            # batch spans a minute boundary) in apply_ticks().
+            #
+            ltp = tick["last_traded_price"]
+            agg = pending.get(token)
+            if agg is None:
+                pending[token] = [tick, tick, ltp, ltp, 1]
+            else:
+                agg[1] = tick
+                if ltp > agg[2]:
+                    agg[2] = ltp
+                elif ltp < agg[3]:
+                    agg[3] = ltp
+                agg[4] += 1
+
+        self.apply_ticks(pending)
+
+        if metrics is not None:
+            metrics.on_tick.record((time.time() - start) * 1000000 / len(ticks), len(ticks))
+
+        #
+        # Every time we call dump_all_instruments(), at the end we must call
+        # finalize_live_data(), if not then something is wrong, shout out.
+        #
+        if self.finalize_count != self.dump_count:
+            PYPError("finalize_count (%d) != dump_count (%d)" %
+                    (self.finalize_count, self.dump_count));
+
+    def apply_ticks(self, pending):
+        ''' Apply the per-token tick aggregates collected by on_ticks() to
+            the corresponding Instruments.
+        '''
+        for token, agg in pending.items():
+            #
+            # Very first tick received for this token, create a new empty
+            # Instrument, we will populate it immediately afterwards.
+            #
+            instrument = self.instruments.get(token)
+            if instrument is None:
+                instrument = Instrument(token, self.live_writer)
+                self.instruments[token] = instrument
+
+            instrument.on_ticks(*agg)
+
+class CandleGenerator:
+    instantiated = False
+    def __init__(self):
+
+        # Enforce singleton.
+        ASSERT(not CandleGenerator.instantiated)
+        CandleGenerator.instantiated = True
+
+        #
+        # Since we can start at any time of the day we need to fetch the 1Min
+        # candles till the last 1Min candle. We do this using historical APIs
+        # and save those to $stock.live.csv for each stock in cfg.stocklist.
+        # Once this is done the live candle generator then starts adding live
+        # ticks beyond that.
+        # Till this is set the live ticks should not be dumped to
+        # $stock.live.csv but kept in memory and later dumped once this is
+        # True.
+        #
+        self.historical_data_refreshed = False
+
+        #
+        # One CandleWorker per feed partition, the ticks of a token always go
+        # to workers[token_partition(token, len(workers))], see enqueue().
+        #
+        self.workers = [CandleWorker(i) for i in range(cfg.feed_partitions)]
+
+        # token -> CandleWorker, saves hashing the token for every tick.
+        self.token_worker = {}
+
+        #
+        # Per-minute completion barrier.
+        # minute_close_epoch -> [workers committed, workers that dumped,
+        # barrier timeout Timer], for the minutes not yet committed by all
+        # the workers. See on_worker_committed().
+        #
+        self.minute_commits = {}
+        self.minute_lock = threading.Lock()
+
+        # Last minute_close_epoch passed on to on_live_data_committed().
+        self.last_committed_minute = None
+
+    def enqueue(self, tick):
+        ''' This is the websocket on_data() callback.
+            It just adds the tick to the thread-safe queue of the token's
+            worker and returns.
+            The idea is to free the websocket callback promptly in case that
+            causes tick drops.
+
+            Note: It's not confirmed yet if the ticks are being dropped by the
+                  websocket or AngelOne itself is not sending all ticks.
+                  Note that it does add extra overhead of adding the ticks to
+                  the queue and then dequeuing from the queue. This may cause
+                  more CPU usage. Need to check.
+        '''
+        #
+        # Stamp the receive time, for the queue wait and queue age.
+        #
+        recv_time = time.time()
+        tick["recv_time"] = recv_time
+
+        token = tick["token"]
+        worker = self.token_worker.get(token)
+        if worker is None:
+            worker = self.workers[token_partition(token, len(self.workers))]
+            self.token_worker[token] = worker
+        worker.q.put(tick)
+
+        if metrics is not None:
+            metrics.exch_to_recv.record((recv_time * 1000 - tick["exchange_timestamp"]) * 1000)
+
+        #
+        # PERF: This is called for every tick, so log only when verbose.
+        #       Backlog is checked by dequeue() using the queue age.
+        #
+        if cfg.verbose:
+            PYPDebug("After enqueue (%s), worker[%d].q.qsize: %d",
+                     broker.token_to_symbol(token), worker.index, worker.q.qsize())
+
+    def last_tick_minute(self):
+        ''' Latest absolute (IST) minute of the ticks received by any worker.
+            Only called after the calling worker got its first tick.
+        '''
+        return max(epoch_to_ist_minute(worker.last_tick_epoch)
+                   for worker in self.workers if worker.last_tick_epoch is not None)
+
+    def tick_idle_secs(self):
+        ''' Seconds since any worker last got a batch of ticks.
+        '''
+        return time.monotonic() - max(worker.last_batch_time for worker in self.workers)
+
+    def on_worker_committed(self, index, minute_close_epoch, dumped):
+        ''' Called by workers[index].live_writer once the candles dumped by
+            its dump_all_instruments() for the minute ending at
+            minute_close_epoch are written to the $stock.live.csv files.
+            dumped is the number of instruments dumped.
+            Once all workers have committed the minute, the minute's live data
+            is finalized, if any worker dumped anything.
+            A worker whose tokens get no tick in the new minute doesn't close
+            the old minute, so don't wait for more than
+            cfg.minute_barrier_timeout seconds for the stragglers.
+        '''
+        with self.minute_lock:
+            #
+            # Straggler committing a minute which was already finalized on
+            # timeout, its rows will be picked up by the next finalize.
+            #
+            if (self.last_committed_minute is not None and
+                minute_close_epoch <= self.last_committed_minute):
+                PYPWarn("Worker %d committed minute [%s] after it was finalized" %
+                        (index, epoch_to_ist(minute_close_epoch)))
+                return
+
+            entry = self.minute_commits.get(minute_close_epoch)
+            if entry is None:
+                entry = [0, 0, None]
+                self.minute_commits[minute_close_epoch] = entry
+                if len(self.workers) > 1:
+                    entry[2] = threading.Timer(cfg.minute_barrier_timeout,
+                                               self.on_minute_barrier_timeout,
+                                               args=(minute_close_epoch,))
+                    entry[2].daemon = True
+                    entry[2].start()
+
+            entry[0] += 1
+            if dumped > 0:
+                entry[1] += 1
+
+            if entry[0] < len(self.workers):
+                return
+
+            del self.minute_commits[minute_close_epoch]
+            if entry[2] is not None:
+                entry[2].cancel()
+            self.last_committed_minute = minute_close_epoch
+
+        if entry[1] > 0:
+            self.on_live_data_committed(minute_close_epoch)
+
+    def on_minute_barrier_timeout(self, minute_close_epoch):
+        ''' Timer callback, finalize the minute ending at minute_close_epoch
+            with whatever the workers have committed till now.
+        '''
+        with self.minute_lock:
+            entry = self.minute_commits.pop(minute_close_epoch, None)
+            if entry is None:
+                return
+            PYPWarn("Only %d of %d workers committed minute [%s] in %ss, finalizing!" %
+                    (entry[0], len(self.workers), epoch_to_ist(minute_close_epoch),
+                     cfg.minute_barrier_timeout))
+            if (self.last_committed_minute is None or
+                minute_close_epoch > self.last_committed_minute):
+                self.last_committed_minute = minute_close_epoch
+
+        if entry[1] > 0:
+            self.on_live_data_committed(minute_close_epoch)
+
+    def on_live_data_committed(self, minute_close_epoch):
+        ''' Called by on_worker_committed() once all the 1Min candles dumped
+            by the workers' dump_all_instruments() are written to the
+            $stock.live.csv files.
+            This runs in the LiveWriter thread if cfg.live_writer_async is set.
+        '''
+        # Replayed candles are not for the engine.
+        if cfg.replay_outdir is not None:
+            return
+
+        self.finalize_live_data(minute_close_epoch)
+        # Touch pylive_running to indicate liveness to engine.
+        Path(cfg.pylivedir + "/pylive_running.xxx").touch()
+
+    def finalize_live_data(self, minute_close_epoch=None):
         ''' Run pyprocess to finalize prelive+live data to get intraday aggregate data
             till the last tick.
             This will create/update files of the form $stock.final.live.<XMin>.csv
+            minute_close_epoch is the end of the minute whose candles are being
+            finalized, for the finalize_delay metric.
         '''
         if not self.ok_to_finalize():
             PYPWarn("Not finalizing live data yet as we don't have enough live candles!")
@@ -807,6 +1372,9 @@ class CandleGenerator:
         os.spawnl(os.P_NOWAIT, exe, "pyprocess/main.py",
                   "--stocklistcsv", cfg.stocklist, "--live")
 
+        if metrics is not None and minute_close_epoch is not None:
+            metrics.finalize_delay.record((time.time() - minute_close_epoch) * 1000000)
+
         #result = subprocess.run([exe, "--stocklistcsv", cfg.stocklist, "--live"], cwd=cwd,
         #                        timeout=60, capture_output=False, text=True, check=True)
         #result.check_returncode()
@@ -888,152 +1456,6 @@ class CandleGenerator:
         return ((sec >= 9*3600+30*60 and sec < 15*3600+30*60) and
                 (td_since_start >= pd.Timedelta('15Min')))
 
-    def on_tick(self, tick):
-        ''' on_tick handler for the CandleGenerator class.
-            Every tick received over the websocket must be fed to this.
-
-            Note: Do not assert in this function and any function called from
-                  this function as that doesn't result in program to stop,
-                  but instead it causes a meaningless message from websocket
-                  claiming the callback failed.
-                  Use ASSERT().
-        '''
-        global ticks_received
-        global stale_ticks_received
-
-        #
-        # Log for the first 1000 ticks received to confirm things are working,
-        # or if verbose is set in config.
-        #
-        if cfg.verbose or (ticks_received < 1000):
-            PYPInfo("[%d] CandleGenerator::on_tick(%s)" %
-                            (ticks_received, broker.token_to_symbol(tick["token"])))
-
-        tick = broker.tick2tick(tick)
-
-        #
-        # XXX This is AngelOne specific, make it generic.
-        #
-        mode = tick["subscription_mode"]
-        ASSERT(mode == 1 or mode == 2 or mode == 3, ("mode=%d" % mode))
-
-        token = tick["token"]
-
-        # AngelOne tick timestamp is in milliseconds.
-        tick_timestamp = tick["exchange_timestamp"]
-        tick_timestamp //= 1000
-
-        dt = pd.to_datetime(tick_timestamp, unit='s').tz_localize('UTC').tz_convert('Asia/Kolkata')
-        #
-        # Ignore ticks received outside market hours.
-        #
-        if ((dt.hour < 9) or
-            (dt.hour == 9 and dt.minute < 15) or
-            (dt.hour > 15) or
-            (dt.hour == 15 and dt.minute > 30)):
-            pretty_tick = json.dumps(tick, indent=2)
-            PYPWarn("Tick (@ %s) generated outside market hours, ignoring: %s" %
-                            (dt, pretty_tick))
-            return
-
-        if self.last_tick_dt is None and dt.second > 2:
-            #
-            # when we start pylive on minute boundary, I see that candles for
-            # the previous minute also arrive, since websocket is not done
-            # sending all of them. Ignore those!
-            # f.e.,
-            # 2023-08-21 09:52:59+05:30
-            #
-            pretty_tick = json.dumps(tick, indent=2)
-            PYPWarn("Previous minute tick (@ %s), ignoring: %s" %
-                            (dt, pretty_tick))
-            return
-
-        #
-        # Any tick received with minute less than the current minute must be
-        # considered stale and dropped, else we may mess up the tick data.
-        #
-        # XXX We need to check if stale ticks are common or does Angelone take
-        #     care of publishing ticks in strictly increasing time order, so
-        #     if we get one tick at T other ticks will only be greater than T.
-        #
-        # Update: Stale ticks are only seen in the first minute after pylive
-        #     is restarted and not seen during the run, which is good!
-        #
-
-        if self.last_tick_dt is not None:
-            dt_minute = dt.hour*60 + dt.minute
-            last_tick_dt_minute = self.last_tick_dt.hour*60 + self.last_tick_dt.minute
-            if dt_minute < last_tick_dt_minute:
-                stale_ticks_received += 1
-                pretty_tick = json.dumps(tick, indent=2)
-                PYPError("[%d] Stale tick (@ %s), last_tick_dt=%s, ignoring: %s" %
-                                (stale_ticks_received, dt, self.last_tick_dt, pretty_tick))
-                return
-
-        # Only count ticks received in market hours.
-        ticks_received += 1
-
-        #
-        # First tick that starts a new minute causes current ongoing candles
-        # (for the current minute) to be sealed and dumped.
-        #
-        # XXX Hopefully anything after this tick will be later than this and
-        #     hence won't be for the previous minute. In case we get some tick
-        #     for the older minute we should ignore that with the risk that we
-        #     will lose some accuracy.
-        #
-        is_new_minute = self.is_new_minute(tick_timestamp)
-
-        #
-        # After we are done processing this tick, store the tick_timestamp as
-        # last_tick_dt, signifying the timestamp of the last tick received.
-        # Whenever a tick is received whose minute value is different from
-        # last_tick_dt that means it's time to seal all the minute candles and
-        # dump them.
-        #
-        # Sometimes I've seen that AngelOne will send older ticks later (maybe
-        # they arrive like that on websocket). This is possible since
-        # self.last_tick_dt tracks the latest tick received for all stocks, but
-        # some stock may be getting older starting tick.
-        #
-        # Ensure last_tick_dt should not move  backwards.
-        #
-        if self.last_tick_dt is None:
-            self.last_tick_dt = dt
-        else:
-            self.last_tick_dt = max(self.last_tick_dt, dt)
-
-        if is_new_minute:
-            PYPWarn("Got new minute tick [%s], dumping all instruments!" %
-                    pd.to_datetime(tick_timestamp, unit='s').
-                    tz_localize('UTC').tz_convert('Asia/Kolkata'))
-            #
-            # dump_all_instruments() will also call finalize_live_data() to
-            # generate live aggregate data after the latest 1Min candle data
-            # received.
-            #
-            self.dump_all_instruments()
-
-        #
-        # Very first tick received for this token, create a new empty Instrument,
-        # we will populate it immediately afterwards.
-        #
-        if token not in self.instruments:
-            self.instruments[token] = Instrument(token)
-
-        # Call on_tick() handler for the token.
-        instrument = self.instruments[token]
-        instrument.on_tick(tick)
-
-        #
-        # Every time we call dump_all_instruments(), at the end we must call
-        # finalize_live_data(), if not then something is wrong, shout out.
-        #
-        if self.finalize_count != self.dump_count:
-            PYPError("finalize_count (%d) != dump_count (%d)" %
-                    (self.finalize_count, self.dump_count));
-
     def start(self):
         #
         # Clear ticks_received, just in case.
@@ -1043,34 +1465,105 @@ class CandleGenerator:
         global start_time
         start_time = pd.Timestamp.now()
 
-        global ticks_received
-        if ticks_received != 0:
-            PYPWarn("Clearing ticks_received (%d)" % (ticks_received));
-            ticks_received = 0
+        for worker in self.workers:
+            if worker.ticks_received != 0:
+                PYPWarn("Clearing worker %d ticks_received (%d)" %
+                        (worker.index, worker.ticks_received));
+                worker.ticks_received = 0
         #
         # Connect to websocket passing self.on_tick as the callback which will
         # be called for every tick received over the websocket.
         # This is done in a separate thread as the start_websocket() call is a
         # blocking call.
         #
+        # With cfg.tick_ring set, the websocket is connected by the ingest
+        # process instead, ws_thread waits for it to exit.
+        #
         global ws_thread
-        ws_thread = threading.Thread(target=broker.start_websocket,
-                                     args=(self.enqueue,),
-                                     daemon=False)
+        if cfg.tick_ring:
+            global ingest_process
+            global ingest_stop
+            ingest_stop = multiprocessing.Event()
+            ingest_process = multiprocessing.Process(target=ingest,
+                                                     args=([w.ring for w in self.workers],
+                                                           ingest_stop))
+            ingest_process.start()
+            PYPInfo("Started ingest process (pid=%d)" % ingest_process.pid)
+
+            ws_thread = threading.Thread(target=ingest_process.join,
+                                         args=(),
+                                         daemon=False)
+        else:
+            ws_thread = threading.Thread(target=broker.start_websocket,
+                                         args=(self.enqueue,),
+                                         daemon=False)
         ws_thread.start()
 
     def stop(self):
         # Stop websocket to not get any more ticks.
-        broker.stop_websocket()
+        if ingest_process is not None:
+            #
+            # All ticks are in the ring once the ingest process exits, the
+            # sentinel is returned after them.
+            #
+            ingest_stop.set()
+            ws_thread.join()
+            PYPInfo("Ingest process exited with exitcode=%s" % ingest_process.exitcode)
+        else:
+            broker.stop_websocket()
 
         #
-        # Ask processing thread to stop after processing all queued ticks.
+        # Ask processing threads to stop after processing all queued ticks.
         # Though not needed, we add a sleep here just to make doubly sure that
         # the sentinel None tick doesn't get queued before any valid tick that
         # the websocket might queue.
         #
         time.sleep(1)
-        self.q.put(None)
+        for worker in self.workers:
+            worker.q.put(None)
+
+def ingest(rings, stop_event):
+    ''' Ingest process, started by CandleGenerator.start() with cfg.tick_ring
+        set. It connects the websocket and writes every tick to the ring of
+        the token's worker, till stop_event is set.
+        Nothing else runs in this process, so websocket receive and decoding
+        never wait for the GIL held by the main process threads.
+    '''
+    setproctitle.setproctitle("pylive.ingest")
+
+    writers = [TickRing.TickRingWriter(ring) for ring in rings]
+
+    #
+    # The broker partitions the tokens over the websocket connections the
+    # same way, so every ring is only written by one connection's thread, as
+    # TickRing needs.
+    #
+    token_writer = {}
+    def put(tick):
+        token = tick["token"]
+        writer = token_writer.get(token)
+        if writer is None:
+            writer = writers[token_partition(token, len(writers))]
+            token_writer[token] = writer
+        writer.put(tick)
+
+    thread = threading.Thread(target=broker.start_websocket,
+                              args=(put,),
+                              daemon=False)
+    thread.start()
+
+    #
+    # Don't outlive the main process, f.e., if it's killed.
+    #
+    parent = os.getppid()
+    while thread.is_alive() and not stop_event.wait(1):
+        if os.getppid() != parent:
+            PYPError("ingest: main process (pid=%d) exited, stopping!" % parent)
+            break
+
+    broker.stop_websocket()
+    thread.join()
+    PYPInfo("ingest: exiting, full_waits=%s" % [w.full_waits for w in writers])
 
 def init():
     ''' This runs in the context of the main process.
@@ -1084,10 +1577,33 @@ def init():
     # updated everytime we dump live candle data or from other places like
     # while waiting for market to open or new minute to start, etc.
     #
-    Path(cfg.pylivedir + "/pylive_running.xxx").touch()
+    if cfg.replay_outdir is None:
+        Path(cfg.pylivedir + "/pylive_running.xxx").touch()
 
     PYPInfo('CandleGenerator: init() start')
-    # Create the singleton CandleGenerator object.
+
+    #
+    # Create the LTP table before any Candle is created, OrderPlacer reads
+    # the LTP from here.
+    #
+    # Replay must not overwrite the live LTP table.
+    global ltp_table
+    if cfg.replay_outdir is not None:
+        ltp_table = LTPTable.LTPTableWriter(os.path.join(cfg.replay_outdir, "ltp.table"))
+    else:
+        ltp_table = LTPTable.LTPTableWriter()
+
+    global metrics
+    if cfg.tick_metrics:
+        metrics = TickMetrics.TickMetrics(cfg.tick_metrics_file)
+
+    global publisher
+    if cfg.publish_latest:
+        publisher = LatestPublisher.LatestPublisher(cfg.publish_latest_dir,
+                                                    cfg.publish_latest_interval_ms,
+                                                    cfg.publish_latest_history)
+
+    # Create the singleton CandleGenerator object, along with its workers.
     global cg
     cg = CandleGenerator()
     PYPInfo('CandleGenerator: init() end')
@@ -1117,7 +1633,14 @@ def start():
     # XXX If this ever starts on a non-minute boundary we need to set
     #     Candle::partial
     #
-    if not is_market_open():
+    if cfg.replay_outdir is not None:
+        #
+        # Replayed frames start wherever the recording started (and the mock
+        # feed at its simulated time), there's no market to wait for and no
+        # historical data to fetch.
+        #
+        cg.historical_data_refreshed = True
+    elif not is_market_open():
         PYPWarn("Waiting for market open @ %s" % pd.Timestamp.now())
 
         while not is_market_open():
@@ -1161,15 +1684,38 @@ def start():
                                              daemon=False)
         historical_thread.start()
 
+    if publisher is not None:
+        publisher.start()
+
+    for worker in cg.workers:
+        worker.live_writer.start()
+
+    if metrics is not None:
+        metrics.start()
+
     cg.start()
     PYPInfo('CandleGenerator: start() end')
 
+def get_ticks_received():
+    ''' Total ticks received over websocket, summed over all the workers.
+    '''
+    return sum(worker.ticks_received for worker in cg.workers)
+
+def get_stale_ticks_received():
+    ''' Total stale ticks received, summed over all the workers.
+    '''
+    return sum(worker.stale_ticks_received for worker in cg.workers)
+
 def stop():
     ''' This runs in the context of the main process.
     '''
     PYPInfo('CandleGenerator: stop() start')
 
     cg.stop()
+    if publisher is not None:
+        publisher.stop()
+    if metrics is not None:
+        metrics.stop()
     global exit_now
     exit_now = True
 
@@ -1182,11 +1728,9 @@ def join():
 
     global historical_thread
     global ws_thread
-    global dequeue_thread
 
     # join() MUST be called after start().
     assert(ws_thread is not None)
-    assert(dequeue_thread is not None)
 
     #
     # historical_thread is only created when pylive/broker is started after
@@ -1199,7 +1743,29 @@ def join():
     ws_thread.join()
     PYPInfo('CandleGenerator: ws_thread exited!')
 
-    dequeue_thread.join()
-    PYPInfo('CandleGenerator: dequeue_thread exited!')
+    for worker in cg.workers:
+        worker.dequeue_thread.join()
+        PYPInfo('CandleGenerator: worker %d dequeue_thread exited!' % worker.index)
+
+        #
+        # dequeue thread has exited, so no more rows can be dumped, stop the
+        # writer after it has written everything.
+        #
+        worker.live_writer.stop()
+        worker.live_writer.join()
+        PYPInfo('CandleGenerator: worker %d live_writer exited!' % worker.index)
+
+    if metrics is not None:
+        metrics.join()
+        #
+        # Last partial minute, exported only once the dequeue threads have
+        # exited so it has all the ticks. exporter() leaves it for us.
+        #
+        metrics.export()
+        PYPInfo('CandleGenerator: metrics export_thread exited!')
+
+    if publisher is not None:
+        publisher.join()
+        PYPInfo('CandleGenerator: publisher flush_thread exited!')
 
     PYPInfo('CandleGenerator: join() end')
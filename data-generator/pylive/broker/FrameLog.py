@@ -0,0 +1,180 @@
+import os, sys, time, struct
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import threading
+import config as cfg
+from helpers import *
+
+#
+# Raw websocket frame recorder and replayer.
+#
+# With cfg.ws_record set, every binary frame received by SmartWebSocketV2 is
+# appended (as received, before it's parsed) to a daily frames file in
+# cfg.ws_record_dir along with the time it was received. These files can
+# later be replayed with broker/replay.py, which feeds the frames through the
+# same SmartWebSocketV2._parse_binary_data() -> CandleGenerator.enqueue()
+# path that the live feed takes, at 1x, Nx or max speed. This lets us
+# reproduce and benchmark the tick path outside market hours, with real
+# market days as repeatable loads.
+#
+# File layout:
+#
+# +--------+---------+---------+-----+
+# | header | frame 0 | frame 1 | ... |
+# +--------+---------+---------+-----+
+#
+# Header (FILE_HEADER): magic, version.
+# Frame: FRAME_HEADER (receive time as epoch seconds, frame length) followed
+#        by the raw frame bytes.
+#
+
+MAGIC = b"PYFRAMES"
+VERSION = 1
+
+FILE_HEADER = struct.Struct("<8sI")
+FRAME_HEADER = struct.Struct("<dI")
+
+# Recorder flushes buffered frames at least this often (seconds).
+FLUSH_INTERVAL = 1.0
+
+def frames_file(dirname, epoch):
+    ''' Daily frames file in dirname, for frames received at epoch.
+    '''
+    return os.path.join(dirname, "frames.%s.bin" %
+                        time.strftime("%Y-%m-%d", time.localtime(epoch)))
+
+class FrameRecorder:
+    ''' Appends raw websocket frames to the daily frames file in dirname.
+        record() is called from the websocket thread for every frame, so it
+        only does a buffered write, the buffer is flushed every
+        FLUSH_INTERVAL seconds.
+    '''
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.path = None
+        self.f = None
+        self.last_flush = 0
+        self.lock = threading.Lock()
+
+        # Stats.
+        self.frames = 0
+        self.bytes = 0
+
+        os.makedirs(self.dirname, exist_ok=True)
+
+    def open(self, path):
+        if self.f is not None:
+            self.f.close()
+
+        new_file = (not os.path.exists(path) or os.path.getsize(path) == 0)
+        self.f = open(path, "ab", buffering=1024*1024)
+        if new_file:
+            self.f.write(FILE_HEADER.pack(MAGIC, VERSION))
+        self.path = path
+        PYPInfo("FrameRecorder: recording websocket frames to %s", path)
+
+    def record(self, data):
+        now = time.time()
+        with self.lock:
+            path = frames_file(self.dirname, now)
+            if path != self.path:
+                self.open(path)
+
+            self.f.write(FRAME_HEADER.pack(now, len(data)))
+            self.f.write(data)
+            self.frames += 1
+            self.bytes += len(data)
+
+            if now - self.last_flush >= FLUSH_INTERVAL:
+                self.f.flush()
+                self.last_flush = now
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+        PYPInfo("FrameRecorder: recorded %d frames (%d bytes) to %s",
+                self.frames, self.bytes, self.path)
+
+def read_frames(path):
+    ''' Generator yielding (receive time, frame) for every frame in path.
+    '''
+    with open(path, "rb") as f:
+        magic, version = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        ASSERT(magic == MAGIC and version == VERSION,
+               "Bad frames file %s: magic=%s version=%d" % (path, magic, version))
+
+        while True:
+            hdr = f.read(FRAME_HEADER.size)
+            if len(hdr) < FRAME_HEADER.size:
+                break
+            recv_time, length = FRAME_HEADER.unpack(hdr)
+            data = f.read(length)
+            # Last frame may be partially written if the recorder was killed.
+            if len(data) < length:
+                PYPWarn("FrameReplayer: truncated frame at the end of %s", path)
+                break
+            yield recv_time, data
+
+class FrameReplayer:
+    ''' Replays frames recorded by FrameRecorder.
+        speed is the replay speed relative to the recorded pace, f.e., 1 for
+        real time and 10 for 10x, 0 replays as fast as possible.
+        parser is a SmartWebSocketV2 instance, used for parsing the frames
+        exactly like the live feed does.
+    '''
+    def __init__(self, path, speed, parser):
+        ASSERT(speed >= 0, "speed=%s" % speed)
+        self.path = path
+        self.speed = speed
+        self.parser = parser
+        self.exit_now = False
+
+        # Stats.
+        self.frames = 0
+        self.start_time = None
+        self.end_time = None
+
+    def run(self, cb):
+        ''' Parse every recorded frame and call cb with the parsed tick, same
+            as SmartWebSocketV2.on_data() would have been called.
+            Returns after all frames are replayed or stop() is called.
+        '''
+        PYPInfo("FrameReplayer: replaying %s at %s speed", self.path,
+                ("%gx" % self.speed) if self.speed > 0 else "max")
+
+        self.start_time = time.perf_counter()
+        first_recv_time = None
+
+        for recv_time, data in read_frames(self.path):
+            if self.exit_now:
+                break
+
+            if self.speed > 0:
+                if first_recv_time is None:
+                    first_recv_time = recv_time
+                due = self.start_time + (recv_time - first_recv_time) / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            cb(self.parser._parse_binary_data(data))
+            self.frames += 1
+
+        self.end_time = time.perf_counter()
+        PYPInfo("FrameReplayer: replayed %d frames in %.3fs (%.1f frames/sec)",
+                self.frames, self.elapsed(), self.rate())
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return (self.frames / elapsed) if elapsed > 0 else 0
+
+    def stop(self):
+        self.exit_now = True
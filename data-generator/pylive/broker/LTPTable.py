@@ -0,0 +1,264 @@
+import os, sys, mmap, struct
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import threading
+import config as cfg
+from helpers import *
+
+#
+# Memory mapped LTP table.
+#
+# CandleGenerator updates the LTP details of a symbol on every tick it gets
+# and OrderPlacer reads those for every order/gtt it refreshes. Earlier this
+# was done through one json file per symbol (pylive/orders/ltp/<symbol>),
+# rewritten on every tick and parsed on every read, which meant few syscalls
+# and a json dump/parse per tick/read.
+# Now we have a single fixed layout file (pylive/orders/ltp/ltp.table) which
+# is mmap()ed by the writer and the readers, with one fixed size record per
+# symbol. The writer does one in-place store per tick and readers read the
+# record w/o any syscall or parsing.
+#
+# File layout:
+#
+# +--------+----------+----------+----------+
+# | header | record 0 | record 1 |   ...    |
+# +--------+----------+----------+----------+
+#
+# Header (HEADER_SIZE bytes):
+#   magic, version, record size, number of record slots, number of used slots.
+#
+# Record (RECORD_SIZE bytes):
+#   version (seqlock), symbol, sequence_number, exchange_timestamp,
+#   last_traded_price, open/high/low/close price of the day,
+#   volume_trade_for_the_day.
+#
+# Each record is protected by a seqlock. The writer makes version odd before
+# updating the record and even after it's done. Readers read the version
+# before and after reading the record and retry if it was odd or it changed.
+# There is only one writer (CandleGenerator's dequeue thread) so writers
+# don't need to synchronize among themselves.
+#
+# Note: We rely on stores not being reordered with other stores and loads
+#       not being reordered with other loads (true for x86). Python
+#       doesn't give us memory barriers and this is good enough for our use.
+#
+# Prices are in paise, as received in the tick.
+#
+
+LTP_TABLE_FILE = os.path.join(cfg.srcdir, "pylive/orders/ltp/ltp.table")
+
+MAGIC = b"PYLTPTBL"
+VERSION = 1
+
+# Max symbols the table can hold, NIFTY_200 needs 200.
+MAX_RECORDS = 1024
+
+# Symbol names are NUL padded to this size.
+SYMBOL_SIZE = 32
+
+HEADER = struct.Struct("<8sIIII")
+HEADER_SIZE = 64
+
+RECORD = struct.Struct("<Q%dsqqqqqqqq" % SYMBOL_SIZE)
+RECORD_SIZE = 128
+
+# The version (seqlock) field at the start of every record.
+SEQLOCK = struct.Struct("<Q")
+# Record fields after the seqlock.
+PAYLOAD = struct.Struct("<qqqqqqqq")
+PAYLOAD_OFFSET = SEQLOCK.size + SYMBOL_SIZE
+
+assert(HEADER.size <= HEADER_SIZE)
+assert(RECORD.size <= RECORD_SIZE)
+
+# How many times a reader retries a record being concurrently updated.
+MAX_READ_RETRIES = 1000
+
+def record_offset(slot):
+    return HEADER_SIZE + (slot * RECORD_SIZE)
+
+class LTPTableWriter:
+    ''' The one and only writer of the LTP table, used by CandleGenerator.
+        It (re)creates the table, so all symbols start with 0 LTP, same as
+        what we had with the initial LTP json files.
+    '''
+    def __init__(self, path=LTP_TABLE_FILE, max_records=MAX_RECORDS):
+        self.path = path
+        self.max_records = max_records
+        self.size = HEADER_SIZE + (max_records * RECORD_SIZE)
+
+        # symbol -> slot.
+        self.slots = {}
+
+        #
+        # Serializes add() across CandleGenerator workers. update() doesn't
+        # need it as every symbol's slot is only updated by its own worker.
+        #
+        self.lock = threading.Lock()
+
+        #
+        # Re-initialize the existing file in place instead of creating a new
+        # one, so that readers which already have it mapped see the new
+        # content and not a stale unlinked file.
+        #
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+            self.mm = mmap.mmap(fd, self.size, mmap.MAP_SHARED,
+                                mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        #
+        # Zero the used slot count first so that readers don't look at the
+        # records while we clear them.
+        #
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, RECORD_SIZE, max_records, 0)
+        self.mm[HEADER_SIZE:self.size] = bytes(self.size - HEADER_SIZE)
+
+        PYPPass("Created LTP table %s (max_records=%d, size=%d)" %
+                (path, max_records, self.size))
+
+    def add(self, symbol):
+        ''' Add a record for symbol, if not already added, and return its slot.
+            The record starts with 0 LTP till update() is called.
+        '''
+        with self.lock:
+            return self._add(symbol)
+
+    def _add(self, symbol):
+        slot = self.slots.get(symbol)
+        if slot is not None:
+            return slot
+
+        ASSERT(len(symbol.encode()) <= SYMBOL_SIZE, "Symbol too long: %s" % symbol)
+        slot = len(self.slots)
+        ASSERT(slot < self.max_records,
+               "LTP table full (%d), cannot add %s" % (self.max_records, symbol))
+
+        RECORD.pack_into(self.mm, record_offset(slot), 0, symbol.encode(),
+                         0, 0, 0, 0, 0, 0, 0, 0)
+        self.slots[symbol] = slot
+
+        # Publish the new slot only after the record is initialized.
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, RECORD_SIZE,
+                         self.max_records, len(self.slots))
+        return slot
+
+    def update(self, slot, tick):
+        ''' Update the record at slot with the LTP details from tick.
+            This is called for every tick, keep it lean.
+        '''
+        off = record_offset(slot)
+        version = SEQLOCK.unpack_from(self.mm, off)[0]
+
+        # Odd version tells readers that the record is being updated.
+        SEQLOCK.pack_into(self.mm, off, version + 1)
+        PAYLOAD.pack_into(self.mm, off + PAYLOAD_OFFSET,
+                          tick["sequence_number"],
+                          tick["exchange_timestamp"],
+                          tick["last_traded_price"],
+                          tick.get("open_price_of_the_day", 0),
+                          tick.get("high_price_of_the_day", 0),
+                          tick.get("low_price_of_the_day", 0),
+                          tick.get("closed_price", 0),
+                          tick.get("volume_trade_for_the_day", 0))
+        SEQLOCK.pack_into(self.mm, off, version + 2)
+
+    def close(self):
+        self.mm.close()
+
+class LTPTableReader:
+    ''' Reader of the LTP table, used by OrderPlacer.
+        The table is mapped on first use, lookups don't make any syscall.
+    '''
+    def __init__(self, path=LTP_TABLE_FILE):
+        self.path = path
+        self.mm = None
+
+        # symbol -> slot, as found by the last scan of the table.
+        self.slots = {}
+
+    def _map(self):
+        ''' Map the table, returns False if the table is not yet created.
+        '''
+        try:
+            with open(self.path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        except FileNotFoundError:
+            #
+            # pylive has not created it yet, expected at startup. get() tries
+            # again on every call so don't flood the logs.
+            #
+            PYPWarnRateLimited("ltp-table-not-found",
+                               "LTP table %s not yet created", self.path)
+            return False
+        except Exception as e:
+            PYPError("Failed to map LTP table %s: %s" % (self.path, e))
+            return False
+
+        magic, version, record_size, _, _ = HEADER.unpack_from(self.mm, 0)
+        ASSERT(magic == MAGIC and version == VERSION and record_size == RECORD_SIZE,
+               "Bad LTP table %s: magic=%s version=%d record_size=%d" %
+               (self.path, magic, version, record_size))
+        return True
+
+    def _scan(self):
+        ''' (Re)build the symbol -> slot map from the table.
+        '''
+        _, _, _, _, used = HEADER.unpack_from(self.mm, 0)
+        self.slots = {}
+        for slot in range(used):
+            off = record_offset(slot) + SEQLOCK.size
+            symbol = self.mm[off:off + SYMBOL_SIZE].rstrip(b"\x00").decode()
+            self.slots[symbol] = slot
+
+    def get(self, symbol):
+        ''' Returns the LTP details for symbol, as a dict with the same keys as
+            the websocket tick, or None if we don't have symbol in the table.
+        '''
+        if self.mm is None and not self._map():
+            return None
+
+        slot = self.slots.get(symbol)
+        if slot is None:
+            # May have been added after our last scan.
+            self._scan()
+            slot = self.slots.get(symbol)
+            if slot is None:
+                return None
+
+        off = record_offset(slot)
+        for _ in range(MAX_READ_RETRIES):
+            fields = RECORD.unpack_from(self.mm, off)
+            version = fields[0]
+            # Writer is in the middle of updating this record.
+            if version & 1:
+                continue
+            if SEQLOCK.unpack_from(self.mm, off)[0] == version:
+                break
+        else:
+            PYPError("LTP table record for %s kept changing, giving up!" % symbol)
+            return None
+
+        #
+        # The writer may have recreated the table (pylive restart) and the
+        # slot may now belong to some other symbol, rescan and retry.
+        #
+        if fields[1].rstrip(b"\x00").decode() != symbol:
+            self.slots.pop(symbol, None)
+            self._scan()
+            if symbol not in self.slots:
+                return None
+            return self.get(symbol)
+
+        return {
+            "sequence_number": fields[2],
+            "exchange_timestamp": fields[3],
+            "last_traded_price": fields[4],
+            "open_price_of_the_day": fields[5],
+            "high_price_of_the_day": fields[6],
+            "low_price_of_the_day": fields[7],
+            "closed_price": fields[8],
+            "volume_trade_for_the_day": fields[9],
+        }
@@ -0,0 +1,280 @@
+import os, sys, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import threading
+from collections import deque
+import config as cfg
+from helpers import *
+
+#
+# Publisher for the terminal's data/stock layout (see data.layout).
+#
+# The terminal reads data/stock/<SYM>/<metric>/latest for every visible cell.
+# latest is a symlink to the most recent numbered history file
+# data/stock/<SYM>/<metric>/<N>, which holds just the value, f.e.,
+#
+# data/stock/INFY/ltp/1
+# data/stock/INFY/ltp/2
+# data/stock/INFY/ltp/latest -> 2
+#
+# CandleGenerator feeds every tick (on_tick()) and every closed 1Min candle
+# (on_candle()) to the publisher which keeps the metrics for each stock
+# incrementally in memory. A flusher thread writes only the metrics that
+# changed since the last flush, at most once every flush_interval_ms. Ticks
+# arriving between two flushes are thus coalesced and only the last value
+# gets written.
+#
+# Every value is written to a temp file and then renamed to the next numbered
+# file, and then latest is atomically switched to it, so the terminal never
+# reads a partially written value. Only the last history_len numbered files
+# are kept.
+#
+# Metrics published:
+# ltp    - Last traded price.
+# pctchg - Percentage change of ltp from previous day's close.
+# gap    - Percentage gap of today's open from previous day's close.
+#          pctchg and gap are 0 till the previous day's close is known.
+# 5ma    - Average of the last 5 1Min candle closes.
+# 10ma   - Average of the last 10 1Min candle closes.
+#
+
+# Moving averages we publish, "<N>ma" is the average of last N 1Min closes.
+MA_PERIODS = (5, 10)
+
+class StockMetrics:
+    ''' In memory metrics for one stock.
+    '''
+    def __init__(self, symbol):
+        self.symbol = symbol
+
+        # metric name -> latest value (rupees/percentage).
+        self.values = {}
+
+        # Last max(MA_PERIODS) 1Min closes and their running sums per period.
+        self.closes = deque(maxlen=max(MA_PERIODS))
+        self.sums = {period: 0.0 for period in MA_PERIODS}
+
+    def set(self, metric, value):
+        ''' Set metric value, returns True if the value changed.
+            We publish with 2 decimals, so only changes visible at that
+            precision count.
+        '''
+        value = round(value, 2)
+        if self.values.get(metric) == value:
+            return False
+        self.values[metric] = value
+        return True
+
+class LatestPublisher:
+    def __init__(self, data_dir, flush_interval_ms, history_len):
+        self.data_dir = data_dir
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.history_len = history_len
+        ASSERT(self.history_len >= 1)
+
+        # symbol -> StockMetrics.
+        self.stocks = {}
+
+        #
+        # (symbol, metric) pairs changed since the last flush.
+        # Updated by the tick thread and drained by the flusher thread, under
+        # self.lock.
+        #
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+        #
+        # (symbol, metric) -> number of the last history file written.
+        # Only touched by the flusher thread.
+        #
+        self.last_num = {}
+
+        self.exit_now = False
+        self.flush_thread = None
+
+        # Stats.
+        self.flushes = 0
+        self.files_written = 0
+
+        os.makedirs(self.data_dir, exist_ok=True)
+
+    def get_stock(self, symbol):
+        stock = self.stocks.get(symbol)
+        if stock is None:
+            stock = StockMetrics(symbol)
+            self.stocks[symbol] = stock
+        return stock
+
+    def on_tick(self, symbol, tick):
+        ''' Update ltp, pctchg and gap for symbol from tick.
+            Called for every tick from CandleGenerator's tick path, keep it
+            lean, no I/O here.
+        '''
+        stock = self.get_stock(symbol)
+        changed = []
+
+        # Prices in the tick are in paise.
+        ltp = tick["last_traded_price"] / 100
+        if stock.set("ltp", ltp):
+            changed.append("ltp")
+
+        #
+        # closed_price is the previous day's close, it's not present in LTP
+        # mode ticks.
+        #
+        prev_close = tick.get("closed_price", 0) / 100
+        if prev_close > 0:
+            if stock.set("pctchg", (ltp - prev_close) * 100 / prev_close):
+                changed.append("pctchg")
+
+            day_open = tick.get("open_price_of_the_day", 0) / 100
+            if day_open > 0 and stock.set("gap", (day_open - prev_close) * 100 / prev_close):
+                changed.append("gap")
+
+        #
+        # Publish 0 till we know the previous day's close (and today's open),
+        # terminal's sttable needs a latest value for every column it shows.
+        #
+        for metric in ("pctchg", "gap"):
+            if metric not in stock.values:
+                stock.set(metric, 0)
+                changed.append(metric)
+
+        if changed:
+            with self.lock:
+                for metric in changed:
+                    self.dirty.add((symbol, metric))
+
+    def on_candle(self, symbol, close):
+        ''' Update the moving averages for symbol with a newly closed 1Min
+            candle's close price (rupees).
+        '''
+        stock = self.get_stock(symbol)
+
+        #
+        # Incrementally update the running sums, subtract the close that
+        # falls out of each period's window.
+        #
+        closes = stock.closes
+        for period in MA_PERIODS:
+            if len(closes) >= period:
+                stock.sums[period] -= closes[-period]
+            stock.sums[period] += close
+        closes.append(close)
+
+        changed = []
+        for period in MA_PERIODS:
+            # Don't publish till we have a full window.
+            if len(closes) < period:
+                continue
+            metric = "%dma" % period
+            if stock.set(metric, stock.sums[period] / period):
+                changed.append(metric)
+
+        if changed:
+            with self.lock:
+                for metric in changed:
+                    self.dirty.add((symbol, metric))
+
+    def get_last_num(self, metric_dir, key):
+        ''' Return the number of the last history file in metric_dir.
+            We need to scan the directory only the first time, so that we
+            continue the numbering across restarts.
+        '''
+        num = self.last_num.get(key)
+        if num is not None:
+            return num
+
+        num = 0
+        if os.path.isdir(metric_dir):
+            for name in os.listdir(metric_dir):
+                if name.isdigit():
+                    num = max(num, int(name))
+        else:
+            os.makedirs(metric_dir, exist_ok=True)
+
+        self.last_num[key] = num
+        return num
+
+    def publish(self, symbol, metric, value):
+        ''' Write value as the next history file for symbol/metric and point
+            latest to it.
+        '''
+        key = (symbol, metric)
+        metric_dir = os.path.join(self.data_dir, symbol, metric)
+        num = self.get_last_num(metric_dir, key) + 1
+
+        # Write temp file and rename it to the next numbered file.
+        tmp = os.path.join(metric_dir, ".tmp.%d" % os.getpid())
+        with open(tmp, "w") as f:
+            f.write("%.2f\n" % value)
+        os.rename(tmp, os.path.join(metric_dir, str(num)))
+
+        # Atomically switch latest to the new file.
+        tmplink = os.path.join(metric_dir, ".latest.%d" % os.getpid())
+        try:
+            os.unlink(tmplink)
+        except FileNotFoundError:
+            pass
+        os.symlink(str(num), tmplink)
+        os.rename(tmplink, os.path.join(metric_dir, "latest"))
+
+        self.last_num[key] = num
+        self.files_written += 1
+
+        # Keep history bounded.
+        old = num - self.history_len
+        if old > 0:
+            try:
+                os.unlink(os.path.join(metric_dir, str(old)))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        ''' Write all metrics changed since the last flush.
+        '''
+        with self.lock:
+            if not self.dirty:
+                return
+            dirty = self.dirty
+            self.dirty = set()
+
+        for symbol, metric in dirty:
+            value = self.stocks[symbol].values[metric]
+            try:
+                self.publish(symbol, metric, value)
+            except Exception as e:
+                #
+                # Terminal is only a viewer, don't let any failure here affect
+                # pylive.
+                #
+                PYPError("LatestPublisher: Failed to publish %s/%s=%s: %s" %
+                         (symbol, metric, value, e))
+
+        self.flushes += 1
+        if cfg.verbose:
+            PYPDebug("LatestPublisher: flush %d wrote %d values (total files written %d)" %
+                     (self.flushes, len(dirty), self.files_written))
+
+    def flusher(self):
+        PYPInfo("LatestPublisher: flusher started, data_dir=%s, flush_interval=%.3fs, history_len=%d" %
+                (self.data_dir, self.flush_interval, self.history_len))
+        while not self.exit_now:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+        # One last flush so that we exit with the latest values published.
+        self.flush()
+        PYPInfo("LatestPublisher: flusher exiting, flushes=%d, files_written=%d" %
+                (self.flushes, self.files_written))
+
+    def start(self):
+        self.flush_thread = threading.Thread(target=self.flusher, args=(), daemon=False)
+        self.flush_thread.start()
+
+    def stop(self):
+        self.exit_now = True
+
+    def join(self):
+        if self.flush_thread is not None:
+            self.flush_thread.join()
@@ -0,0 +1,152 @@
+import os, sys, csv, time
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import queue
+import threading
+import config as cfg
+from helpers import *
+
+#
+# Writer for the $stock.live.csv files.
+#
+# At the start of every minute CandleGenerator dumps the 1Min candle of every
+# instrument to its $stock.live.csv. Earlier every Instrument.dump() opened
+# the file in append mode, created a csv.writer, wrote one row and closed the
+# file, i.e., one open/close pair per instrument per minute, all on the tick
+# thread.
+# Now Instrument.dump() just queues its rows with write() and once all
+# instruments are dumped, dump_all_instruments() calls commit() which writes
+# all the queued rows in one pass through append handles that are kept open
+# for the session, flushes all the files written and then (optionally) fsyncs
+# them, before calling the callback which signals pyprocess. So pyprocess
+# never sees a partially written minute.
+#
+# With background=True commit() just hands the queued rows to the writer
+# thread and returns, so that the tick thread can get going with the ticks of
+# the new minute. The writer thread commits the minutes in order.
+#
+# Note: The handles are opened in append mode (O_APPEND) so every write goes
+#       to the current end of the file even if some other process appends to
+#       it. We only start writing to $stock.live.csv after pyhistorical is
+#       done (re)writing it, see Instrument.dump().
+#
+
+class LiveWriter:
+    def __init__(self, fsync, background):
+        self.fsync = fsync
+        self.background = background
+
+        # csv_file -> (file, csv.writer), kept open for the session.
+        self.writers = {}
+
+        #
+        # (csv_file, row) queued by write() since the last commit().
+        # Only touched by the tick thread.
+        #
+        self.rows = []
+
+        # Minutes committed by the tick thread, processed by the writer thread.
+        self.q = queue.Queue(maxsize=0)
+        self.writer_thread = None
+
+        # Stats.
+        self.commits = 0
+        self.rows_written = 0
+
+    def write(self, csv_file, row):
+        ''' Queue row to be appended to csv_file by the next commit().
+        '''
+        self.rows.append((csv_file, row))
+
+    def commit(self, callback=None):
+        ''' Write all the rows queued since the last commit() and call callback
+            once they are flushed (and fsynced, if asked).
+            In background mode this happens in the writer thread.
+        '''
+        rows = self.rows
+        self.rows = []
+
+        if self.background:
+            self.q.put((rows, callback))
+        else:
+            self.do_commit(rows, callback)
+
+    def get_writer(self, csv_file):
+        writer = self.writers.get(csv_file)
+        if writer is None:
+            # Only needed for replay/load tests, live always has the directory.
+            os.makedirs(os.path.dirname(csv_file), exist_ok=True)
+            outfile = open(csv_file, 'a')
+            writer = (outfile, csv.writer(outfile))
+            self.writers[csv_file] = writer
+        return writer
+
+    def do_commit(self, rows, callback):
+        start = time.perf_counter()
+
+        #
+        # Format all the rows in one pass, these go into the file objects'
+        # buffers. Nothing reaches the files till we flush them below.
+        #
+        dirty = {}
+        for csv_file, row in rows:
+            outfile, csvwriter = self.get_writer(csv_file)
+            csvwriter.writerow(row)
+            dirty[csv_file] = outfile
+
+        for outfile in dirty.values():
+            outfile.flush()
+
+        #
+        # Single barrier after all the files are written, so that the minute
+        # is durable before pyprocess is signalled.
+        #
+        if self.fsync:
+            for outfile in dirty.values():
+                os.fdatasync(outfile.fileno())
+
+        self.commits += 1
+        self.rows_written += len(rows)
+
+        if cfg.verbose:
+            PYPDebug("LiveWriter: commit %d wrote %d rows to %d files in %.3fs (fsync=%s)",
+                     self.commits, len(rows), len(dirty),
+                     time.perf_counter() - start, self.fsync)
+
+        if callback is not None:
+            callback()
+
+    def writer(self):
+        PYPInfo("LiveWriter: writer started, fsync=%s", self.fsync)
+        while True:
+            item = self.q.get()
+            # stop() enqueues the None sentinel value for asking it to stop.
+            if item is None:
+                break
+            self.do_commit(*item)
+
+        self.close()
+        PYPInfo("LiveWriter: writer exiting, commits=%d, rows_written=%d",
+                self.commits, self.rows_written)
+
+    def close(self):
+        for outfile, _ in self.writers.values():
+            outfile.close()
+        self.writers = {}
+
+    def start(self):
+        if self.background:
+            self.writer_thread = threading.Thread(target=self.writer, args=(), daemon=False)
+            self.writer_thread.start()
+
+    def stop(self):
+        ''' Must be called after the last commit().
+        '''
+        if self.background:
+            self.q.put(None)
+        else:
+            self.close()
+
+    def join(self):
+        if self.writer_thread is not None:
+            self.writer_thread.join()
@@ -1,11 +1,15 @@
-import os, sys, csv, setproctitle, re, time, json, signal, shutil
+import os, sys, csv, setproctitle, re, time, json, signal, shutil, hashlib
 import pandas as pd
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 
 import multiprocessing
+import queue
+import concurrent.futures
 import inotify.adapters
 import config as cfg
 from helpers import *
+import LTPTable
+import OrderStore
 
 #
 # TODO:
@@ -33,7 +37,8 @@ orderbook_dumpall_epoch = 0
 #
 squareoff_orderid = 1000
 
-if cfg.broker['selection'] == "angelone":
+# mock is AngelOne talking to broker/mockbroker.py, see config.py.
+if cfg.broker['selection'] in ("angelone", "mock"):
     import AngelOne as broker
 else:
     # Till we support other brokers.
@@ -56,9 +61,94 @@ positions_dir = os.path.join(cfg.srcdir, "pylive/orders/positions")
 # LTP is updated here for each stock, by CandleGenerator.
 ltp_dir = os.path.join(cfg.srcdir, "pylive/orders/ltp")
 
+#
+# State of every engine order, along with its state transitions, see
+# OrderStore.py. Order files are still moved across the above directories, see
+# move_order(), but the state of an order is looked up in order_store.
+#
+order_store_file = os.path.join(cfg.srcdir, "pylive/orders/orderstate.db")
+order_store = None
+
+# Directory for the order files in each state ("old" ones are in <dir>/old).
+ORDER_STATE_DIRS = {
+    "generated": generated_dir,
+    "placing": placing_dir,
+    "placed": placed_dir,
+    "partially_executed": partially_executed_dir,
+    "executed": executed_dir,
+    "squaredoff": squaredoff_dir,
+    "cancelled": cancelled_dir,
+    "failed": failed_dir,
+}
+ORDER_DIR_STATES = {d: state for state, d in ORDER_STATE_DIRS.items()}
+
+# Reader for the LTP table (in ltp_dir) updated by CandleGenerator.
+ltp_table = LTPTable.LTPTableReader()
+
 inotify_adapter = None
 runner_stopped_gracefully = False
 
+def order_state_of(order_file):
+    ''' State of the order whose file is order_file.
+    '''
+    d = os.path.dirname(order_file)
+    if os.path.basename(d) == "old":
+        return "old"
+    return ORDER_DIR_STATES[d]
+
+def order_is_at(order_file):
+    ''' Is the order in the state corresponding to order_file?
+        This is what os.path.exists(order_file) used to tell us.
+    '''
+    return order_store.get_state(os.path.basename(order_file)) == order_state_of(order_file)
+
+def move_order(src_file, dst_file):
+    ''' Move the order file src_file to dst_file and record the order's state
+        transition in order_store. Raises on failure, like os.rename().
+    '''
+    os.rename(src_file, dst_file)
+
+    engine_orderid = os.path.basename(dst_file)
+    from_state = order_store.transition(engine_orderid, order_state_of(dst_file))
+    #
+    # Orders are not known to order_store till process_generated_order() sees
+    # them, anything else means the files were moved behind our back.
+    #
+    if from_state is not None and from_state != order_state_of(src_file):
+        PYPWarn("[OrderStore] Order %s was %s, expected %s (%s -> %s)" %
+                (engine_orderid, from_state, order_state_of(src_file),
+                 src_file, dst_file))
+
+def import_order_files():
+    ''' Add the orders in the orders/ directories to a freshly created
+        order_store. This is the only time we scan these directories.
+    '''
+    regex = re.compile('^[0-9]+$')
+    for state, d in ORDER_STATE_DIRS.items():
+        for order_file in filter(regex.search, os.listdir(d)):
+            file_path = os.path.join(d, order_file)
+            try:
+                with open(file_path) as f:
+                    order = json.load(f)
+                ASSERT(str(order['orderid']) == order_file)
+                order_store.add(order, state, modified=os.stat(file_path).st_mtime)
+            except Exception as e:
+                PYPWarn("[OrderStore] Failed to load %s (%s), adding without json" %
+                        (file_path, e))
+                order_store.transition(order_file, state)
+
+    PYPInfo("[OrderStore] Imported %d orders from %s" %
+            (order_store.count(), os.path.dirname(generated_dir)))
+
+def open_order_store():
+    ''' Open (creating and populating, if needed) order_store.
+        Called from init(), the placer process inherits it.
+    '''
+    global order_store
+    order_store = OrderStore.OrderStore(order_store_file)
+    if order_store.created:
+        import_order_files()
+
 def ASSERT_IS_VALID_ENGINE_ORDER(order):
     ''' Check if the given order json is a valid order generated by the engine.
     '''
@@ -153,39 +243,28 @@ def ASSERT_IS_VALID_ENGINE_ORDER(order):
 def get_ltp(symbol):
     ''' Returns LTP details for symbol, in the form:
         {
-            "subscription_mode": 2,
-            "exchange_type": 1,
-            "token": "11630",
             "sequence_number": 6950681,
             "exchange_timestamp": 1714629059000,
             "last_traded_price": 36790,
-            "subscription_mode_val": "QUOTE",
-            "last_traded_quantity": 3,
-            "average_traded_price": 36653,
-            "volume_trade_for_the_day": 9745238,
-            "total_buy_quantity": 926745.0,
-            "total_sell_quantity": 1683466.0,
             "open_price_of_the_day": 36320,
             "high_price_of_the_day": 36930,
             "low_price_of_the_day": 36320,
-            "closed_price": 36320
+            "closed_price": 36320,
+            "volume_trade_for_the_day": 9745238
         }
 
-        Note: This data was added to pylive/orders/<symbol> by CandleGenerator.
+        Note: This data is updated in the LTP table (pylive/orders/ltp/ltp.table)
+              by CandleGenerator, see LTPTable.py.
     '''
-    ltp_file = os.path.join(ltp_dir, symbol)
-    try:
-        with open(ltp_file) as f:
-            ltp = json.load(f)
-    except Exception as e:
-        PYPError("Failed to open LTP file %s: %s" % (ltp_file, e))
+    ltp = ltp_table.get(symbol)
+    if ltp is None:
         #
-        # Since we create LTP file for every symbol, this shouldn't fail, but
-        # it's possible that we get some gtt/order from broker before we could
-        # get any tick for that stock, so we may not have the LTP. Since this
-        # is a temporary state, we ignore it.
+        # Since we create LTP record for every symbol, this shouldn't fail,
+        # but it's possible that we get some gtt/order from broker before we
+        # could get any tick for that stock, so we may not have the LTP.
+        # Since this is a temporary state, we ignore it.
         #
-        #ASSERT(False)
+        PYPError("No LTP found for %s in LTP table %s" % (symbol, ltp_table.path))
         return None
     return ltp
 
@@ -240,42 +319,126 @@ def get_ltp(symbol):
 #       RealBroker::engine_to_broker_orderid() and
 #       RealBroker::broker_to_engine_orderid().
 #
-def engine_orderid_to_broker_orderid(engine_orderid):
-    ''' Given an engine orderid return the corresponding broker orderid.
-        Note that every order generated by the engine is placed with the real
-        broker which then creates its own order id.
+#
+# In-memory index of the engine_orderbook.
+#
+# broker_orderid_to_engine_orderid() is called for every order and GTT in the
+# broker orderbook on every refresh_orders(), earlier every call json.load()ed
+# the engine_orderbook file and scanned it. Now the file is loaded once in
+# engine_orderbook and indexed by both engine and broker orderids, and it's
+# reloaded only when its (mtime, size, inode) changes, i.e., when the placer
+# process (see watch_generated_dir()) or anyone else updates it.
+# update_engine_orderbook() updates the loaded orderbook and the index along
+# with the file.
+#
+# Note: Both indices map to the first order with the orderid, same as the
+#       linear scan of the orders did.
+#
+engine_orderbook_file = os.path.join(placed_dir, "engine_orderbook")
+engine_orderbook = None
+engine_orderbook_stat = None
+engine_to_broker_index = {}
+broker_to_engine_index = {}
+engine_orderbook_lock = threading.Lock()
+
+def reset_engine_orderbook_lock():
+    ''' The placer process is fork()ed while the refresh thread may be
+        holding engine_orderbook_lock, start afresh in the child.
     '''
-    # engine_orderid must be an integer.
-    ASSERT(isinstance(engine_orderid, int))
-    ASSERT(re.compile('^[0-9]+$').match(engine_orderid) is not None)
+    global engine_orderbook_lock
+    engine_orderbook_lock = threading.Lock()
 
-    engine_orderbook_file = os.path.join(placed_dir, "engine_orderbook")
+os.register_at_fork(after_in_child=reset_engine_orderbook_lock)
 
-    if not os.path.exists(engine_orderbook_file):
-        PYPWarn("%s not present, while searching for engine_orderid %s" %
-                (engine_orderbook_file, engine_orderid))
+def engine_orderbook_file_stat():
+    ''' (mtime, size, inode) of engine_orderbook_file, None if not present.
+    '''
+    try:
+        st = os.stat(engine_orderbook_file)
+    except FileNotFoundError:
         return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def index_engine_orderbook():
+    ''' (Re)build the orderid indices from engine_orderbook.
+    '''
+    global engine_to_broker_index
+    global broker_to_engine_index
+
+    engine_to_broker_index = {}
+    broker_to_engine_index = {}
+    orders = engine_orderbook['orders']
+    if orders is not None:
+        for order in orders:
+            engine_to_broker_index.setdefault(order['orderid'], order)
+            broker_to_engine_index.setdefault(order['broker_orderid'], order)
+
+def load_engine_orderbook():
+    ''' Return the engine_orderbook, (re)loading it from engine_orderbook_file
+        only if the file has changed since it was last loaded.
+        Returns None if the file is not present. If it cannot be loaded, the
+        previously loaded engine_orderbook (if any) is returned.
+        Caller must hold engine_orderbook_lock.
+    '''
+    global engine_orderbook
+    global engine_orderbook_stat
+
+    stat = engine_orderbook_file_stat()
+    if stat is None:
+        engine_orderbook = None
+        engine_orderbook_stat = None
+        return None
+
+    if stat == engine_orderbook_stat:
+        return engine_orderbook
 
     try:
         with open(engine_orderbook_file) as f:
-            engine_orderbook = json.load(f)
+            orderbook = json.load(f)
     except Exception as e:
-        PYPError("Failed to open %s, while searching for engine_orderid %s: %s" %
-                (engine_orderbook_file, engine_orderid, e))
-        return None
+        #
+        # Most likely we caught it while it's being rewritten, use what we
+        # have, we will retry the next time as engine_orderbook_stat is not
+        # updated.
+        #
+        PYPError("Failed to load %s: %s" % (engine_orderbook_file, e))
+        return engine_orderbook
 
     # engine_orderbook MUST have a valid timestamp, in the past.
-    ASSERT(pd.Timestamp(engine_orderbook['timestamp'], unit='s') <= pd.Timestamp.now())
+    ASSERT(pd.Timestamp(orderbook['timestamp'], unit='s') <= pd.Timestamp.now())
 
-    orders = engine_orderbook['orders']
-    if orders is not None:
-        for order in orders:
-            ASSERT_IS_VALID_ENGINE_ORDER(order)
-            if engine_orderid == order['orderid']:
-                PYPInfo("[E2B orderid] %s -> %s (broker_action=%s)" %
-                        (engine_orderid, order['broker_orderid'],
-                         order['broker_action']))
-                return order['broker_orderid']
+    engine_orderbook = orderbook
+    engine_orderbook_stat = stat
+    index_engine_orderbook()
+
+    PYPInfo("Loaded %s with %d orders" %
+            (engine_orderbook_file,
+             len(orderbook['orders']) if orderbook['orders'] is not None else 0))
+    return engine_orderbook
+
+def engine_orderid_to_broker_orderid(engine_orderid):
+    ''' Given an engine orderid return the corresponding broker orderid.
+        Note that every order generated by the engine is placed with the real
+        broker which then creates its own order id.
+    '''
+    # engine_orderid must be an integer.
+    ASSERT(isinstance(engine_orderid, int))
+    ASSERT(re.compile('^[0-9]+$').match(engine_orderid) is not None)
+
+    with engine_orderbook_lock:
+        if load_engine_orderbook() is None:
+            PYPWarn("%s not loaded, while searching for engine_orderid %s" %
+                    (engine_orderbook_file, engine_orderid))
+            return None
+
+        order = engine_to_broker_index.get(engine_orderid)
+
+    if order is not None:
+        ASSERT_IS_VALID_ENGINE_ORDER(order)
+        PYPInfo("[E2B orderid] %s -> %s (broker_action=%s)" %
+                (engine_orderid, order['broker_orderid'],
+                 order['broker_action']))
+        return order['broker_orderid']
 
     PYPError("Did not find engine_orderid %s in %s" %
             (engine_orderid, engine_orderbook_file))
@@ -288,43 +451,28 @@ def broker_orderid_to_engine_orderid(broker_orderid):
     '''
     ASSERT(isinstance(broker_orderid, str))
 
-    engine_orderbook_file = os.path.join(placed_dir, "engine_orderbook")
+    with engine_orderbook_lock:
+        if load_engine_orderbook() is None:
+            PYPWarn("%s not loaded, while searching for broker_orderid %s" %
+                    (engine_orderbook_file, broker_orderid))
+            return None
 
-    if not os.path.exists(engine_orderbook_file):
-        PYPWarn("%s not present, while searching for broker_orderid %s" %
-                (engine_orderbook_file, broker_orderid))
-        return None
+        order = broker_to_engine_index.get(broker_orderid)
 
-    try:
-        with open(engine_orderbook_file) as f:
-            engine_orderbook = json.load(f)
-    except Exception as e:
-        PYPError("Failed to open %s, while searching for broker_orderid %s: %s" %
-                (engine_orderbook_file, broker_orderid, e))
-        return None
-
-    # engine_orderbook MUST have a valid timestamp, in the past.
-    ASSERT(pd.Timestamp(engine_orderbook['timestamp'], unit='s') <= pd.Timestamp.now())
-
-    orders = engine_orderbook['orders']
-    if orders is not None:
-        for order in orders:
-            #
-            # XXX
-            # This assert is commented because orders added to engine
-            # orderbook don't meet all the invariants of an order generated by
-            # engine, f.e., for cancelled orders we may have the triggerprice
-            # if the original order had it, this is because we mark the
-            # existing orders as cancelled in the engine orderbook. Contrast
-            # this with cancel orders generated by the engine which won't have
-            # triggerprice or price.
-            #
-            #ASSERT_IS_VALID_ENGINE_ORDER(order)
-            if broker_orderid == order['broker_orderid']:
-                PYPInfo("[B2E orderid] %s -> %s (broker_action=%s)" %
-                        (broker_orderid, str(order['orderid']),
-                         order['broker_action']))
-                return str(order['orderid'])
+    #
+    # XXX
+    # ASSERT_IS_VALID_ENGINE_ORDER() is not called because orders added to
+    # engine orderbook don't meet all the invariants of an order generated by
+    # engine, f.e., for cancelled orders we may have the triggerprice if the
+    # original order had it, this is because we mark the existing orders as
+    # cancelled in the engine orderbook. Contrast this with cancel orders
+    # generated by the engine which won't have triggerprice or price.
+    #
+    if order is not None:
+        PYPInfo("[B2E orderid] %s -> %s (broker_action=%s)" %
+                (broker_orderid, str(order['orderid']),
+                 order['broker_action']))
+        return str(order['orderid'])
 
     PYPError("Did not find broker_orderid %s in %s" %
             (broker_orderid, engine_orderbook_file))
@@ -337,7 +485,6 @@ def create_empty_engine_orderbook():
         can place an inotify watch on it. Later when engine places an order we update
         engine_orderbook file and engine will get notified.
     '''
-    engine_orderbook_file = os.path.join(placed_dir, "engine_orderbook")
     if os.path.exists(engine_orderbook_file):
         PYPPass("%s already present, not creating!" % (engine_orderbook_file));
         return
@@ -345,17 +492,17 @@ def create_empty_engine_orderbook():
     #
     # Create engine_orderbook json file with empty orders array.
     #
-    engine_orderbook = {"orders": []}
-    engine_orderbook["timestamp"] = pd.Timestamp.now().timestamp()
+    empty_orderbook = {"orders": []}
+    empty_orderbook["timestamp"] = pd.Timestamp.now().timestamp()
 
     try:
         with open(engine_orderbook_file, 'w') as f:
-            json.dump(engine_orderbook, f, indent=4)
+            json.dump(empty_orderbook, f, indent=4)
             PYPPass("Created empty %s with no orders:\n%s" %
-                    (engine_orderbook_file, json.dumps(engine_orderbook, indent=4)))
+                    (engine_orderbook_file, json.dumps(empty_orderbook, indent=4)))
     except Exception as e:
         PYPError("Failed to create %s:\n%s" %
-                 (engine_orderbook_file, json.dumps(engine_orderbook, indent=4)))
+                 (engine_orderbook_file, json.dumps(empty_orderbook, indent=4)))
         #
         # Treat this as fatal as engine will fail to start w/o this file.
         #
@@ -393,30 +540,32 @@ def update_engine_orderbook(order):
     ASSERT("broker_timestamp" in order)
     ASSERT("broker_uniqueorderid" in order)
 
-    engine_orderbook_file = os.path.join(placed_dir, "engine_orderbook")
+    with engine_orderbook_lock:
+        _update_engine_orderbook(order)
+
+def _update_engine_orderbook(order):
+    ''' update_engine_orderbook() with engine_orderbook_lock held.
+        The in-memory engine_orderbook and its indices are updated along with
+        the file.
+    '''
+    global engine_orderbook
+    global engine_orderbook_stat
+
     if os.path.exists(engine_orderbook_file):
-        try:
-            with open(engine_orderbook_file) as f:
-                engine_orderbook = json.load(f)
-                # We should not have an empty engine orderbook.
-                ASSERT(len(engine_orderbook["orders"]) > 0)
-        except Exception as e:
-            PYPError("Failed to open %s: %s" % (engine_orderbook_file, e))
+        if load_engine_orderbook() is None:
+            PYPError("Failed to load %s" % engine_orderbook_file)
             return
+        # We should not have an empty engine orderbook.
+        ASSERT(len(engine_orderbook["orders"]) > 0)
     else:
         engine_orderbook = {"orders": []}
+        index_engine_orderbook()
 
     #
     # Check engine_orderbook to see if order already exists.
     # We expect the order to be present (only) in case it's a cancel/modify order.
     #
-    existing_order = None
-    for o in engine_orderbook["orders"]:
-        ASSERT(isinstance(o['broker_orderid'], str))
-        ASSERT(len(o['broker_orderid']) > 0)
-        if o['broker_orderid'] == order['broker_orderid']:
-            existing_order = o
-            break
+    existing_order = broker_to_engine_index.get(order['broker_orderid'])
 
     if order['action'] == "create":
         ASSERT(order['broker_action'] == "placed")
@@ -439,6 +588,8 @@ def update_engine_orderbook(order):
         # Add the new order.
         engine_orderbook["orders"] += [order]
         engine_orderbook["timestamp"] = pd.Timestamp.now().timestamp()
+        engine_to_broker_index.setdefault(order['orderid'], order)
+        broker_to_engine_index.setdefault(order['broker_orderid'], order)
         PYPPass("Adding newly placed order to engine orderbook, total now %d: %s" %
                 (len(engine_orderbook["orders"]), json.dumps(order, indent=4)))
     elif order['action'] == "cancel":
@@ -487,14 +638,21 @@ def update_engine_orderbook(order):
     #
     # Now dump the updated engine_orderbook.
     #
+    # Note: It's rewritten in place and not by renaming a temporary file over
+    #       it, as engine has an inotify watch on this file. Readers that
+    #       catch it half written retry, see load_engine_orderbook().
+    #
+    data = json.dumps(engine_orderbook, indent=4)
     try:
         with open(engine_orderbook_file, 'w') as f:
-            json.dump(engine_orderbook, f, indent=4)
-            PYPPass("Updated %s is:\n%s" %
-                    (engine_orderbook_file, json.dumps(engine_orderbook, indent=4)))
+            f.write(data)
+        # Our own update, don't reload it.
+        engine_orderbook_stat = engine_orderbook_file_stat()
+        PYPPass("Updated %s is:\n%s" % (engine_orderbook_file, data))
     except Exception as e:
-        PYPError("Failed to update %s:\n%s" %
-                (engine_orderbook_file, json.dumps(engine_orderbook, indent=4)))
+        # In-memory copy no longer matches the file, reload it next time.
+        engine_orderbook_stat = None
+        PYPError("Failed to update %s:\n%s" % (engine_orderbook_file, data))
         return
 
 def process_all_generated_orders():
@@ -526,6 +684,39 @@ def process_all_generated_orders():
     for order in orders:
         process_generated_order(order)
 
+def squareoff_candidates(orders):
+    ''' Return the ROBO orders, from the given broker orders, that must be
+        squared off.
+    '''
+    candidates = []
+    for order in orders:
+        #
+        # We can only squareoff ROBO orders.
+        #
+        if not broker.is_robo_main_order(order):
+            continue
+
+        #
+        # TODO: Check for more orderstatus.
+        #
+        if order['orderstatus'] == 'cancelled':
+            PYPWarn("[auto-squareoff] Ignoring cancelled ROBO order: %s" %
+                    json.dumps(order))
+            continue
+
+        #
+        # If not cancelled, the ROBO order must only be in one of the
+        # following states:
+        # 1. open       -> The order didn't meet the limit price hence didn't
+        #                  enter.
+        # 2. complete   -> The order is either partially or fully completed
+        #
+        ASSERT((order['orderstatus'] == "open") or
+               (order['orderstatus'] == "complete"))
+
+        candidates.append(order)
+    return candidates
+
 def squareoff_all_open_intraday_orders():
     ''' This must be called at 03:05PM to squareoff all open intraday orders to
         avoid auto-squareoff charges from broker (which squares off at 03:10PM).
@@ -535,15 +726,23 @@ def squareoff_all_open_intraday_orders():
         from the latest broker orderbook and not from our saved orderbook so that
         we can even squareoff orders not created by engine (created externally from
         portal or app).
+
+        All the ROBO orders found in the orderbook are squared off concurrently
+        by cfg.squareoff_workers threads, the broker's rate limits are still
+        honoured by _SAFEAPI(). The ones that fail are retried, against a fresh
+        orderbook, up to cfg.squareoff_retries times. Orders are moved to the
+        correct orders/ directory only after all squareoffs are done and we log
+        the time-to-flat, i.e., the time from when we started till the last
+        squareoff returned.
     '''
+    start = time.time()
+
     orderbook = broker.get_order_book()
     if orderbook['status'] != True:
-        PYPError("[auto-squareoff] [AngelOne BUG] Failed to get order book:\n%s" %
-                json.dumps(orderbook, indent=4))
+        PYPError("[auto-squareoff] [AngelOne BUG] Failed to get order book: %s" %
+                json.dumps(orderbook))
         return
 
-    PYPInfo("[auto-squareoff] Got order book: %s" % json.dumps(orderbook, indent=4))
-
     #
     # Go over all bracket orders and auto-squareoff the BO orders which are
     # still not completed.
@@ -557,187 +756,222 @@ def squareoff_all_open_intraday_orders():
                 (len(orders) if orders is not None else "None"))
         return
 
-    for order in orders:
-        #
-        # We can only squareoff ROBO orders.
-        #
-        if not broker.is_robo_main_order(order):
-            continue
+    pending = squareoff_candidates(orders)
+    PYPInfo("[auto-squareoff] Got %d orders in order book, %d ROBO orders to squareoff" %
+            (len(orders), len(pending)))
 
-        #
-        # TODO: Check for more orderstatus.
-        #
-        if order['orderstatus'] == 'cancelled':
-            PYPWarn("[auto-squareoff] Ignoring cancelled ROBO order:\n%s" %
-                    json.dumps(order, indent=4))
-            continue
+    # broker_orderid -> (order, cancelled, squaredoff), in orderbook order.
+    results = {}
+    retries = 0
 
-        PYPInfo("[auto-squareoff] Squaring off ROBO order:\n%s" % json.dumps(order, indent=4))
-
-        #
-        # If not cancelled, the ROBO order must only be in one of the
-        # following states:
-        # 1. open       -> The order didn't meet the limit price hence didn't
-        #                  enter.
-        # 2. complete   -> The order is either partially or fully completed
-        #
-        ASSERT((order['orderstatus'] == "open") or
-               (order['orderstatus'] == "complete"))
-
-        #
-        # Both above states indicate that the order was successfully placed
-        # with the broker, hence the json file corresponding to the order
-        # would be in placed_dir.
-        #
-        # "Fully completed" orders can be already in executed_dir, move there
-        # by refresh_orders()->move_to_correct_orders_dir().
-        #
+    for attempt in range(cfg.squareoff_retries + 1):
+        if not pending:
+            break
 
-        broker_orderid = order['orderid']
+        if attempt > 0:
+            PYPWarn("[auto-squareoff] Retrying %d failed squareoff(s), attempt %d" %
+                    (len(pending), attempt))
+            retries += len(pending)
 
-        # Ask broker routine to squareoff the order.
-        cancelled, squaredoff = broker.squareoff_robo_order(broker_orderid, orderbook)
+            #
+            # Failed orders may have changed state since the last attempt,
+            # f.e., target hit, squareoff them as per the latest orderbook.
+            #
+            orderbook = broker.get_order_book()
+            if orderbook['status'] != True:
+                PYPError("[auto-squareoff] [AngelOne BUG] Failed to get order book: %s" %
+                        json.dumps(orderbook))
+                break
+            snapshot = broker.orderbook_snapshot(orderbook)
+            pending = squareoff_candidates(
+                    [snapshot.get_order(order['orderid']) for order in pending
+                     if snapshot.get_order(order['orderid']) is not None])
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(cfg.squareoff_workers, max(1, len(pending))),
+                thread_name_prefix="squareoff") as pool:
+            futures = [(order, pool.submit(broker.squareoff_robo_order, order['orderid'], orderbook))
+                       for order in pending]
+
+        pending = []
+        for order, future in futures:
+            # Ask broker routine to squareoff the order.
+            cancelled, squaredoff = future.result()
+            results[order['orderid']] = (order, cancelled, squaredoff)
+            if not (cancelled or squaredoff):
+                pending.append(order)
+
+    time_to_flat = time.time() - start
+
+    for order, cancelled, squaredoff in results.values():
+        squareoff_bookkeeping(order, cancelled, squaredoff)
+
+    outcomes = [(cancelled, squaredoff) for _, cancelled, squaredoff in results.values()]
+    PYPPass("[auto-squareoff] %d ROBO orders: %d squaredoff, %d cancelled, "
+            "%d already fully completed, %d failed, %d retries, time-to-flat %.3fs" %
+            (len(outcomes),
+             outcomes.count((False, True)),
+             outcomes.count((True, False)),
+             outcomes.count((True, True)),
+             outcomes.count((False, False)),
+             retries,
+             time_to_flat))
+
+def squareoff_bookkeeping(order, cancelled, squaredoff):
+    ''' Move the engine order corresponding to the ROBO order squared off by
+        squareoff_robo_order() to the correct orders/ directory, as per its
+        return values, cancelled and squaredoff.
+    '''
+    #
+    # The ROBO order was open or complete (see squareoff_candidates()), i.e.,
+    # it was successfully placed with the broker, hence the json file
+    # corresponding to the order would be in placed_dir.
+    #
+    # "Fully completed" orders can be already in executed_dir, move there
+    # by refresh_orders()->move_to_correct_orders_dir().
+    #
+    broker_orderid = order['orderid']
 
-        #
-        # If the ROBO order was placed outside engine then we won't have an
-        # engine_orderid and we don't need to move it around various orders/
-        # subdirectories.
-        #
-        engine_orderid = broker_orderid_to_engine_orderid(broker_orderid)
-        if engine_orderid is None:
-            PYPWarn("[WARN] Order not found in engine orders, created outside?\n%s" %
-                    (json.dumps(order, indent=4)))
-            #ASSERT(False)
-            continue
+    #
+    # If the ROBO order was placed outside engine then we won't have an
+    # engine_orderid and we don't need to move it around various orders/
+    # subdirectories.
+    #
+    engine_orderid = broker_orderid_to_engine_orderid(broker_orderid)
+    if engine_orderid is None:
+        PYPWarn("[WARN] Order not found in engine orders, created outside?\n%s" %
+                (json.dumps(order, indent=4)))
+        #ASSERT(False)
+        return
 
-        placed_file = os.path.join(placed_dir, engine_orderid)
-        partially_executed_file = os.path.join(partially_executed_dir, engine_orderid)
-        executed_file = os.path.join(executed_dir, engine_orderid)
-        squaredoff_file = os.path.join(squaredoff_dir, engine_orderid)
-        cancelled_file = os.path.join(cancelled_dir, engine_orderid)
-        failed_file = os.path.join(failed_dir, engine_orderid)
+    placed_file = os.path.join(placed_dir, engine_orderid)
+    partially_executed_file = os.path.join(partially_executed_dir, engine_orderid)
+    executed_file = os.path.join(executed_dir, engine_orderid)
+    squaredoff_file = os.path.join(squaredoff_dir, engine_orderid)
+    cancelled_file = os.path.join(cancelled_dir, engine_orderid)
+    failed_file = os.path.join(failed_dir, engine_orderid)
 
-        # Can be in at most one of the above places.
-        ASSERT((int(os.path.exists(placed_file)) +
-                int(os.path.exists(partially_executed_file)) +
-                int(os.path.exists(executed_file)) +
-                int(os.path.exists(squaredoff_file)) +
-                int(os.path.exists(failed_file))) <= 1)
+    # Can be in at most one of the above places.
+    ASSERT((int(order_is_at(placed_file)) +
+            int(order_is_at(partially_executed_file)) +
+            int(order_is_at(executed_file)) +
+            int(order_is_at(squaredoff_file)) +
+            int(order_is_at(failed_file))) <= 1)
 
-        # Cannot be in cancelled_dir since it's not already cancelled.
-        ASSERT(not os.path.exists(cancelled_file))
+    # Cannot be in cancelled_dir since it's not already cancelled.
+    ASSERT(not order_is_at(cancelled_file))
 
-        #
-        # Though we shouldn't call squareoff_all_open_intraday_orders() more
-        # than once, but we do support that and simply ignore already
-        # squaredoff orders.
-        #
-        if os.path.exists(squaredoff_file):
-            PYPWarn("[auto-squareoff] ROBO order %s already in orders/squaredoff!" %
-                    squaredoff_file)
-            # We must correctly detect that order is already fully completed.
-            ASSERT(cancelled and squaredoff)
-            continue
+    #
+    # Though we shouldn't call squareoff_all_open_intraday_orders() more
+    # than once, but we do support that and simply ignore already
+    # squaredoff orders.
+    #
+    if order_is_at(squaredoff_file):
+        PYPWarn("[auto-squareoff] ROBO order %s already in orders/squaredoff!" %
+                squaredoff_file)
+        # We must correctly detect that order is already fully completed.
+        ASSERT(cancelled and squaredoff)
+        return
 
-        #
-        # If the order was moved to failed_dir last time when we ran
-        # auto-squaroff it'll still be in failed_dir, handle that.
-        #
-        if os.path.exists(failed_file):
-            PYPWarn("[auto-squareoff] ROBO order %s already in orders/failed!" %
-                    failed_file)
-            # We must correctly detect that order is already fully completed.
-            ASSERT(cancelled and squaredoff)
-            continue
+    #
+    # If the order was moved to failed_dir last time when we ran
+    # auto-squaroff it'll still be in failed_dir, handle that.
+    #
+    if order_is_at(failed_file):
+        PYPWarn("[auto-squareoff] ROBO order %s already in orders/failed!" %
+                failed_file)
+        # We must correctly detect that order is already fully completed.
+        ASSERT(cancelled and squaredoff)
+        return
 
+    #
+    # Both cancelled and squaredoff True means that the order is already "fully
+    # completed" and no squareoff was needed.
+    #
+    if cancelled and squaredoff:
+        PYPInfo("[auto-squareoff] ROBO order already *fully completed*:\n%s" %
+                json.dumps(order, indent=4))
         #
-        # Both cancelled and squaredoff True means that the order is already "fully
-        # completed" and no squareoff was needed.
+        # Move it to executed_dir.
+        # We can have following cases:
+        # 1. It may already have been moved to executed_dir by
+        #    refresh_orders()->move_to_correct_orders_dir().
+        #    This will happen when the order was fully completed before
+        #    the last time the periodic refresh_orders() ran.
+        # 2. It may be in partially_executed_dir.
+        #    This will happen when the order was fully completed after
+        #    the last time the periodic refresh_orders() ran, but it was
+        #    partially completed before that.
+        # 3. It may be in placed_dir.
+        #    This will happen when the order was fully completed after
+        #    the last time the periodic refresh_orders() ran, and it was
+        #    not even partially completed before that.
         #
-        if cancelled and squaredoff:
-            PYPInfo("[auto-squareoff] ROBO order already *fully completed*:\n%s" %
-                    json.dumps(order, indent=4))
-            #
-            # Move it to executed_dir.
-            # We can have following cases:
-            # 1. It may already have been moved to executed_dir by
-            #    refresh_orders()->move_to_correct_orders_dir().
-            #    This will happen when the order was fully completed before
-            #    the last time the periodic refresh_orders() ran.
-            # 2. It may be in partially_executed_dir.
-            #    This will happen when the order was fully completed after
-            #    the last time the periodic refresh_orders() ran, but it was
-            #    partially completed before that.
-            # 3. It may be in placed_dir.
-            #    This will happen when the order was fully completed after
-            #    the last time the periodic refresh_orders() ran, and it was
-            #    not even partially completed before that.
-            #
-            if os.path.exists(executed_file):
-                PYPInfo("[auto-squareoff] ROBO order %s already in orders/executed!" %
-                        executed_file)
-                ASSERT(not os.path.exists(partially_executed_file))
-                ASSERT(not os.path.exists(placed_file))
-            elif os.path.exists(partially_executed_file):
-                ASSERT(not os.path.exists(placed_file))
-                try:
-                    os.rename(partially_executed_file, executed_file)
-                    PYPInfo("[PARTIALLY2FULLYEXECUTED] %s -> %s" %
-                            (partially_executed_file, executed_file))
-                except Exception as e:
-                    PYPError("[PARTIALLY2FULLYEXECUTED] Failed to rename %s -> %s: %s" %
-                            (partially_executed_file, executed_file, e))
-            elif os.path.exists(placed_file):
-                try:
-                    os.rename(placed_file, executed_file)
-                    PYPInfo("[PLACED2EXECUTED] %s -> %s" % (placed_file, executed_file))
-                except Exception as e:
-                    PYPError("[PLACED2EXECUTED] Failed to rename %s -> %s: %s" %
-                            (placed_file, executed_file, e))
-            else:
-                # Has to be in one of the above dirs.
-                ASSERT(False)
-        elif squaredoff:
-            # We squaredoff now, so cannot already be in executed_dir.
-            ASSERT(not os.path.exists(executed_file))
-            if os.path.exists(partially_executed_file):
-                ASSERT(not os.path.exists(placed_file))
-                try:
-                    os.rename(partially_executed_file, squaredoff_file)
-                    PYPInfo("[PARTIAL2SQUAREOFF] %s -> %s" %
-                            (partially_executed_file, squaredoff_file))
-                except Exception as e:
-                    PYPError("[PARTIAL2SQUAREOFF] Failed to rename %s -> %s: %s" %
-                            (partially_executed_file, squaredoff_file, e))
-            elif os.path.exists(placed_file):
-                try:
-                    os.rename(placed_file, squaredoff_file)
-                    PYPInfo("[PLACED2SQUAREDOFF] %s -> %s" %
-                            (placed_file, squaredoff_file))
-                except Exception as e:
-                    PYPError("[PLACED2SQUAREDOFF] Failed to rename %s -> %s: %s" %
-                            (placed_file, squaredoff_file, e))
-            else:
-                ASSERT(False)
-        elif cancelled:
-            #
-            # Only an open BO order can be cancelled and if it's open it
-            # cannot be in partially_executed_dir.
-            #
-            ASSERT(os.path.exists(placed_file))
+        if order_is_at(executed_file):
+            PYPInfo("[auto-squareoff] ROBO order %s already in orders/executed!" %
+                    executed_file)
+            ASSERT(not order_is_at(partially_executed_file))
+            ASSERT(not order_is_at(placed_file))
+        elif order_is_at(partially_executed_file):
+            ASSERT(not order_is_at(placed_file))
             try:
-                os.rename(placed_file, cancelled_file)
-                PYPInfo("[PLACED2CANCELLED] %s -> %s" % (placed_file, cancelled_file))
+                move_order(partially_executed_file, executed_file)
+                PYPInfo("[PARTIALLY2FULLYEXECUTED] %s -> %s" %
+                        (partially_executed_file, executed_file))
             except Exception as e:
-                PYPError("[PLACED2CANCELLED] Failed to rename %s -> %s: %s" %
-                        (placed_file, cancelled_file, e))
+                PYPError("[PARTIALLY2FULLYEXECUTED] Failed to rename %s -> %s: %s" %
+                        (partially_executed_file, executed_file, e))
+        elif order_is_at(placed_file):
+            try:
+                move_order(placed_file, executed_file)
+                PYPInfo("[PLACED2EXECUTED] %s -> %s" % (placed_file, executed_file))
+            except Exception as e:
+                PYPError("[PLACED2EXECUTED] Failed to rename %s -> %s: %s" %
+                        (placed_file, executed_file, e))
         else:
+            # Has to be in one of the above dirs.
+            ASSERT(False)
+    elif squaredoff:
+        # We squaredoff now, so cannot already be in executed_dir.
+        ASSERT(not order_is_at(executed_file))
+        if order_is_at(partially_executed_file):
+            ASSERT(not order_is_at(placed_file))
             try:
-                os.rename(placed_file, failed_file)
-                PYPInfo("[PLACED2FAILED] %s -> %s" % (placed_file, failed_file))
+                move_order(partially_executed_file, squaredoff_file)
+                PYPInfo("[PARTIAL2SQUAREOFF] %s -> %s" %
+                        (partially_executed_file, squaredoff_file))
             except Exception as e:
-                PYPError("[PLACED2FAILED] Failed to rename %s -> %s: %s" %
-                        (placed_file, failed_file, e))
+                PYPError("[PARTIAL2SQUAREOFF] Failed to rename %s -> %s: %s" %
+                        (partially_executed_file, squaredoff_file, e))
+        elif order_is_at(placed_file):
+            try:
+                move_order(placed_file, squaredoff_file)
+                PYPInfo("[PLACED2SQUAREDOFF] %s -> %s" %
+                        (placed_file, squaredoff_file))
+            except Exception as e:
+                PYPError("[PLACED2SQUAREDOFF] Failed to rename %s -> %s: %s" %
+                        (placed_file, squaredoff_file, e))
+        else:
+            ASSERT(False)
+    elif cancelled:
+        #
+        # Only an open BO order can be cancelled and if it's open it
+        # cannot be in partially_executed_dir.
+        #
+        ASSERT(order_is_at(placed_file))
+        try:
+            move_order(placed_file, cancelled_file)
+            PYPInfo("[PLACED2CANCELLED] %s -> %s" % (placed_file, cancelled_file))
+        except Exception as e:
+            PYPError("[PLACED2CANCELLED] Failed to rename %s -> %s: %s" %
+                    (placed_file, cancelled_file, e))
+    else:
+        try:
+            move_order(placed_file, failed_file)
+            PYPInfo("[PLACED2FAILED] %s -> %s" % (placed_file, failed_file))
+        except Exception as e:
+            PYPError("[PLACED2FAILED] Failed to rename %s -> %s: %s" %
+                    (placed_file, failed_file, e))
 
 def update_json(json_file, add_dict):
     ''' Given the path to a json file (which contains an engine order object), read
@@ -760,6 +994,7 @@ def update_json(json_file, add_dict):
         # Write updated.
         with open(json_file, 'w') as f:
             json.dump(order, f, indent=4)
+        order_store.update_order(order)
 
         PYPPass("Updated %s is:\n%s" % (json_file, json.dumps(order, indent=4)))
 
@@ -772,35 +1007,122 @@ def update_json(json_file, add_dict):
     except Exception as e:
         PYPError("update_json(%s, %s) failed: %s" % (json_file, add_dict, e))
 
-def process_generated_order(orderid):
+#
+# Order placement fast path.
+#
+# When engine drops an order in orders/generated, the placer process used to
+# handle it end to end in the inotify thread, i.e., place it with the broker
+# and then do all the bookkeeping (rename to orders/placed, update_json(),
+# engine_orderbook update) before it could look at the next order.
+# Now the inotify thread only does what must be done before the order can be
+# placed (the rename to orders/placing which guards against placing an order
+# twice, parsing and validation, see process_generated_order()) and hands the
+# order to one of cfg.placer_workers placer threads which places it with the
+# broker. All orders for a symbol go to the same placer thread so they are
+# placed in the order engine generated them, while orders for different
+# symbols are placed concurrently. Once the broker acks, the order is handed
+# to the bookkeeper thread which does the rest, in the order of the acks.
+#
+# Every order's timeline, i.e., generated (mtime of the order file), inotify
+# event, parsed, broker ack and persisted, is logged once it's persisted, see
+# log_order_timing().
+#
+# When idle for cfg.placer_keepalive_secs the first placer thread makes a
+# cheap broker call (see broker.warmup()) so that the next order doesn't pay
+# for setting up the connection to the broker.
+#
+placer_queues = []
+bookkeeper_q = queue.Queue(maxsize=0)
+bookkeeper_thread = None
+
+def log_order_timing(order, timing):
+    ''' Log the timeline of order, recorded in timing, in ms.
+    '''
+    PYPInfo("[ORDER-TIMING] %s %s %s: generated->event %.1fms, event->parsed %.1fms, "
+            "parsed->ack %.1fms, ack->persisted %.1fms, event->persisted %.1fms" %
+            (order['orderid'], order['action'], order.get('tradingsymbol', ""),
+             (timing["event"] - timing["generated"]) * 1000,
+             (timing["parsed"] - timing["event"]) * 1000,
+             (timing["ack"] - timing["parsed"]) * 1000,
+             (timing["persisted"] - timing["ack"]) * 1000,
+             (timing["persisted"] - timing["event"]) * 1000))
+
+def dispatch_generated_order(order, placing_file, timing):
+    ''' Hand the validated order to the placer thread for its symbol, or
+        place it right here if the placer threads are not running.
+    '''
+    if not placer_queues:
+        place_generated_order(order, placing_file, timing)
+        return
+
+    index = token_partition(order.get('tradingsymbol', ""), len(placer_queues))
+    placer_queues[index].put((order, placing_file, timing))
+
+def placer(index):
+    ''' Placer thread, places the orders queued by dispatch_generated_order().
+    '''
+    PYPInfo("OrderPlacer: placer %d started" % index)
+    q = placer_queues[index]
+    while True:
+        try:
+            # Only the first placer keeps the connection warm.
+            item = q.get(timeout=(cfg.placer_keepalive_secs if index == 0 else None))
+        except queue.Empty:
+            broker.warmup()
+            continue
+        place_generated_order(*item)
+
+def bookkeeper():
+    ''' Bookkeeper thread, completes the orders placed by the placer threads.
+    '''
+    PYPInfo("OrderPlacer: bookkeeper started")
+    while True:
+        complete_generated_order(*bookkeeper_q.get())
+
+def start_placers():
+    ''' Start the placer and bookkeeper threads. Called in the placer process.
+    '''
+    global bookkeeper_thread
+    bookkeeper_thread = threading.Thread(target=bookkeeper, args=(), daemon=False)
+    bookkeeper_thread.start()
+
+    for index in range(cfg.placer_workers):
+        placer_queues.append(queue.Queue(maxsize=0))
+    for index in range(cfg.placer_workers):
+        threading.Thread(target=placer, args=(index,), daemon=False).start()
+
+def process_generated_order(orderid, event_time=None):
     ''' Process given order from generated_dir.
+        This validates the order and moves it to placing_dir, the order is then
+        placed by place_generated_order() and completed by
+        complete_generated_order(), see dispatch_generated_order().
+        event_time is when we got the inotify event for the order.
 
         XXX This is not entirely broker agnostic and has dependency on AngelOne.
     '''
     PYPInfo("process_generated_order(%s)" % orderid)
 
+    timing = {"event": event_time if event_time is not None else time.time()}
+
     # Absolute pathname of the order file.
     generated_file = os.path.join(generated_dir, orderid)
 
     # Generated order MUST be present in generated_dir.
-    ASSERT(os.path.exists(generated_file))
+    try:
+        timing["generated"] = os.stat(generated_file).st_mtime
+    except FileNotFoundError:
+        ASSERT(False)
 
-    # MUST NOT be present in any other dir.
     placing_file = os.path.join(placing_dir, orderid)
-    placed_file = os.path.join(placed_dir, orderid)
-    partially_executed_file = os.path.join(partially_executed_dir, orderid)
-    executed_file = os.path.join(executed_dir, orderid)
-    squaredoff_file = os.path.join(squaredoff_dir, orderid)
-    cancelled_file = os.path.join(cancelled_dir, orderid)
-    failed_file = os.path.join(failed_dir, orderid)
 
-    ASSERT(not os.path.exists(placing_file));
-    ASSERT(not os.path.exists(placed_file));
-    ASSERT(not os.path.exists(partially_executed_file));
-    ASSERT(not os.path.exists(executed_file));
-    ASSERT(not os.path.exists(squaredoff_file));
-    ASSERT(not os.path.exists(cancelled_file));
-    ASSERT(not os.path.exists(failed_file));
+    #
+    # MUST NOT be in any other state.
+    # Orders generated while we were not running were imported as generated,
+    # see import_order_files().
+    #
+    state = order_store.get_state(orderid)
+    ASSERT(state is None or state == "generated",
+           "Generated order %s is already %s" % (orderid, state))
 
     #
     # Move the order to a temporary holding dir before placing the order with
@@ -814,7 +1136,7 @@ def process_generated_order(orderid):
     # if it's in failed_dir order placement failed.
     #
     try:
-        os.rename(generated_file, placing_file)
+        move_order(generated_file, placing_file)
         PYPInfo("[GEN2PLACING] %s -> %s" % (generated_file, placing_file))
     except Exception as e:
         PYPError("[GEN2PLACING] Failed to rename %s -> %s: %s" %
@@ -837,7 +1159,11 @@ def process_generated_order(orderid):
         ASSERT(False)
         return
 
-    PYPInfo("Got generated order: %s" % json.dumps(order, indent=4))
+    #
+    # Logged in full once placed, see update_json(), don't spend time on
+    # pretty printing before the order is placed.
+    #
+    PYPInfo("Got generated order: %s" % json.dumps(order))
 
     ASSERT_IS_VALID_ENGINE_ORDER(order)
     # Filename must match the orderid member.
@@ -857,6 +1183,15 @@ def process_generated_order(orderid):
            (order["producttype"] == "BO") or
            (order["producttype"] == "GTT"))
 
+    order_store.update_order(order)
+
+    timing["parsed"] = time.time()
+    dispatch_generated_order(order, placing_file, timing)
+
+def place_generated_order(order, placing_file, timing):
+    ''' Place the order (validated by process_generated_order()) with the
+        broker and hand it to complete_generated_order().
+    '''
     #
     # Place order with broker.
     # We only support the following orders:
@@ -909,6 +1244,32 @@ def process_generated_order(orderid):
         else:
             order_response = broker.place_order(order)
 
+    timing["ack"] = time.time()
+    if bookkeeper_thread is not None:
+        bookkeeper_q.put((order, order_response, placing_file, timing))
+    else:
+        complete_generated_order(order, order_response, placing_file, timing)
+
+def complete_generated_order(order, order_response, placing_file, timing):
+    ''' Move the order placed by place_generated_order() to the correct
+        orders/ directory, as per order_response, and update it (and the
+        engine_orderbook) with the broker details.
+    '''
+    _complete_generated_order(order, order_response, placing_file)
+    timing["persisted"] = time.time()
+    log_order_timing(order, timing)
+
+def _complete_generated_order(order, order_response, placing_file):
+    orderid = str(order['orderid'])
+    placed_file = os.path.join(placed_dir, orderid)
+    cancelled_file = os.path.join(cancelled_dir, orderid)
+    failed_file = os.path.join(failed_dir, orderid)
+
+    is_gtt_order = (order["producttype"] == "GTT")
+    is_delivery_order = (order["producttype"] == "DELIVERY")
+    is_modify_order = (order['action'] == "modify")
+    is_cancel_order = (order['action'] == "cancel")
+
     #
     # Order placement failed, move it to failed_dir and return.
     #
@@ -919,7 +1280,7 @@ def process_generated_order(orderid):
                   "GTT " if is_gtt_order else ("DELIVERY " if is_delivery_order else ""),
                   placing_file))
         try:
-            os.rename(placing_file, failed_file)
+            move_order(placing_file, failed_file)
             PYPInfo("[PLACING2FAILED] %s -> %s" % (placing_file, failed_file))
         except Exception as e:
             PYPError("[PLACING2FAILED] Failed to rename %s -> %s: %s" %
@@ -953,7 +1314,7 @@ def process_generated_order(orderid):
 
     if is_cancel_order:
         try:
-            os.rename(placing_file, cancelled_file)
+            move_order(placing_file, cancelled_file)
             PYPInfo("[PLACING2CANCELLED] %s -> %s" % (placing_file, cancelled_file))
 
             #
@@ -982,7 +1343,7 @@ def process_generated_order(orderid):
             return
     else: # create or modify order.
         try:
-            os.rename(placing_file, placed_file)
+            move_order(placing_file, placed_file)
             PYPInfo("[PLACING2PLACED] %s -> %s" % (placing_file, placed_file))
 
             #
@@ -1032,30 +1393,37 @@ def cleanup_orders():
 
     #
     # Cleanup orders addressed with engine orderid.
-    # All these directories have orders stored as engine orderid.
+    # All these directories have orders stored as engine orderid, we find them
+    # from order_store.
     #
-    for d in [generated_dir, placing_dir, placed_dir, cancelled_dir, failed_dir,
-              executed_dir, partially_executed_dir, squaredoff_dir]:
-        order_files = os.listdir(d)
-        PYPLog('Files found in %s: %s' % (d, order_files))
+    market_start = get_same_day_market_start(
+            pd.Timestamp.now()).tz_localize('Asia/Kolkata').timestamp()
 
-        # Filter probable order jsons.
-        regex = re.compile('^[0-9]+$')
-        order_files = list(filter(regex.search, order_files))
+    for row in order_store.get_orders(states=list(ORDER_STATE_DIRS.keys())):
+        engine_orderid = row['engine_orderid']
+        d = ORDER_STATE_DIRS[row['state']]
+        file_path = os.path.join(d, engine_orderid)
 
-        for order_file in order_files:
-            file_path = os.path.join(d, order_file)
+        # Don't cleanup orders created today.
+        if row['modified'] >= market_start:
+            continue
 
-            # Don't cleanup orders created today.
-            if file_updated_after_market_start(file_path):
-                continue
+        # Orders known only by their state don't have producttype.
+        if row['producttype'] is not None:
+            delivery_order = (row['producttype'] in ("DELIVERY", "GTT"))
+        else:
+            delivery_order = os.path.exists(file_path) and is_delivery_order(file_path)
 
-            if int(order_file) > MIN_ORDERID and is_delivery_order(file_path):
-                continue
+        if int(engine_orderid) > MIN_ORDERID and delivery_order:
+            continue
 
-            old_path = os.path.join(d, "old", order_file)
-            os.rename(file_path, old_path)
+        old_path = os.path.join(d, "old", engine_orderid)
+        try:
+            move_order(file_path, old_path)
             PYPWarn("[cleanup_orders] %s -> %s" % (file_path, old_path))
+        except Exception as e:
+            PYPError("[cleanup_orders] Failed to rename %s -> %s: %s" %
+                     (file_path, old_path, e))
 
     #
     # Cleanup orders addressed with broker orderid.
@@ -1139,10 +1507,18 @@ def watch_generated_dir():
     #
     cleanup_orders()
 
+    #
+    # Placer threads place the orders, warm up the broker connection for the
+    # first order.
+    #
+    start_placers()
+    broker.warmup()
+
     PYPInfo('OrderPlacer: Runner, watching dir %s' % generated_dir)
 
     # Sit here fishing inotify events.
     for event in inotify_adapter.event_gen(yield_nones=False):
+        event_time = time.time()
         (_, type_names, path, filename) = event
 
         ASSERT(path == generated_dir)
@@ -1184,7 +1560,7 @@ def watch_generated_dir():
         if int(filename) == squareoff_orderid:
             squareoff_all_open_intraday_orders()
         else:
-            process_generated_order(filename)
+            process_generated_order(filename, event_time)
 
 def move_to_correct_orders_dir(order, orderbook):
     ''' Given 'order' from orderbook periodically fetched from broker, check whether
@@ -1244,40 +1620,40 @@ def move_to_correct_orders_dir(order, orderbook):
         is_triggered = (order['status'] == "SENTTOEXCHANGE")
         if is_cancelled:
             # Once triggered, cannot be cancelled.
-            ASSERT(not os.path.exists(executed_file))
+            ASSERT(not order_is_at(executed_file))
 
             #
             # Cancelled GTT order, we have following possibilities:
             # 1. It is already present in cancelled_dir.
             # 2. It is present in placed dir.
             #
-            if os.path.exists(cancelled_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(cancelled_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
             try:
-                os.rename(placed_file, cancelled_file)
+                move_order(placed_file, cancelled_file)
                 PYPInfo("[PLACED2CANCELLED] %s -> %s" % (placed_file, cancelled_file))
             except Exception as e:
                 PYPError("[PLACED2CANCELLED] Failed to rename %s -> %s: %s" %
                         (placed_file, cancelled_file, e))
         elif is_triggered:
             # Cancelled GTT cannot be triggered.
-            ASSERT(not os.path.exists(cancelled_file))
+            ASSERT(not order_is_at(cancelled_file))
 
             #
             # Triggered GTT order, we have following possibilities:
             # 1. It is already present in executed_dir.
             # 2. It is present in placed dir.
             #
-            if os.path.exists(executed_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(executed_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
             try:
-                os.rename(placed_file, executed_file)
+                move_order(placed_file, executed_file)
                 PYPInfo("[PLACED2EXECUTED] %s -> %s" % (placed_file, executed_file))
             except Exception as e:
                 PYPError("[PLACED2EXECUTED] Failed to rename %s -> %s: %s" %
@@ -1301,14 +1677,14 @@ def move_to_correct_orders_dir(order, orderbook):
             #       completes) or it can be auto-squaredoff in which case the
             #       main order's orderstatus will be "complete".
             #
-            ASSERT(not os.path.exists(pe_file))
-            ASSERT(not os.path.exists(fe_file))
+            ASSERT(not order_is_at(pe_file))
+            ASSERT(not order_is_at(fe_file))
 
-            if os.path.exists(cancelled_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(cancelled_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
             try:
                 #
                 # TODO: When we move the order to cancelled_dir, we must also
@@ -1318,7 +1694,7 @@ def move_to_correct_orders_dir(order, orderbook):
                 #       This has to be done for all order types and
                 #       transitions.
                 #
-                os.rename(placed_file, cancelled_file)
+                move_order(placed_file, cancelled_file)
                 PYPInfo("[PLACED2CANCELLED] %s -> %s" % (placed_file, cancelled_file))
             except Exception as e:
                 PYPError("[PLACED2CANCELLED] Failed to rename %s -> %s: %s" %
@@ -1330,25 +1706,25 @@ def move_to_correct_orders_dir(order, orderbook):
             # 2. It is present in partially executed dir.
             # 3. It is present in placed dir.
             #
-            if os.path.exists(fe_file):
-                ASSERT(not os.path.exists(pe_file))
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(fe_file):
+                ASSERT(not order_is_at(pe_file))
+                ASSERT(not order_is_at(placed_file))
                 return
 
             # partial -> fully executed.
-            if os.path.exists(pe_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(pe_file):
+                ASSERT(not order_is_at(placed_file))
                 try:
-                    os.rename(pe_file, fe_file)
+                    move_order(pe_file, fe_file)
                     PYPInfo("[PARTIALLY2FULLYEXECUTED] %s -> %s" % (pe_file, fe_file))
                 except Exception as e:
                     PYPError("[PARTIALLY2FULLYEXECUTED] Failed to rename %s -> %s: %s" %
                             (pe_file, fe_file, e))
             else:
                 # placed -> fully executed.
-                ASSERT(os.path.exists(placed_file))
+                ASSERT(order_is_at(placed_file))
                 try:
-                    os.rename(placed_file, fe_file)
+                    move_order(placed_file, fe_file)
                     PYPInfo("[PLACED2FULLYEXECUTED] %s -> %s" % (placed_file, fe_file))
                 except Exception as e:
                     PYPError("[PLACED2FULLYEXECUTED] Failed to rename %s -> %s: %s" %
@@ -1359,16 +1735,16 @@ def move_to_correct_orders_dir(order, orderbook):
             # 1. It is already present in partially executed dir.
             # 2. It is present in placed dir.
             #
-            ASSERT(not os.path.exists(fe_file))
-            if os.path.exists(pe_file):
-                ASSERT(not os.path.exists(placed_file))
+            ASSERT(not order_is_at(fe_file))
+            if order_is_at(pe_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
 
             # placed -> partially executed.
             try:
-                os.rename(placed_file, pe_file)
+                move_order(placed_file, pe_file)
                 PYPInfo("[PLACED2PARTIALLYEXECUTED] %s -> %s" % (placed_file, pe_file))
             except Exception as e:
                 PYPError("[PLACED2PARTIALLYEXECUTED] Failed to rename %s -> %s: %s" %
@@ -1376,28 +1752,28 @@ def move_to_correct_orders_dir(order, orderbook):
     elif order['producttype'] == "DELIVERY": # DELIVERY
         if order['orderstatus'] == "complete":
             # Cancelled order cannot complete.
-            ASSERT(not os.path.exists(cancelled_file))
+            ASSERT(not order_is_at(cancelled_file))
 
             #
             # Completed delivery order, we have following possibilities:
             # 1. It is already present in executed dir.
             # 2. It is present in placed dir.
             #
-            if os.path.exists(executed_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(executed_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
             # placed -> executed.
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
             try:
-                os.rename(placed_file, executed_file)
+                move_order(placed_file, executed_file)
                 PYPInfo("[PLACED2EXECUTED] %s -> %s" % (placed_file, executed_file))
             except Exception as e:
                 PYPError("[PLACED2EXECUTED] Failed to rename %s -> %s: %s" %
                         (placed_file, executed_file, e))
         elif order['orderstatus'] == "cancelled":
             # Executed order cannot be cancelled.
-            ASSERT(not os.path.exists(executed_file))
+            ASSERT(not order_is_at(executed_file))
 
             #
             # Cancelled delivery order, we have following possibilities:
@@ -1407,14 +1783,14 @@ def move_to_correct_orders_dir(order, orderbook):
             # Note: Only an "open" delivery order can be cancelled.
             #       Once it completes it cannot be cancelled.
             #
-            if os.path.exists(cancelled_file):
-                ASSERT(not os.path.exists(placed_file))
+            if order_is_at(cancelled_file):
+                ASSERT(not order_is_at(placed_file))
                 return
 
             # placed -> cancelled.
-            ASSERT(os.path.exists(placed_file))
+            ASSERT(order_is_at(placed_file))
             try:
-                os.rename(placed_file, cancelled_file)
+                move_order(placed_file, cancelled_file)
                 PYPInfo("[PLACED2CANCELLED] %s -> %s" % (placed_file, cancelled_file))
             except Exception as e:
                 PYPError("[PLACED2CANCELLED] Failed to rename %s -> %s: %s" %
@@ -1428,7 +1804,53 @@ def move_to_correct_orders_dir(order, orderbook):
         #
         ASSERT(broker.is_robo_sub_order(order))
 
-def refresh_portfolio():
+#
+# Concurrent broker fetches.
+#
+# refresh_portfolio() and refresh_orders() used to call the broker APIs one
+# after the other, each of which may get stuck in _SAFEAPI() retries, so a
+# full refresh took as long as all of them put together. Now they are issued
+# together from fetch_pool (the broker spaces calls to the same endpoint as
+# per its rate limits) and the results are collected in one snapshot dict, so
+# a refresh takes as long as the slowest call.
+#
+BROKER_FETCHES = {
+    "profile": broker.get_profile,
+    "funds": broker.get_funds,
+    "holdings": broker.get_holdings,
+    "positions": broker.get_positions,
+    "orderbook": broker.get_order_book,
+    "tradebook": broker.get_trade_book,
+    "gttlist": broker.get_gtt_list,
+}
+ORDER_FETCHES = ("orderbook", "tradebook", "gttlist")
+fetch_pool = concurrent.futures.ThreadPoolExecutor(max_workers=len(BROKER_FETCHES),
+                                                   thread_name_prefix="broker-fetch")
+
+def portfolio_fetches():
+    ''' Fetches needed by refresh_portfolio().
+    '''
+    fetches = ("funds", "holdings", "positions")
+    # Profile needs to be fetched only once.
+    if not profileFetched:
+        fetches = ("profile",) + fetches
+    return fetches
+
+def fetch_from_broker(names):
+    ''' Fetch names (keys of BROKER_FETCHES) from the broker concurrently.
+        Returns the snapshot dict with the result of every fetch (None if
+        the fetch failed) keyed by name.
+    '''
+    start = time.perf_counter()
+    futures = {name: fetch_pool.submit(BROKER_FETCHES[name]) for name in names}
+    snapshot = {name: future.result() for name, future in futures.items()}
+
+    if cfg.verbose:
+        PYPDebug("Fetched %s from broker in %.3fs" %
+                 (", ".join(names), time.perf_counter() - start))
+    return snapshot
+
+def refresh_portfolio(snapshot=None):
     ''' Refresh portfolio details from AngelOne.
         It queries the following from AngelOne:
         - all holdings
@@ -1437,14 +1859,20 @@ def refresh_portfolio():
 
         This must be called periodically or after an order update from the broker,
         which might indicate some change in orders/holdings/positions.
+
+        snapshot, if given, must have the portfolio_fetches() fetched by
+        fetch_from_broker(), else they are fetched here.
     '''
+    if snapshot is None:
+        snapshot = fetch_from_broker(portfolio_fetches())
+
     #
     # Query profile details and save it in pylive/orders/account/profile.
     # This needs to be done only once as profile information doesn't change.
     #
     global profileFetched
     if not profileFetched:
-        profile = broker.get_profile()
+        profile = snapshot["profile"]
         if profile is not None:
             profile_file = os.path.join(account_dir, "profile")
             try:
@@ -1459,7 +1887,7 @@ def refresh_portfolio():
     #
     # Query fund details and save it in pylive/orders/account/funds.
     #
-    funds = broker.get_funds()
+    funds = snapshot["funds"]
     if funds is not None:
         funds_file = os.path.join(account_dir, "funds")
         try:
@@ -1473,7 +1901,7 @@ def refresh_portfolio():
     #
     # Query holding details and save it in pylive/orders/holdings/allholdings.
     #
-    holdings = broker.get_holdings()
+    holdings = snapshot["holdings"]
     if holdings is not None:
         holdings_file = os.path.join(holdings_dir, "allholdings")
         try:
@@ -1487,7 +1915,7 @@ def refresh_portfolio():
     #
     # Query position details and save it in pylive/orders/positions/allpositions.
     #
-    positions = broker.get_positions()
+    positions = snapshot["positions"]
     if positions is not None:
         positions_file = os.path.join(positions_dir, "allpositions")
         try:
@@ -1499,7 +1927,254 @@ def refresh_portfolio():
             PYPError("Failed to save positions: %s" % e)
             ASSERT(False)
 
-def refresh_orders():
+#
+# Change detection for the files written by refresh_orders().
+#
+# refresh_orders() runs every few seconds and gets the full orderbook, tradebook
+# and gttlist from the broker, most of which is unchanged since the last
+# refresh. Earlier every refresh rewrote orderbook, tradebook and gttlist and
+# every external GTT, and json.load()ed the saved json of every order and GTT
+# just to compare its updatetime.
+# Now persisted_digests remembers the digest of what was last written to each
+# file, and refresh_orders() queues (see queue_persist()) only the documents
+# whose digest changed, which are then written in one batch by persist_batch().
+# A refresh with no changes does no disk I/O. Full documents are logged only
+# when they are written.
+#
+# Note: Files are rewritten in place and not by renaming a temporary file over
+#       them, as engine has inotify watches on these files and relies on
+#       IN_CLOSE_WRITE to learn about the updates (see engine_orderbook for the
+#       same reason). Skipping unchanged files is what saves the disk I/O.
+#
+# Note: The ltp fields added to orders and GTTs by refresh_orders() change on
+#       (almost) every refresh and are excluded from the digest, they just tell
+#       engine the LTP around when the order/GTT changed.
+#
+# Note: persisted_digests is only updated by refresh_orders() so if a file is
+#       removed behind our back it's written again only when it changes or on
+#       the next dumpall.
+#
+persisted_digests = {}
+LTP_FIELDS = ("ltp_sequence_number", "ltp_timestamp", "ltp")
+
+def json_digest(doc, exclude=()):
+    ''' Digest of json document doc, ignoring the top level keys in exclude.
+    '''
+    if exclude:
+        doc = {key: value for key, value in doc.items() if key not in exclude}
+    return hashlib.blake2b(json.dumps(doc, sort_keys=True).encode(),
+                           digest_size=16).digest()
+
+def queue_persist(batch, path, doc, what, force=False, exclude=(), log=PYPInfo):
+    ''' Queue doc to be written to path by persist_batch(), if it's changed
+        since it was last written (or force is True).
+        doc is serialized here, so the caller is free to modify it after this.
+        what describes the file in the log message. Returns True if queued.
+    '''
+    digest = json_digest(doc, exclude)
+    if not force and persisted_digests.get(path) == digest:
+        return False
+    batch.append((path, json.dumps(doc, indent=4), digest, what, log))
+    return True
+
+def persist_batch(batch):
+    ''' Write all the documents queued by queue_persist().
+    '''
+    path = None
+    try:
+        for path, data, digest, what, log in batch:
+            with open(path, 'w') as f:
+                f.write(data)
+            persisted_digests[path] = digest
+            log("Saved %s:\n%s" % (what, data))
+    except Exception as e:
+        PYPError("Failed to save %s: %s" % (path, e))
+        ASSERT(False)
+
+def process_broker_order(order, orderbook, batch, dumpall):
+    ''' Process (main) order from the broker orderbook, moving it to the
+        correct orders/ directory and queueing it to be saved in
+        orders/orderbook/{broker_orderid} (and external-orders/) if it has
+        changed. Called by refresh_orders() for every order in the orderbook
+        and by apply_order_updates() for every updated order.
+    '''
+    #
+    # Since we skip sub-orders we cannot get the target and
+    # stoploss sub-orders.
+    #
+    ASSERT(not broker.is_robo_sub_order(order))
+
+    #
+    # Since we skip sub-orders each order will have a unique
+    # broker_orderid and we save the order as that.
+    #
+    broker_orderid = order['orderid']
+    uniqueorderid = order['uniqueorderid']
+    engine_orderid = broker_orderid_to_engine_orderid(broker_orderid)
+    order["engine_orderid"] = engine_orderid if engine_orderid else ""
+
+    #
+    # Add LTP details to the order.
+    # Engine will use that to create the virtual candle on which
+    # the order status changed, to be fed to the Account handlers.
+    #
+    # XXX Note that the order status may not have changed on this
+    #     exact LTP, but unless we have lot of delay in processing
+    #     order status, it should be fairly close.
+    #
+    token = order['symboltoken']
+    ASSERT(len(token) > 1)
+    symbol = broker.token_to_symbol(token)
+    ASSERT(len(symbol) > 1)
+
+    ltp = get_ltp(symbol)
+    if ltp is not None:
+        order["ltp_sequence_number"] = ltp["sequence_number"]
+        order["ltp_timestamp"] = ltp["exchange_timestamp"]
+        order["ltp"] = ltp["last_traded_price"]
+    else:
+        #
+        # This will usually not fail but in the start if we get
+        # some order detail from broker w/o getting any tick for
+        # that stock, we may have no LTP data. Those orders will
+        # not have the LTP data but anyways since it's the start
+        # those orders will not be acted upon by the engine so it's
+        # ok to have no LTP data.
+        #
+        #ASSERT(False)
+        order["ltp_sequence_number"] = 0
+        order["ltp_timestamp"] = 0
+        order["ltp"] = 0
+
+    #
+    # For orders placed by engine we would also want to move
+    # the order to correct orders/ dir based on its current
+    # status. Since we periodically call refresh_orders() it's
+    # possible that the order is already moved to the required
+    # orders/ directory, in that case don't do anything, else
+    # look at the orderstatus and move the order to the
+    # correct orders/ directory.
+    #
+    move_to_correct_orders_dir(order, orderbook)
+
+    #
+    # If this broker_orderid doesn't correspond to an order we
+    # have placed, save it in orders/orderbook/external-orders/
+    # also. This is just for the record.
+    #
+    if engine_orderid is None:
+        queue_persist(batch, os.path.join(external_orders_dir, broker_orderid),
+                      order, "external-order %s" % broker_orderid,
+                      force=dumpall, exclude=LTP_FIELDS, log=PYPWarn)
+
+    #
+    # The order status may have changed since last time we
+    # created/updated in orders/orderbook/, update the order in
+    # orders/orderbook/.
+    #
+    # On dumpall we write all orders, either it's the first time
+    # after OrderPlacer startup or engine restarted, in both cases
+    # we must let engine know (all orders on startup and updated
+    # ones thereafter).
+    #
+    order_file = os.path.join(orderbook_dir, broker_orderid)
+    queue_persist(batch, order_file, order,
+                  "%s%s" % (order_file, " (first time after start)" if dumpall else ""),
+                  force=dumpall, exclude=LTP_FIELDS)
+
+#
+# Order updates from the broker's order update websocket.
+#
+# Earlier refresh_data_from_broker() polled refresh_portfolio() and
+# refresh_orders() every 10 secs, so a fill could take up to 10 secs to reach
+# engine, and every poll made several REST calls (orderBook, tradeBook,
+# gttLists, holdings, positions and funds) eating into the rate limits.
+# Now, with cfg.order_updates set, the broker calls on_order_update() with
+# every order the moment it changes. The updates are queued in order_updates
+# and applied by the refresh thread (see apply_order_updates()) to
+# last_orderbook, the orderbook fetched by the last refresh_orders(), and the
+# updated orders are processed exactly like refresh_orders() would, so engine
+# gets to know right away. Orders that reach a final state also trigger a
+# portfolio refresh, as holdings, positions and funds change with fills.
+#
+# While the order update websocket is connected the full REST refresh only
+# runs every cfg.order_reconcile_interval secs, to reconcile anything the
+# updates don't cover (tradebook, GTT rules, orders/orderbook/orderbook)
+# or that we might have missed. Every time the websocket (re)connects we
+# do a full refresh as updates may have been missed while disconnected.
+#
+# Note: Updates are only ever applied by the refresh thread, same as
+#       refresh_orders(), so last_orderbook, persisted_digests and the orders/
+#       directories need no locking.
+#
+order_updates = queue.Queue(maxsize=0)
+last_orderbook = None
+shall_refresh_portfolio_now = False
+
+# Polling interval when order updates are not available.
+REFRESH_INTERVAL_SECS = 10
+
+def on_order_update(order):
+    ''' Called by the broker from its order update websocket thread with the
+        updated order (same as an order in the orderbook), or with None when
+        updates may have been missed, f.e., on (re)connect.
+    '''
+    if order is None:
+        refresh_orders_now()
+        return
+    order_updates.put(order)
+
+def apply_order_updates(updates):
+    ''' Apply the updated orders to last_orderbook and process the (main)
+        orders they affect. Runs in the refresh thread.
+    '''
+    global shall_refresh_portfolio_now
+
+    #
+    # Till the first refresh_orders() we don't have an orderbook to apply
+    # the updates to, it'll anyway have the latest orders.
+    #
+    if last_orderbook is None:
+        refresh_orders_now()
+        return
+
+    updated = []
+    for update in updates:
+        broker_orderid = update['orderid']
+        PYPInfo("Order update for %s: status=%s, filled=%s/%s" %
+                (broker_orderid, update.get('orderstatus'),
+                 update.get('filledshares'), update.get('quantity')))
+
+        last_orderbook.apply(update)
+
+        #
+        # Sub-orders are not saved on their own, they decide the state of
+        # their main (robo) order, process that.
+        #
+        if update.get('parentorderid', "") != "":
+            broker_orderid = update['parentorderid']
+        if broker_orderid not in updated:
+            updated.append(broker_orderid)
+
+        if update.get('orderstatus') in ("complete", "cancelled", "rejected"):
+            shall_refresh_portfolio_now = True
+
+    batch = []
+    for broker_orderid in updated:
+        main_order = last_orderbook.get_order(broker_orderid)
+        if main_order is None:
+            #
+            # Sub-order update for a main order we haven't seen yet, the
+            # next refresh will get both.
+            #
+            PYPWarn("Order update for unknown order %s, refreshing orders" % broker_orderid)
+            refresh_orders_now()
+            continue
+        process_broker_order(main_order, last_orderbook, batch, False)
+
+    persist_batch(batch)
+
+def refresh_orders(snapshot=None):
     ''' Refresh order status from AngelOne.
         It queries the following from AngelOne:
         - orders
@@ -1510,48 +2185,48 @@ def refresh_orders():
 
         Note: This is the only function that places orders in orders/orderbook where
               engine reads from.
+
+        snapshot, if given, must have the ORDER_FETCHES fetched by
+        fetch_from_broker(), else they are fetched here.
     '''
+    if snapshot is None:
+        snapshot = fetch_from_broker(ORDER_FETCHES)
+
+    global orderbook_dumpall_epoch
+
+    #
+    # Was engine or pylive.broker restarted after we dumped all the orders?
+    # Is yes, then we should dump all orders (again) for engine to note.
+    #
+    dumpall = ((get_engine_startepoch() > orderbook_dumpall_epoch) or
+               (get_pylivebroker_startepoch() > orderbook_dumpall_epoch))
+
+    # Files that have changed, written together at the end by persist_batch().
+    batch = []
+
     #
     # Query orderbook and save it in pylive/orders/orderbook/orderbook.
     #
-    orderbook = broker.get_order_book()
+    orderbook = snapshot["orderbook"]
     if orderbook is not None:
-        orderbook_file = os.path.join(orderbook_dir, "orderbook")
-        try:
-            with open(orderbook_file, 'w') as f:
-                json.dump(orderbook, f, indent=4)
-            PYPInfo("Saved orders/orderbook/orderbook:\n%s" % json.dumps(orderbook, indent=4))
-        except Exception as e:
-            PYPError("Failed to save orderbook: %s" % e)
-            ASSERT(False)
+        queue_persist(batch, os.path.join(orderbook_dir, "orderbook"), orderbook,
+                      "orders/orderbook/orderbook", force=dumpall)
 
     #
     # Query tradebook and save it in pylive/orders/orderbook/tradebook.
     #
-    tradebook = broker.get_trade_book()
+    tradebook = snapshot["tradebook"]
     if tradebook is not None:
-        tradebook_file = os.path.join(orderbook_dir, "tradebook")
-        try:
-            with open(tradebook_file, 'w') as f:
-                json.dump(tradebook, f, indent=4)
-            PYPInfo("Saved orders/orderbook/tradebook:\n%s" % json.dumps(tradebook, indent=4))
-        except Exception as e:
-            PYPError("Failed to save tradebook: %s" % e)
-            ASSERT(False)
+        queue_persist(batch, os.path.join(orderbook_dir, "tradebook"), tradebook,
+                      "orders/orderbook/tradebook", force=dumpall)
 
     #
     # Query gttlist and save it in pylive/orders/gtt/gttlist.
     #
-    gttlist = broker.get_gtt_list()
+    gttlist = snapshot["gttlist"]
     if gttlist is not None:
-        gttlist_file = os.path.join(gtt_dir, "gttlist")
-        try:
-            with open(gttlist_file, 'w') as f:
-                json.dump(gttlist, f, indent=4)
-            PYPInfo("Saved orders/gtt/gttlist:\n%s" % json.dumps(gttlist, indent=4))
-        except Exception as e:
-            PYPError("Failed to save gttlist: %s" % e)
-            ASSERT(False)
+        queue_persist(batch, os.path.join(gtt_dir, "gttlist"), gttlist,
+                      "orders/gtt/gttlist", force=dumpall)
 
     #
     # Go over all the orders from the freshly received orderbook and find
@@ -1565,144 +2240,22 @@ def refresh_orders():
     #     Also orders may have completed with the Exchange, detect and move
     #     those to executed_dir.
     #
-    global orderbook_dumpall_epoch
-
-    #
-    # Was engine or pylive.broker restarted after we dumped all the orders?
-    # Is yes, then we should dump all orders (again) for engine to note.
-    #
-    dumpall = ((get_engine_startepoch() > orderbook_dumpall_epoch) or
-               (get_pylivebroker_startepoch() > orderbook_dumpall_epoch))
-
     if orderbook is not None:
         orders = orderbook['data']
         if orders is not None:
             for order in orders:
-                parentorderid = order['parentorderid']
                 # Ignore sub-orders.
-                if parentorderid != "":
+                if order['parentorderid'] != "":
                     continue
 
-                #
-                # Since we skip sub-orders we cannot get the target and
-                # stoploss sub-orders.
-                #
-                ASSERT(not broker.is_robo_sub_order(order))
-
-                #
-                # Since we skip sub-orders each order will have a unique
-                # broker_orderid and we save the order as that.
-                #
-                broker_orderid = order['orderid']
-                uniqueorderid = order['uniqueorderid']
-                engine_orderid = broker_orderid_to_engine_orderid(broker_orderid)
-                order["engine_orderid"] = engine_orderid if engine_orderid else ""
-
-                #
-                # Add LTP details to the order.
-                # Engine will use that to create the virtual candle on which
-                # the order status changed, to be fed to the Account handlers.
-                #
-                # XXX Note that the order status may not have changed on this
-                #     exact LTP, but unless we have lot of delay in processing
-                #     order status, it should be fairly close.
-                #
-                token = order['symboltoken']
-                ASSERT(len(token) > 1)
-                symbol = broker.token_to_symbol(token)
-                ASSERT(len(symbol) > 1)
-
-                ltp = get_ltp(symbol)
-                if ltp is not None:
-                    order["ltp_sequence_number"] = ltp["sequence_number"]
-                    order["ltp_timestamp"] = ltp["exchange_timestamp"]
-                    order["ltp"] = ltp["last_traded_price"]
-                else:
-                    #
-                    # This will usually not fail but in the start if we get
-                    # some order detail from broker w/o getting any tick for
-                    # that stock, we may have no LTP data. Those orders will
-                    # not have the LTP data but anyways since it's the start
-                    # those orders will not be acted upon by the engine so it's
-                    # ok to have no LTP data.
-                    #
-                    #ASSERT(False)
-                    order["ltp_sequence_number"] = 0
-                    order["ltp_timestamp"] = 0
-                    order["ltp"] = 0
+                process_broker_order(order, orderbook, batch, dumpall)
 
-                #
-                # For orders placed by engine we would also want to move
-                # the order to correct orders/ dir based on its current
-                # status. Since we periodically call refresh_orders() it's
-                # possible that the order is already moved to the required
-                # orders/ directory, in that case don't do anything, else
-                # look at the orderstatus and move the order to the
-                # correct orders/ directory.
-                #
-                move_to_correct_orders_dir(order, orderbook)
-
-                #
-                # If this broker_orderid doesn't correspond to an order we
-                # have placed, save it in orders/orderbook/external-orders/
-                # also. This is just for the record.
-                #
-                if engine_orderid is None:
-                    order_file = os.path.join(external_orders_dir, broker_orderid)
-                    #
-                    # Either dumpall is True or order_file doesn't exist, in
-                    # both these cases we must dump this order.
-                    #
-                    update_json = (dumpall or (not os.path.exists(order_file)))
-                    if not update_json:
-                        with open(order_file, 'r') as f:
-                            saved_order = json.load(f)
-                            # order updatetime has changed.
-                            update_json = (saved_order['updatetime'] != order['updatetime'])
-                    if update_json:
-                        with open(order_file, 'w') as f:
-                            json.dump(order, f, indent=4)
-                        PYPWarn("Saved external-order %s:\n%s" %
-                                (order_file, json.dumps(order, indent=4)))
-
-                #
-                # The order status may have changed since last time we
-                # created/updated in orders/orderbook/, update the order in
-                # orders/orderbook/
-                #
-                order_file = os.path.join(orderbook_dir, broker_orderid)
-
-                # Do we need to update the json file?
-                update_json = False
-                if (not dumpall) and os.path.exists(order_file):
-                    try:
-                        with open(order_file, 'r') as f:
-                            saved_order = json.load(f)
-                            # order updatetime has changed.
-                            update_json = (saved_order['updatetime'] != order['updatetime'])
-                    except Exception as e:
-                        PYPError("Failed to load order from %s: %s" % (order_file, e))
-                        ASSERT(False)
-                else:
-                    #
-                    # Doesn't exist, or this is the first time after
-                    # OrderPlacer startup.
-                    # In both cases we must create the order to let engine
-                    # know (all orders on startup and updated ones thereafter).
-                    #
-                    update_json = True
-
-                if update_json:
-                    try:
-                        with open(order_file, 'w') as f:
-                            json.dump(order, f, indent=4)
-                        PYPInfo("Saved %s%s:\n%s" %
-                                (order_file,
-                                 " (first time after start)" if dumpall else "",
-                                 json.dumps(order, indent=4)))
-                    except Exception as e:
-                        PYPError("Failed to save %s: %s" % (order_file, e))
-                        ASSERT(False)
+    #
+    # Order updates are applied to this from now on, see apply_order_updates().
+    #
+    global last_orderbook
+    if orderbook is not None:
+        last_orderbook = broker.orderbook_snapshot(orderbook)
 
     #
     # TODO: Go over tradebook for executed orders.
@@ -1773,39 +2326,23 @@ def refresh_orders():
                 # also. This is just for the record.
                 #
                 if engine_orderid is None:
-                    gtt_file = os.path.join(external_orders_dir, ruleid)
-                    with open(gtt_file, 'w') as f:
-                        json.dump(gtt, f, indent=4)
-                    PYPWarn("Saved external-gtt %s:\n%s" %
-                            (gtt_file, json.dumps(gtt, indent=4)))
+                    queue_persist(batch, os.path.join(external_orders_dir, ruleid),
+                                  gtt, "external-gtt %s" % ruleid,
+                                  force=dumpall, exclude=LTP_FIELDS, log=PYPWarn)
 
                 gtt_file = os.path.join(gtt_dir, ruleid)
-                # Do we need to update the json file?
-                update_json = False
-                if (not dumpall) and os.path.exists(gtt_file):
-                    try:
-                        with open(gtt_file, 'r') as f:
-                            saved_gtt = json.load(f)
-                            # gtt updatetime has changed.
-                            update_json = (saved_gtt['updateddate'] != gtt['updateddate'])
-                    except Exception as e:
-                        PYPError("Failed to load gtt from %s: %s" % (gtt_file, e))
-                        ASSERT(False)
-                else:
-                    # Doesn't exist, must create.
-                    update_json = True
-
-                if update_json:
-                    try:
-                        with open(gtt_file, 'w') as f:
-                            json.dump(gtt, f, indent=4)
-                        PYPInfo("Saved %s%s:\n%s" %
-                                (gtt_file,
-                                 " (first time after start)" if dumpall else "",
-                                 json.dumps(gtt, indent=4)))
-                    except Exception as e:
-                        PYPError("Failed to save %s: %s" % (gtt_file, e))
-                        ASSERT(False)
+                queue_persist(batch, gtt_file, gtt,
+                              "%s%s" % (gtt_file, " (first time after start)" if dumpall else ""),
+                              force=dumpall, exclude=LTP_FIELDS)
+
+    #
+    # Write all the changed files in one go.
+    #
+    if batch:
+        PYPInfo("refresh_orders: saving %d changed file(s)%s" %
+                (len(batch), " (dumpall)" if dumpall else ""))
+    persist_batch(batch)
+
     #
     # Set orderbook_dumpall_epoch to current epoch.
     #
@@ -1824,26 +2361,53 @@ def refresh_orders():
 
 def refresh_data_from_broker():
     ''' Refresh thread that's called periodically and queries important info from
-        (AngelOne) broker.
+        (AngelOne) broker. It also applies the order updates received from the
+        broker, see on_order_update().
     '''
     global runner_stopped_gracefully
     global shall_refresh_orders_now
+    global shall_refresh_portfolio_now
+
+    last_refresh = 0
 
     # Keep running till stop() is called.
     while not runner_stopped_gracefully:
-        # Fetch portfolio info.
-        refresh_portfolio()
-        # Fetch order info.
-        refresh_orders()
         #
-        # Fetch every 10 secs, but if refresh_orders_now() is called refresh
-        # promptly.
+        # Full refresh every REFRESH_INTERVAL_SECS, or every
+        # cfg.order_reconcile_interval secs while we are getting order updates.
+        #
+        interval = (cfg.order_reconcile_interval if broker.order_updates_connected()
+                    else REFRESH_INTERVAL_SECS)
+        if time.time() - last_refresh >= interval:
+            last_refresh = time.time()
+            shall_refresh_orders_now = False
+            shall_refresh_portfolio_now = False
+            # Fetch portfolio and order info together.
+            snapshot = fetch_from_broker(portfolio_fetches() + ORDER_FETCHES)
+            refresh_portfolio(snapshot)
+            refresh_orders(snapshot)
+
+        #
+        # If refresh_orders_now() is called refresh promptly.
         #
-        for i in range(1, 100):
-            time.sleep(0.1)
-            if shall_refresh_orders_now:
-                shall_refresh_orders_now = False
-                refresh_orders()
+        if shall_refresh_orders_now:
+            shall_refresh_orders_now = False
+            refresh_orders()
+
+        if shall_refresh_portfolio_now:
+            shall_refresh_portfolio_now = False
+            refresh_portfolio()
+
+        #
+        # Wait for order updates, apply all the queued ones together.
+        #
+        try:
+            updates = [order_updates.get(timeout=0.1)]
+        except queue.Empty:
+            continue
+        while not order_updates.empty():
+            updates.append(order_updates.get())
+        apply_order_updates(updates)
 
 def refresh_orders_now():
     global shall_refresh_orders_now
@@ -1867,6 +2431,9 @@ def init():
     '''
     PYPInfo('OrderPlacer: init() start')
 
+    # Both the processes use order_store, open it before forking the runner.
+    open_order_store()
+
     #
     # Create empty placed/engine_orderbook if it doesn't already exist, so
     # that engine can place an inotify watch on it.
@@ -1912,6 +2479,13 @@ def start():
     ASSERT(runner is not None)
     runner.start()
 
+    #
+    # Start getting order updates, after forking the runner as it doesn't
+    # need them.
+    #
+    if cfg.order_updates:
+        broker.start_order_updates(on_order_update)
+
     PYPInfo('OrderPlacer: start() end')
 
 def stop():
@@ -1929,6 +2503,9 @@ def stop():
     runner_stopped_gracefully = True
     runner.terminate()
 
+    if cfg.order_updates:
+        broker.stop_order_updates()
+
     PYPInfo('OrderPlacer: stop() end')
 
 def join():
@@ -1966,6 +2543,10 @@ def join():
     refresh_thread.join()
     PYPInfo('CandleGenerator: refresh_thread exited!')
 
+    fetch_pool.shutdown()
+    PYPInfo('OrderPlacer: broker API stats: %s' % json.dumps(broker.get_api_stats()))
+    PYPInfo('OrderPlacer: broker HTTP stats: %s' % json.dumps(broker.get_http_stats()))
+
     ASSERT(aso_thread is not None)
     aso_thread.join()
     PYPInfo('CandleGenerator: aso_thread exited!')
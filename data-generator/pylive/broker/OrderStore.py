@@ -0,0 +1,210 @@
+import os, sys, time, json, sqlite3
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import threading
+import config as cfg
+from helpers import *
+
+#
+# Order state store.
+#
+# Every engine order goes through the orders/ directories, f.e.,
+# generated -> placing -> placed -> executed/partial -> executed, and its
+# state used to be wherever its json file was, which meant finding the state
+# of an order needed an os.path.exists() on each of the 7 directories and
+# finding all orders in a state (or all stale orders, see cleanup_orders())
+# needed a listdir() and a json.load() of every file.
+#
+# OrderStore keeps the state of every engine order, along with its json and
+# every state transition it went through, in a SQLite database in WAL mode.
+# Lookups by engine orderid, broker orderid, state and tradingsymbol are all
+# indexed. The orders/ files are still written and moved (see
+# OrderPlacer.move_order()) as that's what the engine and the humans read, but
+# they are never scanned to find the state of an order.
+#
+# Both the main pylive.broker process (refresh_orders()) and the placer
+# process (process_generated_order()) update the store. WAL lets readers
+# proceed while a writer commits and the busy timeout (see conn()) makes
+# writers wait for each other instead of failing. Every update is a single
+# short transaction.
+#
+# Note: sqlite3 connections must not be shared across threads or across
+#       fork(), so every thread (of every process) opens its own connection,
+#       see conn().
+#
+
+# Order states, same as the orders/ directory the order file is in.
+ORDER_STATES = ("generated", "placing", "placed", "partially_executed",
+                "executed", "squaredoff", "cancelled", "failed", "old")
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS orders (
+    engine_orderid TEXT PRIMARY KEY,
+    broker_orderid TEXT,
+    tradingsymbol TEXT,
+    producttype TEXT,
+    state TEXT NOT NULL,
+    order_json TEXT,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_broker_orderid ON orders(broker_orderid);
+CREATE INDEX IF NOT EXISTS orders_state ON orders(state);
+CREATE INDEX IF NOT EXISTS orders_tradingsymbol ON orders(tradingsymbol);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    engine_orderid TEXT NOT NULL,
+    from_state TEXT,
+    to_state TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transitions_engine_orderid ON transitions(engine_orderid);
+'''
+
+class OrderStore:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.tls = threading.local()
+
+        # Was the database created now? Caller may want to populate it.
+        self.created = not os.path.exists(db_file)
+
+        conn = self.conn()
+        with conn:
+            conn.executescript(SCHEMA)
+
+        PYPInfo("OrderStore: %s %s (journal_mode=%s)" %
+                ("created" if self.created else "opened", db_file,
+                 conn.execute("PRAGMA journal_mode").fetchone()[0]))
+
+    def conn(self):
+        ''' This thread's connection, opened on first use.
+        '''
+        conn = getattr(self.tls, "conn", None)
+        # Thread local state is inherited by the thread that calls fork().
+        if conn is None or self.tls.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Durable at checkpoints, never corrupt, good enough for the bookkeeping.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.tls.conn = conn
+            self.tls.pid = os.getpid()
+        return conn
+
+    def add(self, order, state, modified=None):
+        ''' Add a new engine order, in the given state.
+            Returns False if an order with the same engine orderid is already
+            present, the existing order is not changed in that case.
+        '''
+        ASSERT(state in ORDER_STATES)
+        now = time.time()
+        conn = self.conn()
+        try:
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute("INSERT INTO orders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (str(order['orderid']), order.get('broker_orderid'),
+                              order.get('tradingsymbol'), order.get('producttype'),
+                              state, json.dumps(order), now,
+                              modified if modified is not None else now, now))
+                conn.execute("INSERT INTO transitions (engine_orderid, from_state, to_state, timestamp) "
+                             "VALUES (?, NULL, ?, ?)", (str(order['orderid']), state, now))
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def update_order(self, order):
+        ''' Update the json (and the broker orderid, tradingsymbol and
+            producttype) of an existing order.
+            Returns False if the order is not present.
+        '''
+        now = time.time()
+        conn = self.conn()
+        with conn:
+            cursor = conn.execute("UPDATE orders SET broker_orderid = ?, tradingsymbol = ?, "
+                                  "producttype = ?, order_json = ?, modified = ?, updated = ? "
+                                  "WHERE engine_orderid = ?",
+                                  (order.get('broker_orderid'), order.get('tradingsymbol'),
+                                   order.get('producttype'), json.dumps(order), now, now,
+                                   str(order['orderid'])))
+        return cursor.rowcount == 1
+
+    def transition(self, engine_orderid, to_state):
+        ''' Move order engine_orderid to to_state, recording the transition.
+            Orders not yet known are added (with no json) in to_state.
+            Returns the state the order was in before, None if not known.
+        '''
+        ASSERT(to_state in ORDER_STATES)
+        now = time.time()
+        conn = self.conn()
+        with conn:
+            # Take the write lock before reading the current state.
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT state FROM orders WHERE engine_orderid = ?",
+                               (engine_orderid,)).fetchone()
+            from_state = row["state"] if row is not None else None
+            if row is None:
+                conn.execute("INSERT INTO orders (engine_orderid, state, created, modified, updated) "
+                             "VALUES (?, ?, ?, ?, ?)", (engine_orderid, to_state, now, now, now))
+            else:
+                conn.execute("UPDATE orders SET state = ?, updated = ? WHERE engine_orderid = ?",
+                             (to_state, now, engine_orderid))
+            conn.execute("INSERT INTO transitions (engine_orderid, from_state, to_state, timestamp) "
+                         "VALUES (?, ?, ?, ?)", (engine_orderid, from_state, to_state, now))
+        return from_state
+
+    def get_state(self, engine_orderid):
+        ''' State of order engine_orderid, None if not known.
+        '''
+        row = self.conn().execute("SELECT state FROM orders WHERE engine_orderid = ?",
+                                  (engine_orderid,)).fetchone()
+        return row["state"] if row is not None else None
+
+    def get_order(self, engine_orderid):
+        ''' json of order engine_orderid, None if not known.
+        '''
+        row = self.conn().execute("SELECT order_json FROM orders WHERE engine_orderid = ?",
+                                  (engine_orderid,)).fetchone()
+        if row is None or row["order_json"] is None:
+            return None
+        return json.loads(row["order_json"])
+
+    def get_engine_orderid(self, broker_orderid):
+        ''' Engine orderid of the (first) order placed as broker_orderid.
+        '''
+        row = self.conn().execute("SELECT engine_orderid FROM orders WHERE broker_orderid = ? "
+                                  "ORDER BY created LIMIT 1", (broker_orderid,)).fetchone()
+        return row["engine_orderid"] if row is not None else None
+
+    def get_orders(self, states=None, tradingsymbol=None):
+        ''' Rows (engine_orderid, broker_orderid, tradingsymbol, producttype,
+            state, created, modified, updated) of all orders in one of states
+            and/or for tradingsymbol.
+        '''
+        query = ("SELECT engine_orderid, broker_orderid, tradingsymbol, producttype, "
+                 "state, created, modified, updated FROM orders")
+        conds = []
+        args = []
+        if states is not None:
+            conds.append("state IN (%s)" % ",".join("?" * len(states)))
+            args += list(states)
+        if tradingsymbol is not None:
+            conds.append("tradingsymbol = ?")
+            args.append(tradingsymbol)
+        if conds:
+            query += " WHERE " + " AND ".join(conds)
+        return [dict(row) for row in self.conn().execute(query + " ORDER BY created", args)]
+
+    def get_transitions(self, engine_orderid):
+        ''' (from_state, to_state, timestamp) of every transition of order
+            engine_orderid, oldest first.
+        '''
+        return [(row["from_state"], row["to_state"], row["timestamp"])
+                for row in self.conn().execute("SELECT from_state, to_state, timestamp "
+                                               "FROM transitions WHERE engine_orderid = ? "
+                                               "ORDER BY id", (engine_orderid,))]
+
+    def count(self):
+        return self.conn().execute("SELECT COUNT(*) FROM orders").fetchone()[0]
@@ -0,0 +1,171 @@
+import os, sys, time, json
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import threading
+import config as cfg
+from helpers import *
+
+#
+# Tick path latency histograms.
+#
+# To find out where late candles come from (AngelOne, the websocket thread,
+# the tick queue or the minute dump) CandleGenerator records the following,
+# all in microseconds:
+#
+# exch_to_recv   - exchange_timestamp of the tick to when the websocket
+#                  callback got it (per tick). Note that this includes any
+#                  clock skew between AngelOne and us.
+# queue_wait     - time the tick spent in the tick queue (per tick).
+# on_tick        - on_ticks() processing time per tick (batch time / ticks
+#                  in the batch, recorded once per batch for all its ticks).
+# dump           - dump_all_instruments() duration (per minute).
+# finalize_delay - minute close to finalize_live_data() spawning pyprocess
+#                  (per minute).
+#
+# Histograms use log-linear buckets (4 buckets per power of 2, i.e., at most
+# 25% error), so recording a value is a bit_length() and a list increment and
+# there's no per value allocation.
+#
+# Every minute the exporter thread swaps out the histograms collected in the
+# last minute and appends their percentiles, as one json line, to the
+# metrics file.
+#
+# Note: The exporter swaps the counts list with a single assignment, so we
+#       don't need any lock. A value recorded concurrently with the swap may
+#       get accounted in the previous minute, which is fine for our use.
+#       With cfg.feed_partitions > 1 the histograms are recorded by all the
+#       workers (and websocket connections), which may rarely lose a count.
+#
+
+HISTOGRAMS = ("exch_to_recv", "queue_wait", "on_tick", "dump", "finalize_delay")
+
+# Sub-buckets per power of 2 (must be a power of 2).
+SUB_BUCKETS = 4
+SUB_BITS = SUB_BUCKETS.bit_length() - 1
+
+# Enough for values up to 2^40 us (~12 days).
+NUM_BUCKETS = SUB_BUCKETS * 41
+
+# Percentiles exported.
+PERCENTILES = (50, 90, 99, 99.9)
+
+def bucket_index(value):
+    ''' Bucket for value (in us).
+    '''
+    if value < 2 * SUB_BUCKETS:
+        return max(0, value)
+    shift = value.bit_length() - SUB_BITS - 1
+    return min(NUM_BUCKETS - 1, (shift * SUB_BUCKETS) + (value >> shift))
+
+def bucket_upper(index):
+    ''' Largest value that falls in bucket index.
+    '''
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index // SUB_BUCKETS) - 1
+    mantissa = index - (shift * SUB_BUCKETS)
+    return ((mantissa + 1) << shift) - 1
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.max = 0
+
+    def record(self, value, count=1):
+        ''' Record value (us), count times.
+        '''
+        value = int(value)
+        self.counts[bucket_index(value)] += count
+        if value > self.max:
+            self.max = value
+
+    def swap(self):
+        ''' Return (counts, max) collected till now and start afresh.
+        '''
+        counts, self.counts = self.counts, [0] * NUM_BUCKETS
+        maxval, self.max = self.max, 0
+        return counts, maxval
+
+def summarize(counts, maxval):
+    ''' Count, percentiles (in ms) and max (in ms) for the given counts.
+    '''
+    total = sum(counts)
+    summary = {"n": total}
+    if total == 0:
+        return summary
+
+    targets = [(p, total * p / 100) for p in PERCENTILES]
+    seen = 0
+    for index, count in enumerate(counts):
+        if count == 0:
+            continue
+        seen += count
+        while targets and seen >= targets[0][1]:
+            p, _ = targets.pop(0)
+            summary["p%g" % p] = round(min(bucket_upper(index), maxval) / 1000, 3)
+        if not targets:
+            break
+
+    summary["max"] = round(maxval / 1000, 3)
+    return summary
+
+class TickMetrics:
+    def __init__(self, metrics_file, interval_secs=60):
+        self.metrics_file = metrics_file
+        self.interval = interval_secs
+        self.histograms = {name: Histogram() for name in HISTOGRAMS}
+        self.exit_now = False
+        self.export_thread = None
+
+        # Direct access for the tick path.
+        self.exch_to_recv = self.histograms["exch_to_recv"]
+        self.queue_wait = self.histograms["queue_wait"]
+        self.on_tick = self.histograms["on_tick"]
+        self.dump = self.histograms["dump"]
+        self.finalize_delay = self.histograms["finalize_delay"]
+
+    def export(self):
+        ''' Append percentiles for the values collected since the last export
+            to the metrics file.
+        '''
+        record = {"time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        for name, histogram in self.histograms.items():
+            record[name] = summarize(*histogram.swap())
+
+        try:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            PYPError("TickMetrics: Failed to write %s: %s", self.metrics_file, e)
+            return
+
+        if cfg.verbose:
+            PYPDebug("TickMetrics: %s", record)
+
+    def exporter(self):
+        PYPInfo("TickMetrics: exporting every %ds to %s", self.interval, self.metrics_file)
+        while not self.exit_now:
+            # Export at the start of the (wall clock) interval.
+            deadline = (time.time() // self.interval + 1) * self.interval
+            while not self.exit_now and time.time() < deadline:
+                time.sleep(min(1, max(0, deadline - time.time())))
+            #
+            # On stop() the last partial interval is exported by the owner
+            # after the tick path has drained (see CandleGenerator.join()),
+            # exporting it here too would split it into two records.
+            #
+            if self.exit_now:
+                break
+            self.export()
+        PYPInfo("TickMetrics: exporter exiting")
+
+    def start(self):
+        self.export_thread = threading.Thread(target=self.exporter, args=(), daemon=False)
+        self.export_thread.start()
+
+    def stop(self):
+        self.exit_now = True
+
+    def join(self):
+        if self.export_thread is not None:
+            self.export_thread.join()
@@ -0,0 +1,221 @@
+import os, sys, time, mmap, struct
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import config as cfg
+from helpers import *
+
+#
+# Shared memory single-producer single-consumer (SPSC) tick ring.
+#
+# With cfg.tick_ring set, the websocket receive and tick decoding run in a
+# separate ingest process (see CandleGenerator.ingest()), so that the threads
+# of the main pylive.broker process (candle building, historical refresh,
+# OrderPlacer/OrderTracker REST calls and the big json parsing they do) can
+# never hold the GIL when a websocket frame arrives. The ingest process writes
+# every tick as a fixed size record to this ring and the dequeue thread of the
+# main process reads them from there. There's no pickling and no pipe, the
+# records live in an anonymous shared mapping created before the ingest
+# process is fork()ed.
+#
+# Layout:
+#
+# +------+------+--------+--------+-----+------------------+
+# | head | tail | slot 0 | slot 1 | ... | slot (nslots-1)  |
+# +------+------+--------+--------+-----+------------------+
+#
+# head - Number of records ever written. Only the producer updates it.
+# tail - Number of records ever read. Only the consumer updates it.
+#
+# head and tail are in separate cache lines and are free running, the slot
+# for record n is n % nslots (nslots is a power of 2). The ring is empty when
+# head == tail and full when head - tail == nslots.
+#
+# The producer writes the record and then publishes it by updating head, the
+# consumer reads the records till head and then releases the slots by
+# updating tail.
+#
+# Note: head and tail are accessed through a memoryview cast to native
+#       unsigned 64-bit ints, so every access is a single aligned 8-byte
+#       load/store and never torn. x86 doesn't reorder stores with other
+#       stores or loads with other loads, which is all the ordering we need.
+#
+# Note: Records carry the fields returned by the lean websocket decoder (see
+#       SmartWebSocketV2._parse_binary_data_lean()), i.e., ticks read from the
+#       ring look like lean ticks even if the ingest process decodes the full
+#       tick. These are all the fields that CandleGenerator needs.
+#
+
+# Offsets (in 8-byte words) of head and tail.
+HEAD = 0
+TAIL = 8
+HEADER_SIZE = 128
+
+#
+# subscription_mode, token, sequence_number, exchange_timestamp,
+# last_traded_price, volume_trade_for_the_day, open_price_of_the_day,
+# high_price_of_the_day, low_price_of_the_day, closed_price, recv_time.
+#
+RECORD = struct.Struct("<B25s8qd")
+
+# AngelOne LTP mode ticks don't have volume and the day's OHLC.
+LTP_MODE = 1
+
+# How long the consumer sleeps when the ring is empty.
+POLL_INTERVAL = 0.001
+
+# How long the producer sleeps when the ring is full.
+FULL_WAIT = 0.001
+
+class TickRing:
+    ''' The shared memory, must be created before fork()ing the ingest
+        process, which inherits the mapping.
+    '''
+    def __init__(self, nslots):
+        ASSERT(nslots > 0 and (nslots & (nslots - 1)) == 0,
+               "nslots (%d) must be a power of 2" % nslots)
+        self.nslots = nslots
+        self.mask = nslots - 1
+
+        # Anonymous mappings are MAP_SHARED, i.e., shared with fork()ed children.
+        self.mm = mmap.mmap(-1, HEADER_SIZE + nslots * RECORD.size)
+        self.idx = memoryview(self.mm)[:HEADER_SIZE].cast("Q")
+
+        PYPInfo("TickRing: created with %d slots (%d bytes)", nslots, len(self.mm))
+
+class TickRingWriter:
+    ''' Producer side, used by the ingest process.
+        put() is the websocket on_data() callback.
+    '''
+    def __init__(self, ring):
+        self.ring = ring
+        self.mm = ring.mm
+        self.idx = ring.idx
+        self.head = self.idx[HEAD]
+
+        # Stats.
+        self.full_waits = 0
+
+    def put(self, tick):
+        ring = self.ring
+        head = self.head
+
+        #
+        # Ring full means the main process is not keeping up, wait for it
+        # rather than dropping ticks. Websocket frames queue up in the socket
+        # buffer meanwhile.
+        #
+        while head - self.idx[TAIL] >= ring.nslots:
+            self.full_waits += 1
+            PYPWarnRateLimited("tick-ring-full",
+                               "TickRing: ring full (%d slots), waiting for the reader, full_waits=%d",
+                               ring.nslots, self.full_waits)
+            time.sleep(FULL_WAIT)
+
+        RECORD.pack_into(self.mm, HEADER_SIZE + (head & ring.mask) * RECORD.size,
+                         tick["subscription_mode"],
+                         tick["token"].encode("latin-1"),
+                         tick["sequence_number"],
+                         tick["exchange_timestamp"],
+                         tick["last_traded_price"],
+                         tick.get("volume_trade_for_the_day", 0),
+                         tick.get("open_price_of_the_day", 0),
+                         tick.get("high_price_of_the_day", 0),
+                         tick.get("low_price_of_the_day", 0),
+                         tick.get("closed_price", 0),
+                         time.time())
+
+        # Publish the record.
+        head += 1
+        self.idx[HEAD] = head
+        self.head = head
+
+class TickRingReader:
+    ''' Consumer side, used by the CandleGenerator dequeue thread in place of
+        TickQueue.
+    '''
+    def __init__(self, ring):
+        self.ring = ring
+        self.mm = ring.mm
+        self.idx = ring.idx
+        self.tail = self.idx[TAIL]
+
+        # Set by put(None), see get_all().
+        self.stopping = False
+
+        # Raw 25 byte token -> token string, tokens repeat for every tick.
+        self.tokens = {}
+
+    def put(self, tick):
+        ''' Ticks are only added by the ingest process, this is only for
+            queueing the None sentinel after the ingest process has exited.
+            get_all() returns it after all the ticks in the ring.
+        '''
+        ASSERT(tick is None)
+        self.stopping = True
+
+    def qsize(self):
+        return self.idx[HEAD] - self.tail
+
+    def get_all(self, timeout):
+        ''' Returns a list with all the ticks in the ring, in the order they
+            were added. Waits till at least one tick is added or till timeout
+            seconds, in which case an empty list is returned.
+        '''
+        deadline = time.time() + timeout
+        while True:
+            # Must be read before head, see put().
+            stopping = self.stopping
+            head = self.idx[HEAD]
+            if head != self.tail or stopping:
+                break
+            if time.time() >= deadline:
+                return []
+            time.sleep(POLL_INTERVAL)
+
+        ticks = self.read(self.tail, head)
+
+        # Release the slots.
+        self.tail = head
+        self.idx[TAIL] = head
+
+        if stopping:
+            ticks.append(None)
+        return ticks
+
+    def read(self, tail, head):
+        ring = self.ring
+        tokens = self.tokens
+        start = tail & ring.mask
+        count = head - tail
+        ticks = []
+
+        # Records [tail, head) are in at most two contiguous pieces.
+        while count > 0:
+            n = min(count, ring.nslots - start)
+            offset = HEADER_SIZE + start * RECORD.size
+            for (mode, token, seq, exch_ts, ltp, volume,
+                 day_open, day_high, day_low, close,
+                 recv_time) in RECORD.iter_unpack(self.mm[offset:offset + n * RECORD.size]):
+                token_str = tokens.get(token)
+                if token_str is None:
+                    token_str = token.split(b"\x00", 1)[0].decode("latin-1")
+                    tokens[token] = token_str
+                tick = {
+                    "subscription_mode": mode,
+                    "token": token_str,
+                    "sequence_number": seq,
+                    "exchange_timestamp": exch_ts,
+                    "last_traded_price": ltp,
+                    "recv_time": recv_time
+                }
+                if mode != LTP_MODE:
+                    tick["volume_trade_for_the_day"] = volume
+                    tick["open_price_of_the_day"] = day_open
+                    tick["high_price_of_the_day"] = day_high
+                    tick["low_price_of_the_day"] = day_low
+                    tick["closed_price"] = close
+                ticks.append(tick)
+            count -= n
+            start = 0
+
+        return ticks
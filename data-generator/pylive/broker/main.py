@@ -6,7 +6,8 @@ sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
 import config as cfg
 from helpers import *
 
-if cfg.broker['selection'] == "angelone":
+# mock is AngelOne talking to broker/mockbroker.py, see config.py.
+if cfg.broker['selection'] in ("angelone", "mock"):
     import AngelOne as broker
 else:
     # Till we support other brokers.
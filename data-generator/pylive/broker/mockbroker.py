@@ -0,0 +1,926 @@
+#!/usr/bin/env python3
+
+import sys, os, time, json, random, uuid, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+#
+# Local mock of the AngelOne SmartAPI REST server, for load testing the order
+# pipeline (engine -> OrderPlacer -> broker and back) with thousands of
+# orders a day, outside market hours and w/o a real account.
+#
+# With broker.selection set to "mock" in pylive/backtester.json, AngelOne.py
+# logs in to and places/tracks orders with this server (broker.mock.url)
+# instead of apiconnect.angelone.in, over the same SmartConnect calls, so
+# everything above HTTP, _SAFEAPI() retries and rate limiting, the pooled
+# session, the orderbook/ROBO helpers and OrderPlacer, runs unchanged.
+#
+# It serves the calls pylive makes:
+# - loginByPassword, getProfile, getRMS,
+# - placeOrder, modifyOrder, cancelOrder, getOrderBook, getTradeBook,
+# - getPosition, getAllHolding,
+# - GTT createRule, modifyRule, cancelRule, ruleList, ruleDetails.
+#
+# Orders are matched every --match-ms against the LTP of their symbol:
+# - MARKET orders fill at the LTP.
+# - LIMIT orders fill once the LTP crosses their price, at the LTP capped by
+#   their price.
+# - When a ROBO (bracket) order fills, a target LIMIT sub-order ("open") and
+#   a stoploss STOPLOSS_LIMIT sub-order ("trigger pending") are created, with
+#   parentorderid set to the ROBO order, squareoff/stoploss away from its
+#   price. The stoploss becomes a LIMIT order when the LTP crosses its
+#   triggerprice. When either completes, the other is cancelled (OCO).
+# - Cancelling a complete ROBO order squares it off, like AngelOne does, by
+#   completing the stoploss sub-order at the LTP and cancelling the target.
+# - GTT rules stay "NEW" till the LTP crosses their triggerprice (from where
+#   it was when the rule was created/modified or first got an LTP), then they
+#   become "SENTTOEXCHANGE" and place a NORMAL DELIVERY LIMIT order.
+# - Fills go to the tradebook and positions, bought DELIVERY quantity shows
+#   up in holdings.
+# Orders always fill completely, there are no partial fills or rejections.
+#
+# LTP is taken from pylive's LTP table (--ltp-table, see LTPTable.py), so
+# orders fill on the same prices the engine sees, f.e., from mockfeed.py.
+# Symbols not in the table (or w/o --ltp-table) get a random walk starting at
+# the price of their first order, MARKET orders and GTT rules for such
+# symbols wait till they have a price.
+#
+# Every request takes --latency-ms (plus up to --jitter-ms), requests over
+# AngelOne's per API rate limits get AngelOne's 'Access denied because of
+# exceeding access rate' response and --error-rate of the remaining requests
+# fail with the AB1004 'Something Went Wrong' error, so that the retry and
+# backoff paths get exercised too.
+#
+# f.e.
+# $ ./mockfeed.py --port 8765 --rate 2000 &
+# $ ./mockbroker.py --port 8766 --ltp-table ../orders/ltp/ltp.table &
+# and in pylive/backtester.json
+#   "ws_feed_url": "ws://127.0.0.1:8765",
+#   "broker": { "selection": "mock", "mock": { "url": "http://127.0.0.1:8766", ... } }
+#
+# All state is in memory, restart it to start a new day.
+#
+# This only uses the standard library (plus LTPTable with --ltp-table).
+#
+
+ROUTE_PREFIX = "/rest/secure/angelbroking/"
+GTT_PREFIX = "/gtt-service/rest/secure/angelbroking/gtt/v1/"
+
+#
+# path -> (Exchange method, requests/sec allowed), rate limits as per
+# https://smartapi.angelbroking.com/docs/RateLimit, same as
+# AngelOne.API_RATE_LIMITS.
+#
+ROUTES = {
+    "/rest/auth/angelbroking/user/v1/loginByPassword": ("login", 1),
+    ROUTE_PREFIX + "user/v1/getProfile": ("profile", 3),
+    ROUTE_PREFIX + "user/v1/getRMS": ("funds", 2),
+    ROUTE_PREFIX + "order/v1/placeOrder": ("place_order", 20),
+    ROUTE_PREFIX + "order/v1/modifyOrder": ("modify_order", 20),
+    ROUTE_PREFIX + "order/v1/cancelOrder": ("cancel_order", 20),
+    ROUTE_PREFIX + "order/v1/getOrderBook": ("order_book", 1),
+    ROUTE_PREFIX + "order/v1/getTradeBook": ("trade_book", 1),
+    ROUTE_PREFIX + "order/v1/getPosition": ("positions", 1),
+    ROUTE_PREFIX + "portfolio/v1/getAllHolding": ("holdings", 1),
+    GTT_PREFIX + "createRule": ("create_gtt", 20),
+    GTT_PREFIX + "modifyRule": ("modify_gtt", 20),
+    GTT_PREFIX + "cancelRule": ("cancel_gtt", 20),
+    ROUTE_PREFIX + "gtt/v1/ruleList": ("gtt_list", 1),
+    ROUTE_PREFIX + "gtt/v1/ruleDetails": ("gtt_details", 1),
+}
+
+# AngelOne returns this as plain text (with 403) when a rate limit is exceeded.
+RATE_LIMIT_TEXT = "Access denied because of exceeding access rate"
+
+# Error codes, as per https://smartapi.angelbroking.com/docs/ErrorCodes.
+ERR_SOMETHING_WENT_WRONG = "AB1004"
+ERR_INVALID_VARIETY = "AB1008"
+ERR_INVALID_PRODUCTTYPE = "AB1012"
+ERR_ORDER_NOT_FOUND = "AB1013"
+ERR_NOT_SPECIFIED = "AB2000"
+ERR_INVALID_TOKEN = "AG8001"
+
+# Orders still at the exchange.
+WORKING_STATUSES = ("open", "trigger pending")
+
+# NSE tick size.
+TICK = 0.05
+
+# Stoploss sub-order limit price is this much beyond its triggerprice.
+SL_LIMIT_BUFFER = 0.02
+
+def to_tick(price):
+    return round(round(price / TICK) * TICK, 2)
+
+def timestr(t=None):
+    ''' AngelOne's orderbook time format, f.e., "29-Dec-2023 09:21:33".
+    '''
+    return time.strftime("%d-%b-%Y %H:%M:%S", time.localtime(t))
+
+def ok(data):
+    return {"status": True, "message": "SUCCESS", "errorcode": "", "data": data}
+
+def error(message, errorcode):
+    return {"status": False, "message": message, "errorcode": errorcode, "data": None}
+
+class PriceFeed:
+    ''' LTP (in rupees) of the symbols we have orders for.
+    '''
+    def __init__(self, ltp_table, rng):
+        self.ltp_table = ltp_table
+        self.reader = None
+        self.rng = rng
+        # symbol -> random walk price, for symbols not in the LTP table.
+        self.walk = {}
+
+    def get(self, symbol, price=0):
+        ''' LTP of symbol, None if we don't have one. price (if non-zero)
+            starts the random walk of a symbol not in the LTP table.
+        '''
+        if self.ltp_table is not None:
+            # Created by CandleGenerator when pylive starts.
+            if self.reader is None and os.path.exists(self.ltp_table):
+                import LTPTable
+                self.reader = LTPTable.LTPTableReader(self.ltp_table)
+            if self.reader is not None:
+                ltp = self.reader.get(symbol)
+                if ltp is not None and ltp["last_traded_price"] > 0:
+                    # Prices are in paise.
+                    return ltp["last_traded_price"] / 100.0
+
+        if symbol not in self.walk and price > 0:
+            self.walk[symbol] = price
+        return self.walk.get(symbol)
+
+    def step(self):
+        ''' Move the random walk prices, once every match.
+        '''
+        for symbol, price in self.walk.items():
+            self.walk[symbol] = max(TICK, to_tick(price + self.rng.choice((-1, 0, 1)) *
+                                                  max(TICK, price * 0.0002)))
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.orders = 0
+        self.fills = 0
+        self.gtts = 0
+
+class Exchange:
+    ''' Simulated orderbook, GTT rules, trades and positions of the (one)
+        client logged in.
+    '''
+    def __init__(self, args, stats):
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(args.seed)
+        self.prices = PriceFeed(args.ltp_table, self.rng)
+        self.lock = threading.Lock()
+
+        self.clientcode = None
+        self.jwt_token = None
+
+        # orderid -> order json, in the order placed.
+        self.orders = {}
+        # orderid -> order json, of orders still at the exchange.
+        self.working = {}
+        # ROBO orderid -> {"target": order, "stoploss": order}.
+        self.suborders = {}
+        # ruleid -> GTT rule json.
+        self.gtts = {}
+        # ruleid -> True if the rule triggers when LTP goes above triggerprice,
+        # None till we have the LTP.
+        self.gtt_above = {}
+        self.trades = []
+        # (tradingsymbol, producttype) -> position.
+        self.portfolio = {}
+
+        self.day = time.strftime("%y%m%d")
+        self.next_orderid = 1
+        self.next_fillid = 1
+        self.next_ruleid = 1000001
+
+    def new_orderid(self):
+        orderid = "%s%09d" % (self.day, self.next_orderid)
+        self.next_orderid += 1
+        return orderid
+
+    def symbol(self, tradingsymbol):
+        ''' LTP table symbol for tradingsymbol, f.e., SBIN for SBIN-EQ.
+        '''
+        return tradingsymbol[:-3] if tradingsymbol.endswith("-EQ") else tradingsymbol
+
+    #
+    # Session.
+    #
+
+    def login(self, params):
+        with self.lock:
+            self.clientcode = params.get("clientcode", "MOCK")
+            self.jwt_token = uuid.uuid4().hex
+            return ok({"jwtToken": self.jwt_token,
+                       "refreshToken": uuid.uuid4().hex,
+                       "feedToken": uuid.uuid4().hex})
+
+    def authorized(self, authorization):
+        return self.jwt_token is not None and authorization == ("Bearer %s" % self.jwt_token)
+
+    def profile(self, params):
+        return ok({"clientcode": self.clientcode,
+                   "name": "Mock Broker",
+                   "email": "",
+                   "mobileno": "",
+                   "exchanges": ["nse_cm"],
+                   "products": ["BO", "NRML", "CO", "CNC", "MIS", "MARGIN"],
+                   "lastlogintime": "",
+                   "broker": ""})
+
+    def funds(self, params):
+        with self.lock:
+            realised = sum(self.realised(position) for position in self.portfolio.values())
+        net = self.args.funds + realised
+        return ok({"net": "%.4f" % net,
+                   "availablecash": "%.4f" % net,
+                   "availableintradaypayin": "0.0000",
+                   "availablelimitmargin": "0.0000",
+                   "collateral": "0.0000",
+                   "m2munrealized": "0.0000",
+                   "m2mrealized": "%.4f" % realised,
+                   "utiliseddebits": "0.0000",
+                   "utilisedspan": None,
+                   "utilisedoptionpremium": None,
+                   "utilisedholdingsales": None,
+                   "utilisedexposure": None,
+                   "utilisedturnover": None,
+                   "utilisedpayout": "%.4f" % net})
+
+    #
+    # Orders.
+    #
+
+    def new_order(self, params, **fields):
+        now = timestr()
+        orderid = self.new_orderid()
+        quantity = str(int(params["quantity"]))
+        order = {
+            "variety": params["variety"],
+            "ordertype": params["ordertype"],
+            "producttype": params["producttype"],
+            "duration": params.get("duration", "DAY"),
+            "price": float(params.get("price", 0)),
+            "triggerprice": float(params.get("triggerprice", 0)),
+            "quantity": quantity,
+            "disclosedquantity": "0",
+            # AngelOne doesn't echo ROBO squareoff/stoploss in the orderbook.
+            "squareoff": 0.0,
+            "stoploss": 0.0,
+            "trailingstoploss": 0.0,
+            "tradingsymbol": params["tradingsymbol"],
+            "transactiontype": params["transactiontype"],
+            "exchange": params.get("exchange", "NSE"),
+            "symboltoken": str(params["symboltoken"]),
+            "ordertag": params.get("ordertag", ""),
+            "instrumenttype": "",
+            "strikeprice": -1.0,
+            "optiontype": "",
+            "expirydate": "",
+            "lotsize": "1",
+            "cancelsize": "0",
+            "averageprice": 0.0,
+            "filledshares": "0",
+            "unfilledshares": quantity,
+            "orderid": orderid,
+            "text": "",
+            "status": "open",
+            "orderstatus": "open",
+            "updatetime": now,
+            "exchtime": now,
+            "exchorderupdatetime": now,
+            "fillid": "",
+            "filltime": "",
+            "parentorderid": "",
+            "uniqueorderid": str(uuid.uuid4()),
+        }
+        order.update(fields)
+        self.orders[orderid] = order
+        self.working[orderid] = order
+        return order
+
+    def set_status(self, order, status, text=""):
+        now = timestr()
+        order["status"] = order["orderstatus"] = status
+        order["text"] = text
+        order["updatetime"] = order["exchtime"] = order["exchorderupdatetime"] = now
+        if status not in WORKING_STATUSES:
+            self.working.pop(order["orderid"], None)
+            if status == "cancelled":
+                order["cancelsize"] = order["unfilledshares"]
+
+    def validate_order(self, params):
+        ''' Error response for a bad placeOrder request, None if it's good.
+        '''
+        for key in ("variety", "tradingsymbol", "symboltoken", "transactiontype",
+                    "ordertype", "producttype", "quantity"):
+            if key not in params:
+                return error("Missing %s" % key, ERR_NOT_SPECIFIED)
+        if params["variety"] not in ("NORMAL", "ROBO"):
+            return error("Invalid Order Variety", ERR_INVALID_VARIETY)
+        if params["producttype"] not in ("DELIVERY", "INTRADAY", "BO"):
+            return error("Invalid Product Type", ERR_INVALID_PRODUCTTYPE)
+        if (params["variety"] == "ROBO") != (params["producttype"] == "BO"):
+            return error("Invalid Product Type", ERR_INVALID_PRODUCTTYPE)
+        if params["transactiontype"] not in ("BUY", "SELL"):
+            return error("Invalid transactiontype %s" % params["transactiontype"], ERR_NOT_SPECIFIED)
+        # We don't place SL/SL-M orders.
+        if params["ordertype"] not in ("MARKET", "LIMIT"):
+            return error("ordertype %s not supported by mock broker" % params["ordertype"],
+                         ERR_NOT_SPECIFIED)
+        if int(params["quantity"]) <= 0:
+            return error("Invalid quantity", ERR_NOT_SPECIFIED)
+        if params["ordertype"] == "LIMIT" and float(params.get("price", 0)) <= 0:
+            return error("Invalid price", ERR_NOT_SPECIFIED)
+        if params["variety"] == "ROBO":
+            if params["ordertype"] != "LIMIT":
+                return error("ROBO orders must be LIMIT orders", ERR_NOT_SPECIFIED)
+            if float(params.get("squareoff", 0)) <= 0 or float(params.get("stoploss", 0)) <= 0:
+                return error("ROBO orders must have squareoff and stoploss", ERR_NOT_SPECIFIED)
+        return None
+
+    def place_order(self, params):
+        resp = self.validate_order(params)
+        if resp is not None:
+            return resp
+
+        with self.lock:
+            order = self.new_order(params)
+            if params["variety"] == "ROBO":
+                self.suborders[order["orderid"]] = {
+                    "squareoff": float(params["squareoff"]),
+                    "stoploss": float(params["stoploss"]),
+                }
+            self.stats.orders += 1
+            return ok({"script": order["tradingsymbol"],
+                       "orderid": order["orderid"],
+                       "uniqueorderid": order["uniqueorderid"]})
+
+    def modify_order(self, params):
+        with self.lock:
+            order = self.orders.get(params.get("orderid"))
+            if order is None:
+                return error("Order not found", ERR_ORDER_NOT_FOUND)
+            if order["orderid"] not in self.working:
+                return error("Order is %s, cannot modify" % order["orderstatus"], ERR_NOT_SPECIFIED)
+
+            if "price" in params:
+                order["price"] = float(params["price"])
+            if "triggerprice" in params:
+                order["triggerprice"] = float(params["triggerprice"])
+            if "quantity" in params:
+                order["quantity"] = order["unfilledshares"] = str(int(params["quantity"]))
+            if "ordertype" in params and order["parentorderid"] == "":
+                order["ordertype"] = params["ordertype"]
+            self.set_status(order, order["orderstatus"])
+            return ok({"orderid": order["orderid"], "uniqueorderid": order["uniqueorderid"]})
+
+    def cancel_order(self, params):
+        with self.lock:
+            order = self.orders.get(params.get("orderid"))
+            if order is None:
+                return error("Order not found", ERR_ORDER_NOT_FOUND)
+
+            resp = ok({"orderid": order["orderid"], "uniqueorderid": order["uniqueorderid"]})
+            if order["orderid"] in self.working:
+                self.set_status(order, "cancelled", "Cancelled by user")
+                return resp
+
+            #
+            # Cancelling a complete ROBO order exits the position, the
+            # stoploss sub-order completes at the LTP, the target is
+            # cancelled.
+            #
+            legs = self.suborders.get(order["orderid"])
+            if (order["orderstatus"] == "complete" and legs is not None and
+                    "target" in legs and legs["target"]["orderid"] in self.working):
+                stoploss = legs["stoploss"]
+                ltp = self.prices.get(self.symbol(order["tradingsymbol"]))
+                # Cancels the target, see fill().
+                self.fill(stoploss, ltp if ltp is not None else stoploss["triggerprice"])
+                return resp
+
+            return error("Order is %s, cannot cancel" % order["orderstatus"], ERR_NOT_SPECIFIED)
+
+    def fill(self, order, price):
+        ''' Fill order completely at price.
+        '''
+        now = time.time()
+        fillid = "%d" % self.next_fillid
+        self.next_fillid += 1
+        quantity = int(order["quantity"])
+        price = to_tick(price)
+
+        order["averageprice"] = price
+        order["filledshares"] = order["quantity"]
+        order["unfilledshares"] = "0"
+        order["fillid"] = fillid
+        order["filltime"] = time.strftime("%H:%M:%S", time.localtime(now))
+        self.set_status(order, "complete")
+        self.stats.fills += 1
+
+        self.trades.append({
+            "exchange": order["exchange"],
+            "producttype": order["producttype"],
+            "tradingsymbol": order["tradingsymbol"],
+            "instrumenttype": "",
+            "symbolgroup": "EQ",
+            "strikeprice": "-1",
+            "optiontype": "",
+            "expirydate": "",
+            "marketlot": "1",
+            "precision": "2",
+            "multiplier": "-1",
+            "tradevalue": "%.2f" % (price * quantity),
+            "transactiontype": order["transactiontype"],
+            "fillprice": price,
+            "fillsize": order["quantity"],
+            "orderid": order["orderid"],
+            "fillid": fillid,
+            "filltime": order["filltime"],
+        })
+
+        key = (order["tradingsymbol"], order["producttype"])
+        position = self.portfolio.get(key)
+        if position is None:
+            position = {"order": order, "buyqty": 0, "sellqty": 0,
+                        "buyamount": 0.0, "sellamount": 0.0}
+            self.portfolio[key] = position
+        side = "buy" if order["transactiontype"] == "BUY" else "sell"
+        position[side + "qty"] += quantity
+        position[side + "amount"] += price * quantity
+
+        parent = self.orders.get(order["parentorderid"])
+        if order["variety"] == "ROBO" and parent is None:
+            self.create_suborders(order)
+        elif parent is not None:
+            # One Cancels Other.
+            legs = self.suborders[parent["orderid"]]
+            other = legs["stoploss"] if order is legs["target"] else legs["target"]
+            if other["orderid"] in self.working:
+                self.set_status(other, "cancelled", "Cancelled by OCO")
+
+    def create_suborders(self, order):
+        ''' Target and stoploss sub-orders of ROBO order, which just filled.
+        '''
+        legs = self.suborders[order["orderid"]]
+        price = order["price"]
+        if order["transactiontype"] == "BUY":
+            side = "SELL"
+            target = to_tick(price + legs["squareoff"])
+            trigger = to_tick(price - legs["stoploss"])
+            limit = to_tick(trigger * (1 - SL_LIMIT_BUFFER))
+        else:
+            side = "BUY"
+            target = to_tick(price - legs["squareoff"])
+            trigger = to_tick(price + legs["stoploss"])
+            limit = to_tick(trigger * (1 + SL_LIMIT_BUFFER))
+
+        params = dict(variety="ROBO", producttype="BO", tradingsymbol=order["tradingsymbol"],
+                      symboltoken=order["symboltoken"], transactiontype=side,
+                      quantity=order["quantity"])
+        legs["target"] = self.new_order(dict(params, ordertype="LIMIT", price=target))
+        legs["stoploss"] = self.new_order(dict(params, ordertype="STOPLOSS_LIMIT",
+                                               price=limit, triggerprice=trigger))
+        for leg in (legs["target"], legs["stoploss"]):
+            leg["parentorderid"] = order["orderid"]
+            leg["uniqueorderid"] = leg["orderid"]
+            leg["disclosedquantity"] = leg["quantity"]
+        self.set_status(legs["stoploss"], "trigger pending")
+
+    def match(self):
+        ''' Fill/trigger the working orders and GTT rules the LTP crossed.
+        '''
+        with self.lock:
+            self.prices.step()
+
+            for order in list(self.working.values()):
+                # Cancelled by OCO, when its sibling filled in this match.
+                if order["orderid"] not in self.working:
+                    continue
+                ltp = self.prices.get(self.symbol(order["tradingsymbol"]), order["price"])
+                if ltp is None:
+                    continue
+                buy = (order["transactiontype"] == "BUY")
+
+                if order["orderstatus"] == "trigger pending":
+                    if (ltp >= order["triggerprice"]) if buy else (ltp <= order["triggerprice"]):
+                        # Triggered stoploss sub-order goes to the exchange as LIMIT.
+                        order["ordertype"] = "LIMIT"
+                        self.set_status(order, "open")
+                    else:
+                        continue
+
+                if order["ordertype"] == "MARKET":
+                    self.fill(order, ltp)
+                elif buy and ltp <= order["price"]:
+                    self.fill(order, min(ltp, order["price"]))
+                elif not buy and ltp >= order["price"]:
+                    self.fill(order, max(ltp, order["price"]))
+
+            for rule in self.gtts.values():
+                if rule["status"] != "NEW":
+                    continue
+                ltp = self.prices.get(self.symbol(rule["tradingsymbol"]))
+                if ltp is None:
+                    continue
+                if self.gtt_above[rule["id"]] is None:
+                    self.gtt_above[rule["id"]] = (rule["triggerprice"] > ltp)
+                    continue
+                if ((ltp >= rule["triggerprice"]) if self.gtt_above[rule["id"]] else
+                        (ltp <= rule["triggerprice"])):
+                    rule["status"] = "SENTTOEXCHANGE"
+                    rule["updateddate"] = timestr()
+                    self.new_order(dict(variety="NORMAL", ordertype="LIMIT",
+                                        producttype="DELIVERY",
+                                        tradingsymbol=rule["tradingsymbol"],
+                                        symboltoken=rule["symboltoken"],
+                                        transactiontype=rule["transactiontype"],
+                                        price=rule["price"], quantity=rule["qty"]))
+
+    def order_book(self, params):
+        with self.lock:
+            # AngelOne returns null, not [], when there are no orders.
+            return ok(json.loads(json.dumps(list(self.orders.values()))) or None)
+
+    def trade_book(self, params):
+        with self.lock:
+            return ok(json.loads(json.dumps(self.trades)) or None)
+
+    #
+    # Portfolio.
+    #
+
+    def realised(self, position):
+        closed = min(position["buyqty"], position["sellqty"])
+        if closed == 0:
+            return 0.0
+        return closed * ((position["sellamount"] / position["sellqty"]) -
+                         (position["buyamount"] / position["buyqty"]))
+
+    def positions_json(self):
+        positions = []
+        for (tradingsymbol, producttype), position in self.portfolio.items():
+            order = position["order"]
+            buyavg = position["buyamount"] / position["buyqty"] if position["buyqty"] else 0
+            sellavg = position["sellamount"] / position["sellqty"] if position["sellqty"] else 0
+            netqty = position["buyqty"] - position["sellqty"]
+            netvalue = position["sellamount"] - position["buyamount"]
+            netprice = abs(netvalue / netqty) if netqty else 0
+            positions.append({
+                "exchange": order["exchange"],
+                "symboltoken": order["symboltoken"],
+                "producttype": producttype,
+                "tradingsymbol": tradingsymbol,
+                "symbolname": self.symbol(tradingsymbol),
+                "instrumenttype": "",
+                "priceden": "1",
+                "pricenum": "1",
+                "genden": "1",
+                "gennum": "1",
+                "precision": "2",
+                "multiplier": "-1",
+                "boardlotsize": "1",
+                "buyqty": str(position["buyqty"]),
+                "sellqty": str(position["sellqty"]),
+                "buyamount": "%.2f" % position["buyamount"],
+                "sellamount": "%.2f" % position["sellamount"],
+                "symbolgroup": "EQ",
+                "strikeprice": "-1",
+                "optiontype": "",
+                "expirydate": "",
+                "lotsize": "1",
+                "cfbuyqty": "0",
+                "cfsellqty": "0",
+                "cfbuyamount": "0",
+                "cfsellamount": "0",
+                "buyavgprice": "%.2f" % buyavg,
+                "sellavgprice": "%.2f" % sellavg,
+                "avgnetprice": "%.2f" % netprice,
+                "netvalue": "%.2f" % netvalue,
+                "netqty": str(netqty),
+                "totalbuyvalue": "%.2f" % position["buyamount"],
+                "totalsellvalue": "%.2f" % position["sellamount"],
+                "cfbuyavgprice": "0",
+                "cfsellavgprice": "0",
+                "totalbuyavgprice": "%.2f" % buyavg,
+                "totalsellavgprice": "%.2f" % sellavg,
+                "netprice": "%.2f" % netprice,
+            })
+        return positions
+
+    def positions(self, params):
+        with self.lock:
+            return ok(self.positions_json() or None)
+
+    def holdings(self, params):
+        ''' Today's net DELIVERY buys, as T1 quantity.
+        '''
+        holdings = []
+        with self.lock:
+            for (tradingsymbol, producttype), position in self.portfolio.items():
+                netqty = position["buyqty"] - position["sellqty"]
+                if producttype != "DELIVERY" or netqty <= 0:
+                    continue
+                order = position["order"]
+                avg = position["buyamount"] / position["buyqty"]
+                ltp = self.prices.get(self.symbol(tradingsymbol)) or avg
+                holdings.append({
+                    "tradingsymbol": tradingsymbol,
+                    "exchange": order["exchange"],
+                    "isin": "",
+                    "t1quantity": netqty,
+                    "realisedquantity": 0,
+                    "quantity": netqty,
+                    "authorisedquantity": 0,
+                    "product": "DELIVERY",
+                    "collateralquantity": None,
+                    "collateraltype": None,
+                    "haircut": 0,
+                    "averageprice": round(avg, 2),
+                    "ltp": ltp,
+                    "symboltoken": order["symboltoken"],
+                    "close": ltp,
+                    "profitandloss": round((ltp - avg) * netqty, 2),
+                    "pnlpercentage": round((ltp - avg) * 100 / avg, 2),
+                })
+
+        value = sum(h["ltp"] * h["quantity"] for h in holdings)
+        invested = sum(h["averageprice"] * h["quantity"] for h in holdings)
+        return ok({"holdings": holdings,
+                   "totalholding": {
+                       "totalholdingvalue": round(value, 2),
+                       "totalinvvalue": round(invested, 2),
+                       "totalprofitandloss": round(value - invested, 2),
+                       "totalpnlpercentage": round((value - invested) * 100 / invested, 2)
+                                             if invested else 0}})
+
+    #
+    # GTT.
+    #
+
+    def create_gtt(self, params):
+        for key in ("tradingsymbol", "symboltoken", "transactiontype", "price",
+                    "triggerprice", "qty"):
+            if key not in params:
+                return error("Missing %s" % key, ERR_NOT_SPECIFIED)
+        if float(params["triggerprice"]) <= 0 or float(params["price"]) <= 0 or int(params["qty"]) <= 0:
+            return error("Invalid price/triggerprice/qty", ERR_NOT_SPECIFIED)
+
+        with self.lock:
+            ruleid = self.next_ruleid
+            self.next_ruleid += 1
+            now = time.time()
+            timeperiod = int(params.get("timeperiod", 365))
+            rule = {
+                "id": ruleid,
+                "clientid": self.clientcode,
+                "tradingsymbol": params["tradingsymbol"],
+                "symboltoken": str(params["symboltoken"]),
+                "exchange": params.get("exchange", "NSE"),
+                "producttype": "DELIVERY",
+                "transactiontype": params["transactiontype"],
+                "price": float(params["price"]),
+                "qty": int(params["qty"]),
+                "triggerprice": float(params["triggerprice"]),
+                "disclosedqty": int(params.get("disclosedqty", params["qty"])),
+                "timeperiod": timeperiod,
+                "status": "NEW",
+                "createddate": timestr(now),
+                "updateddate": timestr(now),
+                "expirydate": timestr(now + timeperiod * 86400),
+            }
+            self.gtts[ruleid] = rule
+            self.set_gtt_direction(rule)
+            self.stats.gtts += 1
+            return ok({"id": ruleid})
+
+    def set_gtt_direction(self, rule):
+        ''' A rule triggers when the LTP crosses its triggerprice from where it
+            is now, see match().
+        '''
+        ltp = self.prices.get(self.symbol(rule["tradingsymbol"]))
+        self.gtt_above[rule["id"]] = (rule["triggerprice"] > ltp) if ltp is not None else None
+
+    def get_rule(self, params):
+        try:
+            return self.gtts.get(int(params.get("id")))
+        except (TypeError, ValueError):
+            return None
+
+    def modify_gtt(self, params):
+        with self.lock:
+            rule = self.get_rule(params)
+            if rule is None:
+                return error("Rule not found", ERR_NOT_SPECIFIED)
+            if rule["status"] != "NEW":
+                return error("Rule is %s, cannot modify" % rule["status"], ERR_NOT_SPECIFIED)
+            for key, cast in (("price", float), ("triggerprice", float),
+                              ("qty", int), ("disclosedqty", int)):
+                if key in params:
+                    rule[key] = cast(params[key])
+            rule["updateddate"] = timestr()
+            self.set_gtt_direction(rule)
+            return ok({"id": rule["id"]})
+
+    def cancel_gtt(self, params):
+        with self.lock:
+            rule = self.get_rule(params)
+            if rule is None:
+                return error("Rule not found", ERR_NOT_SPECIFIED)
+            if rule["status"] != "NEW":
+                return error("Rule is %s, cannot cancel" % rule["status"], ERR_NOT_SPECIFIED)
+            rule["status"] = "CANCELLED"
+            rule["updateddate"] = timestr()
+            return ok({"id": rule["id"]})
+
+    def gtt_list(self, params):
+        ''' Rules with one of the given statuses, page (from 1) of count rules.
+        '''
+        statuses = params.get("status", ["FORALL"])
+        page = max(1, int(params.get("page", 1)))
+        count = max(1, int(params.get("count", 10)))
+        with self.lock:
+            rules = [rule for rule in reversed(list(self.gtts.values()))
+                     if "FORALL" in statuses or rule["status"] in statuses]
+            return ok(json.loads(json.dumps(rules[(page - 1) * count:page * count])))
+
+    def gtt_details(self, params):
+        with self.lock:
+            rule = self.get_rule(params)
+            if rule is None:
+                return error("Rule not found", ERR_NOT_SPECIFIED)
+            return ok(dict(rule))
+
+class RouteLimit:
+    ''' requests/sec allowed on a route. Unlike ratelimit.TokenBucket,
+        requests over the limit are rejected and not delayed.
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def allow(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class MockBrokerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, args, exchange, stats):
+        super().__init__((args.host, args.port), RequestHandler)
+        self.args = args
+        self.exchange = exchange
+        self.stats = stats
+        self.rng = random.Random(args.seed)
+        self.limits = {path: RouteLimit(rate) for path, (_, rate) in ROUTES.items()}
+        self.limits_lock = threading.Lock()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like apiconnect.angelone.in.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, code, body, content_type="application/json"):
+        body = body.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_api()
+
+    def do_POST(self):
+        self.handle_api()
+
+    def handle_api(self):
+        server = self.server
+        args = server.args
+        stats = server.stats
+
+        path = urlsplit(self.path).path
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length > 0 else b""
+
+        route = ROUTES.get(path)
+        if route is None:
+            self.send(404, json.dumps(error("No route %s" % path, ERR_NOT_SPECIFIED)))
+            return
+        method, _ = route
+
+        with server.limits_lock:
+            stats.requests += 1
+            allowed = args.no_rate_limits or server.limits[path].allow(time.monotonic())
+            inject_error = server.rng.random() < args.error_rate
+            delay = (args.latency_ms + server.rng.uniform(0, args.jitter_ms)) / 1000.0
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if not allowed:
+            stats.rate_limited += 1
+            self.send(403, RATE_LIMIT_TEXT, content_type="text/plain")
+            return
+
+        if inject_error:
+            stats.errors += 1
+            self.send(200, json.dumps(error("Something Went Wrong, Please Try After Sometime",
+                                            ERR_SOMETHING_WENT_WRONG)))
+            return
+
+        exchange = server.exchange
+        if method != "login" and not exchange.authorized(self.headers.get("Authorization")):
+            self.send(200, json.dumps(error("Invalid Token", ERR_INVALID_TOKEN)))
+            return
+
+        # GET requests carry their (unused) params in the query string.
+        try:
+            params = json.loads(body) if body else {}
+            resp = getattr(exchange, method)(params)
+        except Exception as e:
+            resp = error("Bad request: %s" % e, ERR_NOT_SPECIFIED)
+        self.send(200, json.dumps(resp))
+
+def matcher(exchange, interval):
+    while True:
+        time.sleep(interval)
+        exchange.match()
+
+def report(exchange, stats, interval):
+    last_requests = 0
+    while True:
+        time.sleep(interval)
+        with exchange.lock:
+            working = len(exchange.working)
+            gtts = sum(1 for rule in exchange.gtts.values() if rule["status"] == "NEW")
+        print("[mockbroker] %.0f requests/sec, total requests=%d, rate limited=%d, "
+              "errors=%d, orders=%d, fills=%d, working=%d, gtts=%d (%d pending)" %
+              ((stats.requests - last_requests) / interval, stats.requests,
+               stats.rate_limited, stats.errors, stats.orders, stats.fills,
+               working, stats.gtts, gtts), flush=True)
+        last_requests = stats.requests
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mock AngelOne SmartAPI REST server for load testing the pylive order pipeline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--ltp-table", default=None,
+                        help="pylive LTP table to take prices from, f.e., ../orders/ltp/ltp.table (default: random walk)")
+    parser.add_argument("--match-ms", type=float, default=100,
+                        help="match orders against the LTP every these many ms (default: 100)")
+    parser.add_argument("--latency-ms", type=float, default=20,
+                        help="added latency of every request (default: 20)")
+    parser.add_argument("--jitter-ms", type=float, default=10,
+                        help="added random latency, up to these many ms (default: 10)")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of requests failed with AB1004 (default: 0)")
+    parser.add_argument("--no-rate-limits", action="store_true",
+                        help="don't enforce AngelOne's per API rate limits")
+    parser.add_argument("--funds", type=float, default=1000000,
+                        help="available cash (default: 1000000)")
+    parser.add_argument("--seed", type=int, default=20231117,
+                        help="random seed for latency, errors and random walk prices")
+    parser.add_argument("--report-secs", type=float, default=10,
+                        help="print stats every these many seconds (default: 10)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    stats = Stats()
+    exchange = Exchange(args, stats)
+    server = MockBrokerServer(args, exchange, stats)
+
+    threading.Thread(target=matcher, args=(exchange, args.match_ms / 1000.0), daemon=True).start()
+    threading.Thread(target=report, args=(exchange, stats, args.report_secs), daemon=True).start()
+
+    print("[mockbroker] Listening on http://%s:%d, latency=%g+%gms, error rate=%g, "
+          "rate limits %s, prices from %s" %
+          (args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate,
+           "off" if args.no_rate_limits else "on",
+           args.ltp_table if args.ltp_table else "random walk"), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
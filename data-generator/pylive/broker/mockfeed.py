@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+import sys, os, time, json, random, struct, base64, hashlib, argparse, asyncio
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+from SmartApi.smartWebSocketV2 import SmartWebSocketV2
+
+#
+# Local mock of the AngelOne SmartWebSocketV2 feed, for load testing
+# CandleGenerator with more tokens and higher tick rates than the real feed
+# gives us.
+#
+# It speaks the same protocol as wss://smartapisocket.angelone.in/smart-stream
+# as far as SmartWebSocketV2 is concerned:
+# - subscribe/unsubscribe json requests (action 1/0, with mode and tokenList),
+# - "ping" text heartbeat answered with "pong", and websocket ping/pong,
+# - binary LTP/QUOTE/SNAP_QUOTE ticks, packed with the same layouts that
+#   SmartWebSocketV2 parses them with.
+#
+# Every connection gets synthetic ticks (random walk prices, increasing day
+# volume) for the tokens it subscribed, at --rate ticks/sec. For the first
+# --burst-secs seconds of every minute the rate is multiplied by --burst and
+# every subscribed token gets a tick at the 0th second, like liquid stocks do
+# in the real market.
+#
+# Ticks are stamped with a simulated exchange clock that starts at
+# --start-time (09:15 IST today by default) so that pylive accepts them
+# irrespective of when we run the test.
+#
+# Point pylive at it with ws_feed_url in pylive/backtester.json, or better
+# use broker/replay.py which doesn't login or place orders, f.e.,
+# $ ./mockfeed.py --port 8765 --rate 5000 &
+# $ ./replay.py --feed ws://127.0.0.1:8765 --duration 600
+# Set ws_feed_tokens to subscribe to more tokens than the stocklist has.
+# With replay.py --partitions N (or feed_partitions) pylive opens N
+# connections, each with its share of the tokens and its own --rate, all on
+# the same simulated clock.
+#
+# This only uses the standard library (plus SmartApi for the packet layouts)
+# so that it can run anywhere.
+#
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# IST is UTC+05:30.
+IST_OFFSET_SECS = 19800
+
+# Generator wakes up these many times a second to send ticks.
+TICKS_PER_SEC_SLOTS = 100
+
+class TokenState:
+    ''' Synthetic market state of one token.
+    '''
+    def __init__(self, token, exchange_type, mode, rng):
+        self.token = token
+        self.token_bytes = token.encode()
+        self.exchange_type = exchange_type
+        self.mode = mode
+        self.rng = rng
+
+        # Prices in paise, as in the real feed.
+        self.close = rng.randrange(10000, 500000)
+        self.ltp = self.close
+        self.open = None
+        self.high = None
+        self.low = None
+        self.volume = 0
+        self.seq = 0
+
+    def next_tick(self, exchange_timestamp_ms):
+        ''' Move the price/volume and return the packed tick.
+        '''
+        step = max(5, self.ltp // 2000)
+        self.ltp = max(5, self.ltp + self.rng.choice((-step, 0, step)))
+        if self.open is None:
+            self.open = self.high = self.low = self.ltp
+        self.high = max(self.high, self.ltp)
+        self.low = min(self.low, self.ltp)
+        ltq = self.rng.randrange(1, 500)
+        self.volume += ltq
+        self.seq += 1
+
+        if self.mode == SmartWebSocketV2.LTP_MODE:
+            return SmartWebSocketV2._LTP_STRUCT.pack(
+                    self.mode, self.exchange_type, self.token_bytes,
+                    self.seq, exchange_timestamp_ms, self.ltp)
+
+        quote = (self.mode, self.exchange_type, self.token_bytes,
+                 self.seq, exchange_timestamp_ms, self.ltp, ltq, self.ltp,
+                 self.volume, float(self.volume), float(self.volume),
+                 self.open, self.high, self.low, self.close)
+
+        if self.mode == SmartWebSocketV2.QUOTE:
+            return SmartWebSocketV2._QUOTE_STRUCT.pack(*quote)
+
+        return SmartWebSocketV2._SNAP_QUOTE_STRUCT.pack(
+                *quote, exchange_timestamp_ms // 1000, 0, 0.0,
+                self.close * 11 // 10, self.close * 9 // 10,
+                self.close * 13 // 10, self.close * 7 // 10)
+
+class SimClock:
+    ''' Simulated exchange clock, starts at start_epoch and runs speed times
+        the wall clock.
+    '''
+    def __init__(self, start_epoch, speed):
+        self.start_epoch = start_epoch
+        self.speed = speed
+        self.wall_start = time.time()
+
+    def now(self):
+        return self.start_epoch + (time.time() - self.wall_start) * self.speed
+
+class Stats:
+    def __init__(self):
+        self.connections = 0
+        self.ticks = 0
+        self.bytes = 0
+
+#
+# Minimal websocket (RFC 6455) server side framing.
+# Client frames are always masked, ours never are.
+#
+
+async def ws_handshake(reader, writer):
+    request = await reader.readuntil(b"\r\n\r\n")
+    key = None
+    for line in request.decode("latin-1").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "sec-websocket-key":
+            key = value.strip()
+    if key is None:
+        writer.write(b"HTTP/1.1 400 Bad Request\r\n\r\n")
+        await writer.drain()
+        return False
+
+    accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+    writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                  "Upgrade: websocket\r\n"
+                  "Connection: Upgrade\r\n"
+                  "Sec-WebSocket-Accept: %s\r\n\r\n" % accept).encode())
+    await writer.drain()
+    return True
+
+async def ws_read_frame(reader):
+    ''' Returns (opcode, payload) for the next frame.
+    '''
+    b0, b1 = await reader.readexactly(2)
+    opcode = b0 & 0x0F
+    length = b1 & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if (b1 & 0x80) else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return opcode, payload
+
+def ws_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+class FeedConnection:
+    ''' One client connection, with its own subscriptions and tick generator.
+    '''
+    def __init__(self, args, clock, stats, reader, writer):
+        self.args = args
+        self.clock = clock
+        self.stats = stats
+        self.reader = reader
+        self.writer = writer
+        self.rng = random.Random(args.seed)
+        self.peer = writer.get_extra_info("peername")
+
+        # token -> TokenState.
+        self.tokens = {}
+        # Tokens in subscription order, for round robin ticks.
+        self.token_order = []
+        self.next_token = 0
+        self.closed = False
+
+    def on_request(self, request):
+        action = request.get("action")
+        params = request.get("params", {})
+        mode = params.get("mode", SmartWebSocketV2.QUOTE)
+        for token_list in params.get("tokenList", []):
+            exchange_type = token_list.get("exchangeType", SmartWebSocketV2.NSE_CM)
+            for token in token_list.get("tokens", []):
+                if action == SmartWebSocketV2.SUBSCRIBE_ACTION:
+                    if token not in self.tokens:
+                        self.token_order.append(token)
+                    self.tokens[token] = TokenState(token, exchange_type, mode, self.rng)
+                elif action == SmartWebSocketV2.UNSUBSCRIBE_ACTION:
+                    if self.tokens.pop(token, None) is not None:
+                        self.token_order.remove(token)
+
+        print("[mockfeed] %s: action=%s mode=%s, %d tokens subscribed" %
+              (self.peer, action, mode, len(self.tokens)), flush=True)
+
+    async def read_loop(self):
+        while not self.closed:
+            try:
+                opcode, payload = await ws_read_frame(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+
+            if opcode == OP_TEXT:
+                text = payload.decode()
+                # Application heartbeat.
+                if text == SmartWebSocketV2.HEART_BEAT_MESSAGE:
+                    self.writer.write(ws_frame(OP_TEXT, b"pong"))
+                    continue
+                try:
+                    self.on_request(json.loads(text))
+                except ValueError as e:
+                    print("[mockfeed] %s: bad request %r: %s" % (self.peer, text, e), flush=True)
+            elif opcode == OP_PING:
+                self.writer.write(ws_frame(OP_PONG, payload))
+            elif opcode == OP_CLOSE:
+                self.writer.write(ws_frame(OP_CLOSE, payload[:2]))
+                break
+
+        self.closed = True
+
+    def send_ticks(self, count, exchange_timestamp_ms):
+        ''' Send count ticks, round robin over the subscribed tokens.
+        '''
+        order = self.token_order
+        if not order:
+            return
+        frames = []
+        for _ in range(count):
+            if self.next_token >= len(order):
+                self.next_token = 0
+            state = self.tokens[order[self.next_token]]
+            self.next_token += 1
+            frames.append(ws_frame(OP_BINARY, state.next_tick(exchange_timestamp_ms)))
+        data = b"".join(frames)
+        self.writer.write(data)
+        self.stats.ticks += count
+        self.stats.bytes += len(data)
+
+    async def tick_loop(self):
+        args = self.args
+        slot = 1.0 / TICKS_PER_SEC_SLOTS
+        # Fractional ticks carried over to the next slot.
+        carry = 0.0
+        last_minute = None
+
+        while not self.closed:
+            await asyncio.sleep(slot)
+            now = self.clock.now()
+            exchange_timestamp_ms = int(now * 1000)
+            minute, second = divmod(int(now), 60)
+
+            # Every token ticks at the start of a new minute.
+            if minute != last_minute:
+                if last_minute is not None:
+                    self.send_ticks(len(self.token_order), exchange_timestamp_ms)
+                last_minute = minute
+
+            rate = args.rate
+            if second < args.burst_secs:
+                rate *= args.burst
+
+            carry += rate * slot * self.clock.speed
+            count = int(carry)
+            carry -= count
+            self.send_ticks(count, exchange_timestamp_ms)
+
+            # Let a slow client push back on us, like a real socket would.
+            await self.writer.drain()
+
+    async def run(self):
+        self.stats.connections += 1
+        print("[mockfeed] %s: connected" % (self.peer,), flush=True)
+        reader_task = asyncio.ensure_future(self.read_loop())
+        try:
+            await self.tick_loop()
+        except ConnectionError:
+            pass
+        self.closed = True
+        reader_task.cancel()
+        self.writer.close()
+        self.stats.connections -= 1
+        print("[mockfeed] %s: disconnected" % (self.peer,), flush=True)
+
+async def report(stats, interval):
+    last_ticks = 0
+    while True:
+        await asyncio.sleep(interval)
+        print("[mockfeed] connections=%d, %.0f ticks/sec, total ticks=%d, bytes=%d" %
+              (stats.connections, (stats.ticks - last_ticks) / interval,
+               stats.ticks, stats.bytes), flush=True)
+        last_ticks = stats.ticks
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mock SmartWebSocketV2 feed server for load testing pylive")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=1000,
+                        help="ticks/sec per connection, across all subscribed tokens (default: 1000)")
+    parser.add_argument("--burst", type=float, default=5,
+                        help="rate multiplier for the first --burst-secs of every minute (default: 5)")
+    parser.add_argument("--burst-secs", type=int, default=2,
+                        help="seconds of burst at the start of every minute (default: 2)")
+    parser.add_argument("--start-time", default="09:15",
+                        help="simulated exchange time (IST, HH:MM) to start at, today (default: 09:15)")
+    parser.add_argument("--clock-speed", type=float, default=1.0,
+                        help="simulated clock speed relative to wall clock (default: 1)")
+    parser.add_argument("--seed", type=int, default=20231117,
+                        help="random seed for the synthetic prices")
+    parser.add_argument("--report-secs", type=float, default=10,
+                        help="print send stats every these many seconds (default: 10)")
+    return parser.parse_args()
+
+def start_epoch(hhmm):
+    ''' Epoch of hhmm IST today.
+    '''
+    hour, minute = (int(x) for x in hhmm.split(":"))
+    ist_now = time.time() + IST_OFFSET_SECS
+    ist_midnight = ist_now - (ist_now % 86400)
+    return ist_midnight + hour * 3600 + minute * 60 - IST_OFFSET_SECS
+
+async def serve(args):
+    clock = SimClock(start_epoch(args.start_time), args.clock_speed)
+    stats = Stats()
+
+    async def on_connect(reader, writer):
+        if await ws_handshake(reader, writer):
+            await FeedConnection(args, clock, stats, reader, writer).run()
+        else:
+            writer.close()
+
+    server = await asyncio.start_server(on_connect, args.host, args.port)
+    print("[mockfeed] Listening on ws://%s:%d, rate=%g ticks/sec, burst=%gx for %ds, start=%s IST" %
+          (args.host, args.port, args.rate, args.burst, args.burst_secs, args.start_time),
+          flush=True)
+    asyncio.ensure_future(report(stats, args.report_secs))
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import sys, os, time, argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'common'))
+
+import config as cfg
+from helpers import *
+
+#
+# Replay websocket frames recorded by pylive.broker (with ws_record set in
+# pylive/backtester.json, see FrameLog.py) through the live tick path, i.e.,
+# SmartWebSocketV2._parse_binary_data() -> CandleGenerator.enqueue() ->
+# CandleGenerator.dequeue(), at the recorded pace (1x), N times faster, or as
+# fast as possible. This lets us reproduce and benchmark the tick path outside
+# market hours, with captured market days serving as repeatable loads.
+#
+# Instead of recorded frames it can also take ticks from a websocket feed,
+# usually the mock feed (see mockfeed.py), for --duration seconds, to find the
+# tick rate and token count at which the tick path can't keep up.
+#
+# Only CandleGenerator is run, no orders are placed/tracked, we don't login
+# to the broker and pyprocess is not run for the dumped candles. The
+# $stock.live.csv files and the LTP table are written under --outdir, not to
+# the live locations.
+#
+# f.e.
+# $ ./replay.py --frames ../frames/frames.2023-11-17.bin --speed 0
+# $ ./replay.py --feed ws://127.0.0.1:8765 --duration 600
+# $ ./replay.py --feed ws://127.0.0.1:8765 --duration 600 --partitions 4
+#
+# At the end it reports the replay rate, ticks/second handled by
+# CandleGenerator, the tick queue depth and the per-minute dump latency.
+#
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded websocket frames through CandleGenerator")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--frames",
+                        help="frames file recorded by pylive.broker")
+    source.add_argument("--feed",
+                        help="websocket feed url, f.e., ws://127.0.0.1:8765 for mockfeed.py")
+    parser.add_argument("--duration", type=float, default=300,
+                        help="seconds to run for with --feed (default: 300)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed relative to the recorded pace, 0 for max speed (default: 1)")
+    parser.add_argument("--partitions", type=int, default=None,
+                        help="feed partitions (websocket connections and candle workers), default: feed_partitions from config")
+    parser.add_argument("--outdir", default="/tmp/pylive.replay",
+                        help="directory for the live.csv files and LTP table (default: /tmp/pylive.replay)")
+    return parser.parse_args()
+
+def percentile(values, pct):
+    ''' pct percentile of values (which must not be empty), nearest rank.
+    '''
+    values = sorted(values)
+    idx = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[idx]
+
+def main():
+    args = parse_args()
+    ASSERT(args.speed >= 0, "--speed must be >= 0")
+
+    #
+    # Must be set before the broker and CandleGenerator are initialized.
+    #
+    if args.frames is not None:
+        ASSERT(os.path.exists(args.frames), "%s not found" % args.frames)
+        cfg.replay_file = args.frames
+        cfg.replay_speed = args.speed
+        # Replayer stats are reported from this process, replay in-process.
+        cfg.tick_ring = False
+    else:
+        cfg.ws_feed_url = args.feed
+    cfg.replay_outdir = args.outdir
+    # LTP table is created directly in outdir, make sure it exists.
+    os.makedirs(args.outdir, exist_ok=True)
+    cfg.historicaldir = os.path.join(args.outdir, "historical")
+    cfg.publish_latest = False
+    cfg.ws_record = False
+    if args.partitions is not None:
+        ASSERT(args.partitions >= 1, "--partitions must be >= 1")
+        cfg.feed_partitions = args.partitions
+
+    if cfg.broker['selection'] in ("angelone", "mock"):
+        import AngelOne as broker
+    else:
+        # Till we support other brokers.
+        ASSERT(False)
+
+    import CandleGenerator as CandleGenerator
+
+    if args.frames is not None:
+        PYPPass("==> Replaying %s at %s speed, output in %s" %
+                (args.frames, ("%gx" % args.speed) if args.speed > 0 else "max", args.outdir),
+                console=True)
+    else:
+        PYPPass("==> Taking ticks from %s for %gs, output in %s" %
+                (args.feed, args.duration, args.outdir), console=True)
+
+    broker.init()
+    ASSERT(broker.is_initialized())
+
+    CandleGenerator.init()
+    CandleGenerator.start()
+
+    cg = CandleGenerator.cg
+
+    #
+    # Sample the tick queue depth and tick rate while the replay runs.
+    #
+    max_qsize = 0
+    last_ticks = 0
+    start = time.perf_counter()
+    while CandleGenerator.ws_thread.is_alive():
+        if args.feed is not None and (time.perf_counter() - start) >= args.duration:
+            break
+        time.sleep(1)
+        qsize = sum(worker.q.qsize() for worker in cg.workers)
+        max_qsize = max(max_qsize, qsize)
+        ticks = CandleGenerator.get_ticks_received()
+        PYPInfo("replay: %d ticks/sec, qsize=%d",
+                ticks - last_ticks, qsize, console=True)
+        last_ticks = ticks
+
+    CandleGenerator.stop()
+    CandleGenerator.join()
+
+    latencies = [latency for worker in cg.workers for latency in worker.dump_latencies]
+
+    print("")
+    replayer = broker.replayer
+    if replayer is not None:
+        elapsed = replayer.elapsed()
+        print("Frames replayed       : %d in %.3fs (%.1f frames/sec)" %
+              (replayer.frames, elapsed, replayer.rate()))
+    else:
+        elapsed = time.perf_counter() - start
+        print("Feed                  : %s for %.3fs" % (args.feed, elapsed))
+    ticks = CandleGenerator.get_ticks_received()
+    print("Ticks handled         : %d (%.1f ticks/sec), stale=%d" %
+          (ticks,
+           (ticks / elapsed) if elapsed > 0 else 0,
+           CandleGenerator.get_stale_ticks_received()))
+    print("Queue depth           : max sampled %d, max batch %d, batches %d, workers %d" %
+          (max_qsize,
+           max(worker.max_batch for worker in cg.workers),
+           sum(worker.batches for worker in cg.workers),
+           len(cg.workers)))
+    if latencies:
+        print("Minute dump latency   : n=%d avg=%.2fms p50=%.2fms p99=%.2fms max=%.2fms" %
+              (len(latencies),
+               sum(latencies) * 1000 / len(latencies),
+               percentile(latencies, 50) * 1000,
+               percentile(latencies, 99) * 1000,
+               max(latencies) * 1000))
+    else:
+        print("Minute dump latency   : no minute boundary crossed")
+
+if __name__ == '__main__':
+    main()
@@ -96,6 +96,164 @@ log_to_console = (logfile is None)
 # PYPDebug logs will be logged if verbose logging is configured.
 verbose = (config['verbose'] == "True")
 
+#
+# Logs below this level are dropped w/o even formatting them.
+# One of DEBUG, INFO, WARNING, ERROR. Optional, defaults to INFO.
+#
+log_level = config.get('log_level', "INFO")
+assert(log_level in ["DEBUG", "INFO", "WARNING", "ERROR"])
+
+#
+# If True, logs are written to the logfile/console by a background thread
+# and the PYP*() helpers just queue the log records. See helpers.py.
+# Optional, defaults to False.
+#
+async_logging = (config.get('async_logging', "False") == "True")
+
+#
+# PYPWarnRateLimited() logs warnings with the same key at most once every
+# log_ratelimit_secs seconds. Optional, defaults to 10 seconds.
+#
+log_ratelimit_secs = float(config.get('log_ratelimit_secs', "10"))
+
+#
+# Decode websocket ticks in lean mode, see SmartWebSocketV2._parse_binary_data_lean().
+# This is optional and defaults to full decoding, to not break older config files.
+#
+lean_ticks = (config.get('lean_ticks', "False") == "True")
+
+#
+# If tick_ring is True, the websocket runs in a separate ingest process which
+# passes ticks to the main process through a shared memory ring of
+# tick_ring_slots (must be a power of 2) fixed size records, see
+# broker/TickRing.py. Optional, defaults to the websocket thread in the main
+# process.
+#
+tick_ring = (config.get('tick_ring', "False") == "True")
+tick_ring_slots = int(config.get('tick_ring_slots', "65536"))
+
+#
+# Subscribed tokens are split into feed_partitions partitions by a stable hash
+# of the token (see token_partition()), each with its own websocket
+# connection and CandleGenerator worker that builds and dumps the candles of
+# its tokens. A minute is finalized once all workers have dumped it, or after
+# minute_barrier_timeout seconds. Optional, defaults to 1 partition.
+#
+feed_partitions = int(config.get('feed_partitions', "1"))
+assert(feed_partitions >= 1)
+minute_barrier_timeout = float(config.get('minute_barrier_timeout', "10"))
+
+#
+# Publish latest ltp/gap/pctchg/5ma/10ma for each stock in the terminal's
+# data/stock layout, see broker/LatestPublisher.py.
+# These are optional and the publisher is disabled by default.
+#
+publish_latest = (config.get('publish_latest', "False") == "True")
+publish_latest_dir = config.get('publish_latest_dir',
+                                os.path.join(srcdir, "..", "data", "stock"))
+publish_latest_interval_ms = int(config.get('publish_latest_interval_ms', "500"))
+publish_latest_history = int(config.get('publish_latest_history', "10"))
+assert(publish_latest_interval_ms > 0)
+assert(publish_latest_history > 0)
+
+#
+# $stock.live.csv files are written through handles kept open for the session,
+# see broker/LiveWriter.py.
+# If live_fsync is True, the files written at a minute boundary are fsynced
+# before pyprocess is run for finalizing the live data.
+# If live_writer_async is True, the files are written by a background thread
+# so that the tick thread can process the ticks of the new minute right away.
+# Both are optional and default to False.
+#
+live_fsync = (config.get('live_fsync', "False") == "True")
+live_writer_async = (config.get('live_writer_async', "False") == "True")
+
+#
+# If tick_metrics is True, tick path latency histograms are collected and
+# their percentiles are appended to tick_metrics_file every minute, see
+# broker/TickMetrics.py. Optional, disabled by default.
+# A warning is logged if the oldest queued tick has waited for more than
+# queue_age_alarm_ms (defaults to 1000ms) when the tick queue is drained.
+#
+tick_metrics = (config.get('tick_metrics', "False") == "True")
+tick_metrics_file = config.get('tick_metrics_file', os.path.join(logdir, "pylive.metrics"))
+queue_age_alarm_ms = float(config.get('queue_age_alarm_ms', "1000"))
+
+#
+# If ws_record is True, raw websocket frames are recorded in daily files in
+# ws_record_dir, which can later be replayed with broker/replay.py.
+# See broker/FrameLog.py. Optional, defaults to False.
+#
+ws_record = (config.get('ws_record', "False") == "True")
+ws_record_dir = config.get('ws_record_dir', os.path.join(pylivedir, "frames"))
+
+#
+# If ws_feed_url is set, the websocket connects to it instead of the broker's
+# feed, f.e., to the mock feed server broker/mockfeed.py for load testing.
+# With ws_feed_url set, ws_feed_tokens (if more than the stocks in stocklist)
+# is the number of tokens to subscribe to, the extra tokens are taken from
+# the broker's instruments.
+# Both are optional, by default we connect to the broker's feed.
+#
+ws_feed_url = config.get('ws_feed_url', "")
+ws_feed_tokens = int(config.get('ws_feed_tokens', "0"))
+
+#
+# These are not read from the config file, broker/replay.py sets them when
+# replaying recorded frames (or a mock feed) instead of the live feed.
+# replay_speed is relative to the recorded pace, 0 means as fast as possible.
+# replay_outdir is where replay writes what live would write in historicaldir
+# and pylive/orders/ltp, it's set whenever we run under broker/replay.py.
+#
+replay_file = None
+replay_speed = 1.0
+replay_outdir = None
+
+#
+# If order_updates is True, OrderPlacer subscribes to the broker's order update
+# websocket and applies order updates as they come. While it's connected the
+# full REST refresh of orders and portfolio runs only every
+# order_reconcile_interval seconds, for reconciliation. Optional, defaults to
+# True and 60 secs.
+#
+order_updates = (config.get('order_updates', "True") == "True")
+order_reconcile_interval = float(config.get('order_reconcile_interval', "60"))
+
+#
+# OrderPlacer places orders using placer_workers threads, orders for the same
+# symbol are always placed by the same thread, in order. When idle for
+# placer_keepalive_secs it makes a cheap broker call to keep the connection to
+# the broker warm for the next order. Optional, defaults to 4 and 30 secs.
+#
+placer_workers = int(config.get('placer_workers', "4"))
+placer_keepalive_secs = float(config.get('placer_keepalive_secs', "30"))
+assert(placer_workers >= 1)
+assert(placer_keepalive_secs > 0)
+
+#
+# All broker REST calls share a pool of keep-alive connections, so that they
+# don't pay for a TCP and TLS handshake every time. broker_http_pool_size is
+# the number of connections kept alive, it should be at least the number of
+# threads making concurrent broker calls (concurrent portfolio/order fetches
+# and placer_workers). broker_http_connect_timeout and broker_http_read_timeout
+# are the connect and read timeouts (secs) of every call.
+# Optional, defaults to 16, 3 secs and 7 secs.
+#
+broker_http_pool_size = int(config.get('broker_http_pool_size', "16"))
+broker_http_connect_timeout = float(config.get('broker_http_connect_timeout', "3"))
+broker_http_read_timeout = float(config.get('broker_http_read_timeout', "7"))
+assert(broker_http_pool_size >= 1)
+
+#
+# At auto-squareoff time OrderPlacer squares off all open ROBO orders
+# concurrently using squareoff_workers threads, and retries the ones that
+# fail up to squareoff_retries times. Optional, defaults to 8 and 2.
+#
+squareoff_workers = int(config.get('squareoff_workers', "8"))
+squareoff_retries = int(config.get('squareoff_retries', "2"))
+assert(squareoff_workers >= 1)
+assert(squareoff_retries >= 0)
+
 #
 # NOTE: basicConfig() should be called before any call to logging.info() etc,
 #       else the logger gets default initialized and doesn't use the arguments
@@ -111,7 +269,7 @@ logging.basicConfig(format='[pylive] %(asctime)s: %(message)s',
                     filename=logfile,
                     #filemode='w',   # don't append every run to the file.
                     filemode='a',   # append (not truncate) to not clear old logs.
-                    level=logging.INFO)
+                    level=getattr(logging, log_level))
 
 #
 # Now sanitize various oconfig and set easy-access variable names for each
@@ -152,5 +310,15 @@ assert(stocklist in ["NIFTY_50.csv", "NIFTY_100.csv", "NIFTY_200.csv"])
 # Broker information.
 broker = config['broker']
 
+#
 # Till we support other brokers assert for angelone.
-assert(broker['selection'] == 'angelone')
+# "mock" is AngelOne with the mock broker (broker/mockbroker.py, running at
+# broker['mock']['url']) in place of AngelOne's REST server, for load testing
+# the order pipeline. The mock broker has neither the feed nor the order
+# update websocket, so ticks must come from ws_feed_url (f.e.,
+# broker/mockfeed.py) and orders are tracked with REST refreshes.
+#
+assert(broker['selection'] in ['angelone', 'mock'])
+if broker['selection'] == 'mock':
+    assert(broker['mock']['url'] != "")
+    order_updates = False
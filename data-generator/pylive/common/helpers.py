@@ -18,13 +18,16 @@
 #       Sort this out before using it outside pylive.
 ############################################################################
 
-import sys, os, csv, json, atexit, traceback
+import sys, os, csv, json, atexit, traceback, time
 import multiprocessing
+import queue
 import pandas as pd
 import numpy as np
 import datetime
 import logging
+import logging.handlers
 import threading
+import zlib
 import pytz
 import functools
 from pprint import *
@@ -62,79 +65,215 @@ holiday_list_loaded = False
 # Callback to be called on exit.
 exit_cb = None
 
-def PYPLog(logstr, console=None, logfile=False):
+#
+# Asynchronous logging.
+#
+# If cfg.async_logging is set, the PYP*() logging helpers don't write to the
+# logfile/console in the caller's context, instead they just queue the log
+# record (w/o formatting it) to log_queue, and a background writer thread
+# (log_listener) formats the records and writes them to the logfile and
+# console. This keeps logging from competing with the tick processing threads
+# for disk and (mostly) for the GIL.
+#
+# Note: Since the record is formatted later, the arguments passed to the PYP*()
+#       helpers must not be modified after the call.
+#
+# Note: Queued records are lost if we exit w/o draining the queue, hence
+#       ASSERT() and atexit call stop_async_logging().
+#
+log_queue = None
+log_queue_handler = None
+log_listener = None
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    ''' QueueHandler which doesn't format the record in the caller's
+        context, the listener thread formats it.
+    '''
+    def prepare(self, record):
+        return record
+
+class _ConsoleHandler(logging.Handler):
+    ''' Runs in the listener thread and prints records which the PYP*()
+        helpers wanted to go to the console, with the color they asked for.
+    '''
+    def emit(self, record):
+        color = getattr(record, "pyp_console", None)
+        if color is None:
+            return
+        print(color + record.getMessage() + Fore.RESET + Style.RESET_ALL)
+
+def start_async_logging():
+    ''' Move the root logger's handlers to a background listener thread and
+        make the root logger just queue records for the listener.
+    '''
+    global log_queue
+    global log_queue_handler
+    global log_listener
+
+    root = logging.getLogger()
+    handlers = root.handlers[:] + [_ConsoleHandler()]
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    log_queue_handler = _DeferredQueueHandler(log_queue)
+    root.addHandler(log_queue_handler)
+
+    log_listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                                  respect_handler_level=True)
+    log_listener.start()
+
+    #
+    # A fork()ed child (f.e. OrderPlacer runner) doesn't have the listener
+    # thread, start a fresh listener (and queue) in the child.
+    #
+    os.register_at_fork(after_in_child=_restart_async_logging_in_child)
+    atexit.register(stop_async_logging)
+
+def _restart_async_logging_in_child():
+    global log_queue
+    global log_listener
+
+    if log_listener is None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    log_queue_handler.queue = log_queue
+    log_listener = logging.handlers.QueueListener(log_queue, *log_listener.handlers,
+                                                  respect_handler_level=True)
+    log_listener.start()
+
+def stop_async_logging():
+    ''' Write all queued log records and stop the listener thread.
+        Logging after this is synchronous.
+    '''
+    global log_listener
+
+    if log_listener is None:
+        return
+
+    listener = log_listener
+    log_listener = None
+
+    # Drain the queue and join the listener thread.
+    listener.stop()
+
+    # Any logs from now on are written in the caller's context.
+    root = logging.getLogger()
+    root.removeHandler(log_queue_handler)
+    for handler in listener.handlers:
+        if not isinstance(handler, _ConsoleHandler):
+            root.addHandler(handler)
+
+def _pyplog(level, tag, color, log_to_console, logstr, args):
+    ''' Common code for the PYP*() helpers.
+        Caller must have checked that the log is enabled before calling us.
+        logstr is formatted with args (if any) only when it's actually
+        written, which is in the listener thread for async logging.
+    '''
+    if log_listener is not None:
+        #
+        # Let the listener thread do all the formatting.
+        # The timestamp is taken now, but converted to string later.
+        #
+        if args:
+            logging.log(level, "[%s][%d][%s] " + logstr,
+                        datetime.datetime.now(), os.getpid(), tag, *args,
+                        extra={"pyp_console": color if log_to_console else None})
+        else:
+            logging.log(level, "[%s][%d][%s] %s",
+                        datetime.datetime.now(), os.getpid(), tag, logstr,
+                        extra={"pyp_console": color if log_to_console else None})
+        return None
+
+    if args:
+        logstr = logstr % args
+
+    dlogstr = ("[%s][%d][%s] %s" %
+                (datetime.datetime.now(), os.getpid(), tag, logstr))
+
+    logging.log(level, dlogstr)
+
+    if log_to_console:
+        print(color + dlogstr + Fore.RESET + Style.RESET_ALL)
+
+    return dlogstr
+
+def log_enabled(level):
+    ''' Returns True if logs of the given level will be logged.
+        Callers can use this to avoid preparing expensive log arguments.
+    '''
+    # skip_logging doesn't skip warnings and errors.
+    if cfg.skip_logging and level < logging.WARNING:
+        return False
+    return logging.getLogger().isEnabledFor(level)
+
+def PYPLog(logstr, *args, console=None, logfile=False):
     ''' Normal logging.
         It'll log to console, if:
             1. Caller has passed console=True
             2. Caller has not explicitly passed console=False and
                cfg.log_to_console is True.
+
+        logstr is formatted with args (logstr % args) only if the log is
+        actually written, so callers should pass args instead of formatting
+        logstr themselves, in hot paths.
     '''
-    if cfg.skip_logging:
+    if not log_enabled(logging.INFO):
         return
 
     log_to_console = (console or (console is None and cfg.log_to_console))
 
-    dlogstr = ("[%s][%d][   LOG] %s" %
-                (datetime.datetime.now(), os.getpid(), logstr))
-
-    logging.info(dlogstr)
-
-    if log_to_console:
-        print(dlogstr)
+    _pyplog(logging.INFO, "   LOG", "", log_to_console, logstr, args)
 
-def PYPDebug(logstr, console=None):
+def PYPDebug(logstr, *args, console=None):
     ''' Normal logging.
     '''
-    if cfg.skip_logging or not cfg.verbose:
+    if not cfg.verbose or not log_enabled(logging.INFO):
         return
 
     log_to_console = (console or (console is None and cfg.log_to_console))
 
-    dlogstr = ("[%s][%d][ DEBUG] %s" %
-                (datetime.datetime.now(), os.getpid(), logstr))
-
-    logging.info(dlogstr)
-
-    if log_to_console:
-        print(dlogstr)
+    _pyplog(logging.INFO, " DEBUG", "", log_to_console, logstr, args)
 
-def PYPInfo(logstr, console=None, logfile=False):
+def PYPInfo(logstr, *args, console=None, logfile=False):
     ''' Bright.
     '''
-    if cfg.skip_logging:
+    if not log_enabled(logging.INFO):
         return
 
     log_to_console = (console or (console is None and cfg.log_to_console))
 
-    dlogstr = ("[%s][%d][  INFO] %s" %
-            (datetime.datetime.now(), os.getpid(), logstr))
-
-    logging.info(dlogstr)
-
-    if log_to_console:
-        print(Style.BRIGHT + dlogstr + Style.RESET_ALL)
+    _pyplog(logging.INFO, "  INFO", Style.BRIGHT, log_to_console, logstr, args)
 
-def PYPError(logstr, console=None):
+def PYPError(logstr, *args, console=None):
     ''' Bright red.
     '''
     # Always log errors to console. This helps in catching assert failures.
     log_to_console = True
 
+    if args:
+        logstr = logstr % args
+
     dlogstr = ("[%s][%d][ ERROR] %s" %
                 (datetime.datetime.now(), os.getpid(), logstr))
 
-    logging.error(dlogstr)
-
-    if log_to_console:
-        print(Style.BRIGHT + Fore.RED + dlogstr + Fore.RESET + Style.RESET_ALL)
+    _pyplog(logging.ERROR, " ERROR", Style.BRIGHT + Fore.RED, log_to_console, logstr, ())
 
+    #
     # Send errors to error log too.
+    # Errors are rare, so we write these synchronously so that they are not
+    # lost even if we die right after.
+    #
     err_f.write(dlogstr + "\n")
     err_f.flush()
 
-def PYPWarn(logstr, console=None, logfile=True):
+def PYPWarn(logstr, *args, console=None, logfile=True):
     ''' Bright yellow.
     '''
+    if not log_enabled(logging.WARNING):
+        return
+
     #
     # XXX
     # When directing logs to a file/null it's useful to have warning logs come
@@ -144,49 +283,87 @@ def PYPWarn(logstr, console=None, logfile=True):
     #log_to_console = (console or (console is None and cfg.log_to_console))
     log_to_console = True
 
-    dlogstr = ("[%s][%d][  WARN] %s" %
-                (datetime.datetime.now(), os.getpid(), logstr))
+    _pyplog(logging.WARNING, "  WARN", Style.BRIGHT + Fore.YELLOW, log_to_console, logstr, args)
+
+#
+# Rate limiting state for ratelimit().
+# key -> [time of the last allowed log, logs suppressed since then].
+#
+ratelimit_state = {}
+ratelimit_lock = threading.Lock()
+
+def ratelimit(key, interval=None):
+    ''' Rate limiter for logs which can come for every tick.
+        Logs with the same key are allowed at most once every 'interval'
+        seconds (cfg.log_ratelimit_secs by default).
+        Returns None if the log must be suppressed, else returns the count of
+        logs suppressed since the last allowed one, which the caller should
+        log.
+    '''
+    if interval is None:
+        interval = cfg.log_ratelimit_secs
+
+    now = time.monotonic()
+    with ratelimit_lock:
+        state = ratelimit_state.get(key)
+        if state is None:
+            state = [None, 0]
+            ratelimit_state[key] = state
+        elif (now - state[0]) < interval:
+            state[1] += 1
+            return None
+        suppressed = state[1]
+        state[0] = now
+        state[1] = 0
+
+    return suppressed
+
+def PYPWarnRateLimited(key, logstr, *args, interval=None):
+    ''' Same as PYPWarn() but warnings with the same key are rate limited,
+        see ratelimit().
+    '''
+    if not log_enabled(logging.WARNING):
+        return
 
-    logging.warn(dlogstr)
+    suppressed = ratelimit(key, interval)
+    if suppressed is None:
+        return
 
-    if log_to_console:
-        print(Style.BRIGHT + Fore.YELLOW + dlogstr +
-              Fore.RESET + Style.RESET_ALL)
+    if suppressed > 0:
+        logstr = ("[%s, suppressed %d] " % (key, suppressed)) + logstr
+
+    PYPWarn(logstr, *args)
 
-def PYPPass(logstr, console=None, logfile=True):
+def PYPPass(logstr, *args, console=None, logfile=True):
     ''' Logging for some successful action.
     '''
-    if cfg.skip_logging:
+    if not log_enabled(logging.INFO):
         return
 
     log_to_console = (console or (console is None and cfg.log_to_console))
 
-    dlogstr = ("[%s][%d][  PASS] %s" %
-            (datetime.datetime.now(), os.getpid(), logstr))
+    _pyplog(logging.INFO, "  PASS", Style.BRIGHT + Fore.GREEN, log_to_console, logstr, args)
 
-    logging.info(dlogstr)
-
-    if log_to_console:
-        print(Style.BRIGHT + Fore.GREEN + dlogstr +
-              Fore.RESET + Style.RESET_ALL)
-
-def PYPFail(logstr, console=None):
+def PYPFail(logstr, *args, console=None):
     ''' Logging for some failed action.
     '''
     # Just like PYPError(), log all failures to console.
     log_to_console = True
 
+    if args:
+        logstr = logstr % args
+
     dlogstr = ("[%s][%d][  FAIL] %s" %
                 (datetime.datetime.now(), os.getpid(), logstr))
 
-    logging.error(dlogstr)
-
-    if log_to_console:
-        print(Fore.RED + dlogstr + Fore.RESET + Style.RESET_ALL)
+    _pyplog(logging.ERROR, "  FAIL", Fore.RED, log_to_console, logstr, ())
 
     err_f.write(dlogstr + "\n")
     err_f.flush()
 
+if cfg.async_logging:
+    start_async_logging()
+
 def register_exitcb(cb):
     ''' Register callback to be called on program exit.
         Unfortunately atexit handlers are not called by os._exit() and sys.exit()
@@ -346,6 +523,9 @@ def ASSERT(cond, msg=None, exitcode=None):
     if exit_cb is not None:
         exit_cb()
 
+    # os._exit() doesn't run atexit handlers, write the queued logs now.
+    stop_async_logging()
+
     try:
         sys.stdout.flush()
         sys.exit(exitcode if exitcode is not None else 1)
@@ -589,6 +769,64 @@ def get_current_time():
     #return tz.localize(datetime.datetime.now())
     return datetime.datetime.now()
 
+#
+# IST is UTC+05:30 and has no DST, so a fixed offset is all we need to convert
+# epoch seconds to IST wall clock.
+#
+IST_OFFSET_SECS = 19800
+
+def epoch_to_ist_minute(epoch):
+    ''' Given epoch seconds, return the absolute IST minute, i.e., minutes
+        since epoch as per the IST wall clock.
+        (epoch_to_ist_minute(epoch) % 1440) gives the minute-of-day and
+        (epoch % 60) gives the seconds-in-minute.
+
+        PERF: This is meant for the per-tick path where creating a tz-aware
+              pd.Timestamp for every tick is too expensive. Use
+              epoch_to_ist() only when a Timestamp is really needed.
+    '''
+    return (epoch + IST_OFFSET_SECS) // 60
+
+def token_partition(token, npartitions):
+    ''' Partition (0..npartitions-1) of the broker token (string).
+        This must be stable across processes and restarts, so that the
+        websocket connection and the candle worker of a token always agree,
+        hence crc32 and not hash() which is randomized per process.
+    '''
+    if npartitions == 1:
+        return 0
+    return zlib.crc32(token.encode()) % npartitions
+
+def ist_str_to_minute(dtstr):
+    ''' Given an IST datetime string as found in the live/historical csv
+        files, f.e., "2023-11-17 09:15:00+05:30", return the absolute IST
+        minute, same as epoch_to_ist_minute() would for the same time.
+
+        PERF: This only parses the "YYYY-MM-DD HH:MM" prefix w/o creating a
+              pd.Timestamp. The wall clock time is treated as UTC so the
+              result is minutes since epoch as per the IST wall clock.
+    '''
+    d = datetime.datetime.strptime(dtstr[:16], "%Y-%m-%d %H:%M")
+    return (d - datetime.datetime(1970, 1, 1)) // datetime.timedelta(minutes=1)
+
+def epoch_to_ist(epoch):
+    ''' Given epoch seconds, return the tz-aware (Asia/Kolkata) pd.Timestamp.
+    '''
+    return pd.to_datetime(epoch, unit='s').tz_localize('UTC').tz_convert('Asia/Kolkata')
+
+class LazyIST:
+    ''' Wrapper for epoch seconds which is converted to the IST Timestamp
+        string only when it's formatted, use it for passing timestamps to the
+        PYP*() helpers which format lazily.
+    '''
+    __slots__ = ("epoch",)
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+
+    def __str__(self):
+        return str(epoch_to_ist(self.epoch))
+
 def is_market_open(dt=None):
     ''' Given a Timestamp, return if the markets are open at that time.
         Caller usually wants to start a candle at this time, so we return
@@ -0,0 +1,134 @@
+import os, time, random, threading
+
+#
+# Per-endpoint token bucket rate limiter with jittered exponential backoff,
+# for calling broker REST APIs that have per-endpoint rate limits.
+#
+# Every endpoint has one or more token buckets, one for every limit it has,
+# f.e., AngelOne's getCandleData allows 3 requests/sec, 180/min and 5000/hr.
+# acquire() takes a token from each bucket of the endpoint, waiting exactly as
+# long as needed for the bucket that runs out last. Tokens are reserved under
+# the lock and the wait happens outside it, so concurrent callers are spaced
+# out in the order they come and none of them sleeps longer than required.
+#
+# When a call still gets rate limited (or fails), backoff() pushes the
+# endpoint's next allowed call out by a jittered exponential delay ("full
+# jitter", i.e., uniformly random between 0 and base * 2^attempt, capped), so
+# the retry, and every other caller of that endpoint, waits for it in
+# acquire(). Callers never sleep on their own.
+#
+# Counters (calls, throttles, wait time, retries) are kept per endpoint, see
+# stats().
+#
+# Note: This doesn't use pylive's helpers (logging etc) so that pyhistorical
+#       can use it too.
+#
+
+class TokenBucket:
+    def __init__(self, requests, seconds):
+        # Refill rate (tokens/sec) and capacity.
+        self.rate = requests / seconds
+        self.capacity = requests
+        self.tokens = requests
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        ''' Take a token, returns how long to wait (from now) before using it.
+            Tokens go negative for callers that have to wait, so the callers
+            after them wait longer.
+        '''
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+class Endpoint:
+    def __init__(self, limits):
+        self.buckets = [TokenBucket(requests, seconds) for requests, seconds in limits]
+        # Set by backoff(), no call before this (time.monotonic()).
+        self.not_before = 0
+
+        # Stats.
+        self.calls = 0
+        self.throttles = 0
+        self.wait = 0.0
+        self.retries = 0
+
+class RateLimiter:
+    def __init__(self, limits, backoff_base=0.25, backoff_max=8.0):
+        ''' limits maps endpoint name to its limit, either requests/sec or a
+            list of (requests, seconds) tuples. Endpoints not in limits are
+            not throttled, but they still get backoff and stats.
+        '''
+        self.limits = {}
+        for name, limit in limits.items():
+            if isinstance(limit, (int, float)):
+                limit = [(limit, 1)]
+            self.limits[name] = limit
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+        # fork() may happen while some other thread holds the lock.
+        os.register_at_fork(after_in_child=self.reset_lock)
+
+    def reset_lock(self):
+        self.lock = threading.Lock()
+
+    def get_endpoint(self, name):
+        endpoint = self.endpoints.get(name)
+        if endpoint is None:
+            endpoint = Endpoint(self.limits.get(name, []))
+            self.endpoints[name] = endpoint
+        return endpoint
+
+    def acquire(self, name):
+        ''' Wait till endpoint name can be called without exceeding its rate
+            limits (or the backoff set by backoff()). Returns the time waited.
+        '''
+        with self.lock:
+            endpoint = self.get_endpoint(name)
+            now = time.monotonic()
+            wait = max([endpoint.not_before - now] +
+                       [bucket.reserve(now) for bucket in endpoint.buckets])
+            endpoint.calls += 1
+            if wait > 0:
+                endpoint.throttles += 1
+                endpoint.wait += wait
+
+        if wait > 0:
+            time.sleep(wait)
+            return wait
+        return 0
+
+    def backoff(self, name, attempt):
+        ''' Call after attempt (1 for the first call) to call endpoint name
+            failed, f.e., with a rate limit error. The next acquire() for the
+            endpoint waits for a jittered exponential delay.
+            Returns the delay.
+        '''
+        delay = random.uniform(0, min(self.backoff_max,
+                                      self.backoff_base * (2 ** (attempt - 1))))
+        with self.lock:
+            endpoint = self.get_endpoint(name)
+            endpoint.not_before = max(endpoint.not_before, time.monotonic() + delay)
+            endpoint.retries += 1
+        return delay
+
+    def stats(self):
+        ''' Per endpoint counters, along with their totals (as "total").
+        '''
+        with self.lock:
+            stats = {name: {"calls": endpoint.calls,
+                            "throttles": endpoint.throttles,
+                            "wait": round(endpoint.wait, 3),
+                            "retries": endpoint.retries}
+                     for name, endpoint in self.endpoints.items()}
+
+        stats["total"] = {key: sum(endpoint[key] for endpoint in stats.values())
+                          for key in ("calls", "throttles", "wait", "retries")}
+        stats["total"]["wait"] = round(stats["total"]["wait"], 3)
+        return stats
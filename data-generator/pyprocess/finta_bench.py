@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+#
+# Correctness and speed benchmark for the vendored finta (finta/finta.py).
+#
+# It runs every TA method on fixed synthetic OHLCV frames of various sizes and
+# for each (method, size) pair it records the runtime and the peak memory
+# allocated by the method. For the "golden" sizes it also compares the output
+# against the golden values stored in finta/golden/, so that any optimization
+# to finta which changes the numerical output is caught.
+#
+# Usual workflow:
+# 1. Before touching finta, generate the golden values using the unmodified
+#    finta.py and commit them.
+#    $ ./finta_bench.py --update-golden
+# 2. Make changes to finta.py, run the benchmark and check that all methods
+#    still PASS and compare the runtimes against the earlier run.
+#    $ ./finta_bench.py --csv /tmp/finta.after.csv
+#
+# This doesn't use config.py/helpers.py as those need a valid backtester.json
+# and data tld, and we want to be able to run the benchmark anywhere.
+#
+import os, sys
+import time
+import inspect
+import argparse
+import tracemalloc
+import numpy as np
+import pandas as pd
+from colorama import Fore, Style
+
+from finta.finta import TA as ta
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "finta", "golden")
+
+# Seed for the synthetic data, changing this invalidates all golden files.
+SEED = 20231117
+
+# Sizes (number of rows) for which we benchmark, and those for which we check golden values.
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000, 5000000]
+DEFAULT_GOLDEN_SIZES = [1000, 10000]
+
+#
+# Methods which have mandatory arguments or whose default arguments are not
+# suitable for the benchmark. Anything not listed here is called with just the
+# ohlcv frame.
+#
+METHOD_KWARGS = {
+    "LWMA": {"period": 10},
+}
+
+#
+# Methods which are not really indicators, or cannot be called on the synthetic
+# frame. Keep this list short, a method listed here is not guarded at all.
+# These just raise NotImplementedError in finta.
+#
+SKIP_METHODS = {"ALMA", "LWMA", "MAMA", "SWI", "TMF", "VIDYA"}
+
+def synthetic_ohlcv(rows):
+    ''' Return a deterministic OHLCV DataFrame with 'rows' 1Min candles.
+        Prices follow a random walk around 1000.0, rounded to the tick size of
+        0.05, and the candles are consistent, i.e. low <= open,close <= high.
+        Index is a DatetimeIndex of 1Min candles (ignoring market hours) as
+        some methods need a datetime index.
+    '''
+    rng = np.random.default_rng(SEED)
+
+    close = 1000.0 + np.cumsum(rng.normal(0, 0.5, rows))
+    # Don't let the random walk go to/below 0, some indicators take log.
+    close = np.maximum(close, 10.0)
+    open_ = np.empty(rows)
+    open_[0] = close[0]
+    open_[1:] = close[:-1] + rng.normal(0, 0.1, rows - 1)
+    high = np.maximum(open_, close) + np.abs(rng.normal(0, 0.3, rows))
+    low = np.minimum(open_, close) - np.abs(rng.normal(0, 0.3, rows))
+    volume = rng.integers(1, 100000, rows).astype(np.float64)
+
+    round_tick = lambda a: np.round(a * 20) / 20
+
+    index = pd.date_range("2017-01-02 09:15:00", periods=rows, freq="1min")
+    return pd.DataFrame({"open": round_tick(open_),
+                         "high": round_tick(high),
+                         "low": round_tick(low),
+                         "close": round_tick(close),
+                         "volume": volume}, index=index)
+
+def ta_methods():
+    ''' Return sorted list of names of all the TA indicator methods. '''
+    methods = []
+    for name, member in inspect.getmembers(ta):
+        if name.startswith("_") or not callable(member):
+            continue
+        if name in SKIP_METHODS:
+            continue
+        methods.append(name)
+    return sorted(methods)
+
+def result_to_arrays(name, result):
+    ''' Convert result of a TA method (Series/DataFrame/tuple of Series) to a
+        dict of float64 numpy arrays, keyed by "<method>.<column>".
+    '''
+    arrays = {}
+    if isinstance(result, pd.DataFrame):
+        for i, col in enumerate(result.columns):
+            arrays["%s.%d.%s" % (name, i, col)] = result[col]
+    elif isinstance(result, pd.Series):
+        arrays["%s.0" % name] = result
+    elif isinstance(result, (tuple, list)):
+        for i, r in enumerate(result):
+            arrays["%s.%d" % (name, i)] = r
+    else:
+        arrays["%s.0" % name] = result
+
+    for key in arrays:
+        arrays[key] = np.asarray(arrays[key], dtype=np.float64)
+    return arrays
+
+def run_method(name, ohlcv, measure_alloc):
+    ''' Run one TA method on ohlcv and return (result, seconds, peak_bytes).
+        The method is run once untraced for timing, and once more under
+        tracemalloc for the allocation numbers if measure_alloc is True, as
+        tracemalloc slows down allocation heavy code by a lot.
+    '''
+    method = getattr(ta, name)
+    kwargs = METHOD_KWARGS.get(name, {})
+
+    # Every call gets its own copy as some methods modify the passed frame.
+    df = ohlcv.copy()
+    start = time.perf_counter()
+    result = method(df, **kwargs)
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if measure_alloc:
+        df = ohlcv.copy()
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        method(df, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+def golden_file(rows):
+    return os.path.join(GOLDEN_DIR, "golden_%d.npz" % rows)
+
+def load_golden(rows):
+    path = golden_file(rows)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {key: f[key] for key in f.files}
+
+def compare(name, arrays, golden, rtol, atol):
+    ''' Compare the method output against the golden values.
+        Returns None if they match, else a string describing the mismatch.
+    '''
+    keys = sorted(k for k in golden if k.split(".", 1)[0] == name)
+    if not keys:
+        return "no golden values"
+    if keys != sorted(arrays.keys()):
+        return "output columns %s != golden %s" % (sorted(arrays.keys()), keys)
+
+    for key in keys:
+        got, exp = arrays[key], golden[key]
+        if got.shape != exp.shape:
+            return "%s: shape %s != golden %s" % (key, got.shape, exp.shape)
+        bad = ~np.isclose(got, exp, rtol=rtol, atol=atol, equal_nan=True)
+        if bad.any():
+            idx = int(np.argmax(bad))
+            return ("%s: %d values differ, first at row %d (got %r, golden %r)" %
+                    (key, int(bad.sum()), idx, got[idx], exp[idx]))
+    return None
+
+def fmt_bytes(n):
+    if n is None:
+        return "-"
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return "%.1f%s" % (n, unit)
+        n /= 1024
+    return "%.1fTB" % n
+
+def main():
+    parser = argparse.ArgumentParser(description="finta correctness and speed benchmark")
+
+    parser.add_argument("--sizes", type=str,
+                        default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="comma separated list of frame sizes (rows) to benchmark")
+    parser.add_argument("--golden-sizes", type=str,
+                        default=",".join(str(s) for s in DEFAULT_GOLDEN_SIZES),
+                        help="comma separated list of frame sizes checked against golden values")
+    parser.add_argument("--methods", type=str,
+                        help="comma separated list of TA methods to run, default all")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="(re)generate golden values for --golden-sizes, instead of checking")
+    parser.add_argument("--rtol", type=float, default=1e-9, help="relative tolerance")
+    parser.add_argument("--atol", type=float, default=1e-9, help="absolute tolerance")
+    parser.add_argument("--no-alloc", action="store_true",
+                        help="don't measure allocations (halves the run time)")
+    #
+    # Some indicators are implemented as python loops and take forever on the
+    # larger frames. Once a method takes more than --budget secs for a size,
+    # skip it for the larger sizes.
+    #
+    parser.add_argument("--budget", type=float, default=60.0,
+                        help="skip larger sizes for a method once it takes more than these many secs")
+    parser.add_argument("--csv", type=str, help="save per-method results to this csv file")
+
+    args = parser.parse_args()
+
+    sizes = sorted(int(s) for s in args.sizes.split(","))
+    golden_sizes = set(int(s) for s in args.golden_sizes.split(","))
+    if args.update_golden:
+        # Golden values don't need the large sizes.
+        sizes = sorted(golden_sizes)
+
+    methods = ta_methods()
+    if args.methods:
+        wanted = args.methods.split(",")
+        unknown = set(wanted) - set(methods)
+        if unknown:
+            print("Unknown TA methods: %s" % sorted(unknown))
+            sys.exit(1)
+        methods = [m for m in methods if m in wanted]
+
+    print("finta %s, %d methods, sizes %s" % (ta.__version__, len(methods), sizes))
+
+    rows = []
+    failed = 0
+    over_budget = set()
+
+    for size in sizes:
+        ohlcv = synthetic_ohlcv(size)
+        check = (size in golden_sizes) and not args.update_golden
+        golden = load_golden(size) if check else None
+        if check and golden is None:
+            #
+            # Missing golden file means nothing is guarded, fail rather than
+            # letting every method through.
+            #
+            print(Fore.RED + "No golden file %s, run with --update-golden using the "
+                  "unmodified finta" % golden_file(size) + Style.RESET_ALL)
+            sys.exit(1)
+
+        #
+        # With --methods only the selected methods' arrays are regenerated,
+        # the golden values of the other methods must be kept as they are.
+        #
+        new_golden = {}
+        if args.update_golden and args.methods:
+            new_golden = load_golden(size) or {}
+            for key in [k for k in new_golden if k.split(".", 1)[0] in methods]:
+                del new_golden[key]
+
+        for name in methods:
+            if name in over_budget:
+                continue
+
+            try:
+                result, seconds, peak = run_method(name, ohlcv, not args.no_alloc)
+            except Exception as e:
+                failed += 1
+                print(Fore.RED + "[%8d] %-18s EXCEPTION %s: %s" %
+                      (size, name, type(e).__name__, e) + Style.RESET_ALL)
+                rows.append((name, size, None, None, "EXCEPTION"))
+                continue
+
+            arrays = result_to_arrays(name, result)
+            status = "-"
+            color = ""
+
+            if args.update_golden:
+                new_golden.update(arrays)
+                status = "SAVED"
+            elif golden is not None:
+                mismatch = compare(name, arrays, golden, args.rtol, args.atol)
+                #
+                # A method w/o golden values (f.e., newly added) fails till
+                # they are added with --update-golden --methods <name>.
+                #
+                if mismatch is None:
+                    status = "PASS"
+                    color = Fore.GREEN
+                else:
+                    status = "FAIL"
+                    color = Fore.RED
+                    failed += 1
+
+            print(color + "[%8d] %-18s %10.4fs %10s  %s" %
+                  (size, name, seconds, fmt_bytes(peak), status) + Style.RESET_ALL)
+            if status == "FAIL":
+                print(Fore.RED + "           %s" % mismatch + Style.RESET_ALL)
+
+            rows.append((name, size, seconds, peak, status))
+
+            if seconds > args.budget:
+                print(Fore.YELLOW + "           %s took %.1fs > budget %.1fs, skipping larger sizes" %
+                      (name, seconds, args.budget) + Style.RESET_ALL)
+                over_budget.add(name)
+
+        if args.update_golden:
+            os.makedirs(GOLDEN_DIR, exist_ok=True)
+            np.savez_compressed(golden_file(size), **new_golden)
+            print("Saved %d golden arrays to %s" % (len(new_golden), golden_file(size)))
+
+    if args.csv:
+        pd.DataFrame(rows, columns=["method", "rows", "seconds", "peak_bytes", "status"]).to_csv(args.csv, index=False)
+        print("Saved results to %s" % args.csv)
+
+    # Slowest methods at the largest size, these are the ones to look at first.
+    timed = [r for r in rows if r[2] is not None]
+    if timed:
+        largest = max(r[1] for r in timed)
+        slowest = sorted((r for r in timed if r[1] == largest), key=lambda r: -r[2])[:10]
+        print("\nSlowest methods at %d rows:" % largest)
+        for name, size, seconds, peak, _ in slowest:
+            print("    %-18s %10.4fs %10s" % (name, seconds, fmt_bytes(peak)))
+        if over_budget:
+            print("Over budget (not run at all sizes): %s" % sorted(over_budget))
+
+    if failed:
+        print(Fore.RED + "\n%d failures!" % failed + Style.RESET_ALL)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()